@@ -4,15 +4,25 @@ import os
 import logging
 from jobwatcher import JobWatcher
 import sys
-from messagesender import MessageSender#
-from journal import Journal
+import signal
+from messagesender import MessageSender, PipelinedMessageSender
+from journal import Journal, CheckpointingJournal, ConfirmedEventTracker
+from models import StatusCache, JobState
+from leader import LeaderLease, LeaderElectedRunner
+from pipeline import EventPipeline
+from outbox import SpoolOutbox
+from metrics import MetricsServer, watch_health
+import redispool
+from registry import JobRegistry
+from timeline import RouteTimeline
 import pika
+import socket
+import threading
+import uuid
+from functools import partial
+from logsetup import configure_logging
 
-logging.basicConfig(format="{asctime} {name}|{funcName} [{levelname}] {message}",level=logging.DEBUG,style='{')
-pikaLogger = logging.getLogger("pika")
-pikaLogger.level=logging.WARN
-k8logger = logging.getLogger("kubernetes")
-k8logger.level = logging.WARN
+configure_logging()
 logger = logging.getLogger(__name__)
 
 
@@ -34,18 +44,48 @@ def get_current_namespace():
         return None
 
 
-if __name__ == "__main__":
-    init_k8s_client()
+def get_namespaces()->list:
+    """
+    works out which namespaces to watch: the comma-separated NAMESPACES list if it is set, otherwise the one that we
+    are running in (or NAMESPACE if we are outside the cluster)
+    :return: list of namespace names, empty if none could be determined
+    """
+    from_env = os.getenv("NAMESPACES")
+    if from_env:
+        return [ns.strip() for ns in from_env.split(",") if ns.strip()!=""]
 
     namespace = get_current_namespace()
     if namespace is None:
         namespace = os.getenv("NAMESPACE")
+    return [namespace] if namespace is not None else []
 
-    if namespace is None:
-        logger.error("Could not determine namespace from inside cluster, and NAMESPACE was not set in the environment")
+
+def run_in_thread(name:str, target, failed:threading.Event):
+    """
+    runs the target on a daemon thread, setting `failed` if it raises
+    """
+    def wrapper():
+        try:
+            target()
+        except Exception as e:
+            logger.exception("Watcher for {0} failed: {1}".format(name, e))
+            failed.set()
+
+    t = threading.Thread(target=wrapper, name=name, daemon=True)
+    t.start()
+    return t
+
+
+if __name__ == "__main__":
+    init_k8s_client()
+
+    namespaces = get_namespaces()
+    if len(namespaces)==0:
+        logger.error("Could not determine namespace from inside cluster, and neither NAMESPACES nor NAMESPACE was set in the environment")
         sys.exit(1)
 
-    logger.info("CDSReaper started up, namespace is '{0}'".format(namespace))
+    leader_election = os.getenv("LEADER_ELECTION", "false").lower()=="true"
+    logger.info("CDSReaper started up, namespaces are {0}{1}".format(namespaces, " (with leader election)" if leader_election else ""))
 
     rmq_setup = pika.connection.ConnectionParameters(
         host=os.environ.get("RABBITMQ_HOST"),
@@ -56,14 +96,155 @@ if __name__ == "__main__":
         retry_delay=int(os.environ.get("RABBITMQ_RETRY_DELAY", 3))
     )
 
-    sender = MessageSender(rmq_setup, os.environ.get("MY_EXCHANGE", "cdsresponder"))
-    #prefer to crash if we can't connect at startup, this makes it obvious to monitoring that we are not running yet.
-    #once we are up and running, retry more, in order to try and stay up.
-    journal = Journal(os.getenv("REDIS_HOST"),
-                      int(os.getenv("REDIS_PORT",6379)),
-                      int(os.getenv("REDIS_DB_NUM", 0)),
-                      os.getenv("REDIS_PASS"),
-                      max_retries=1)
-    journal.max_retries = 10
-    job_watcher = JobWatcher(kubernetes.client.BatchV1Api(), sender, journal, namespace)
-    job_watcher.run_sync()
+    # if PUBLISH_CONFIRM_WINDOW is set, up to that many messages can be waiting for a broker confirmation at once.
+    # otherwise each message is confirmed before the next watch event is read.
+    confirm_window = int(os.environ.get("PUBLISH_CONFIRM_WINDOW", 0))
+    # if OUTBOX_PATH is set, messages are spooled to disk and sent on from there in the background, so that we carry on
+    # reading the watch while rabbitmq is down
+    outbox_path = os.getenv("OUTBOX_PATH")
+    if outbox_path is not None and confirm_window > 0:
+        logger.warning("PUBLISH_CONFIRM_WINDOW is ignored when OUTBOX_PATH is set, the outbox sends one message at a time")
+        confirm_window = 0
+    if confirm_window > 0:
+        logger.info("Publishing with up to {0} unconfirmed messages in flight".format(confirm_window))
+    # if PIPELINE_QUEUE_SIZE is set, publishing and journalling are handed off to background stages so that reading the
+    # watch only waits for them when this many items are queued up
+    pipeline_queue_size = int(os.environ.get("PIPELINE_QUEUE_SIZE", 0))
+
+    # each namespace gets its own connections and journal key, so that they can be watched independently. with a
+    # single namespace we keep the original key so that an existing journal is picked up
+    shards = []
+    fallback_file = os.getenv("JOURNAL_FALLBACK_FILE")
+    # every journal, status cache and leader lease gets its redis client from one shared connection pool of this size
+    redispool.DEFAULT_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", redispool.DEFAULT_MAX_CONNECTIONS))
+    # records of finished jobs are kept for this long, so that the keyspace doesn't grow forever. 0 keeps them forever
+    finished_job_ttl = int(os.getenv("FINISHED_JOB_TTL_SECONDS", 7*24*3600))
+    # every job status is also indexed in the job registry for this long, so that jobs can be looked up with
+    # registry.py. 0 turns the registry off
+    registry_retention = int(os.getenv("REGISTRY_RETENTION_SECONDS", 7*24*3600))
+    # per-route duration histograms are kept for this long, 0 turns them off
+    timeline_retention = int(os.getenv("TIMELINE_RETENTION_SECONDS", 30*24*3600))
+    indexers = None
+    for namespace in namespaces:
+        if confirm_window > 0:
+            sender = PipelinedMessageSender(rmq_setup, os.environ.get("MY_EXCHANGE", "cdsresponder"), max_outstanding=confirm_window)
+        else:
+            sender = MessageSender(rmq_setup, os.environ.get("MY_EXCHANGE", "cdsresponder"))
+        if outbox_path is not None:
+            sender = SpoolOutbox(outbox_path if len(namespaces)==1 else "{0}.{1}".format(outbox_path, namespace), sender,
+                                 fsync=os.getenv("OUTBOX_FSYNC", "true").lower()!="false")
+        #prefer to crash if we can't connect at startup, this makes it obvious to monitoring that we are not running yet.
+        #once we are up and running, retry more, in order to try and stay up.
+        journal = CheckpointingJournal(os.getenv("REDIS_HOST"),
+                                       int(os.getenv("REDIS_PORT",6379)),
+                                       int(os.getenv("REDIS_DB_NUM", 0)),
+                                       os.getenv("REDIS_PASS"),
+                                       max_retries=1,
+                                       checkpoint_events=int(os.getenv("JOURNAL_CHECKPOINT_EVENTS", 100)),
+                                       checkpoint_interval_ms=int(os.getenv("JOURNAL_CHECKPOINT_INTERVAL_MS", 2000)),
+                                       fallback_path=fallback_file if fallback_file is None or len(namespaces)==1 else "{0}.{1}".format(fallback_file, namespace),
+                                       event_key=Journal.EVENT_KEY if len(namespaces)==1 else "{0}:{1}".format(Journal.EVENT_KEY, namespace))
+        journal.max_retries = 10
+        if indexers is None:
+            indexers = []
+            if registry_retention > 0:
+                registry = JobRegistry(journal.client, retention_seconds=registry_retention)
+                registry.start_pruning()
+                indexers.append(registry)
+            if timeline_retention > 0:
+                indexers.append(RouteTimeline(journal.client, retention_seconds=timeline_retention))
+        if pipeline_queue_size > 0:
+            pipeline = EventPipeline(sender, journal, queue_size=pipeline_queue_size, namespace=namespace)
+            pipeline.start()
+        else:
+            pipeline = None
+        shards.append((namespace, sender, journal, pipeline))
+
+    def make_watcher(namespace, sender, journal, pipeline):
+        # the status cache and tracker are made afresh for each watcher, so that a replica that becomes leader again
+        # does not compare against statuses that another replica has moved on from in the meantime.
+        # job states are written out along with the journal checkpoints rather than one at a time
+        # with a single namespace we keep the original key prefix, like the journal key, so that existing records are
+        # picked up
+        status_cache = StatusCache(journal.client, max_entries=int(os.getenv("STATUS_CACHE_SIZE", 1000)),
+                                   finished_ttl=finished_job_ttl if finished_job_ttl > 0 else None, batched=True,
+                                   indexers=indexers,
+                                   key_prefix=JobState.KEY_PREFIX if len(namespaces)==1 else "{0}:{1}".format(JobState.KEY_PREFIX, namespace))
+        journal.attach_status_cache(status_cache)
+        if pipeline is not None:
+            sender = pipeline
+            journal = pipeline.journal
+        return JobWatcher(kubernetes.client.BatchV1Api(), sender, journal, namespace,
+                          tracker=ConfirmedEventTracker(journal) if confirm_window > 0 or pipeline is not None else None,
+                          status_cache=status_cache,
+                          debounce_seconds=float(os.getenv("STATUS_DEBOUNCE_SECONDS", 0)),
+                          lean_watch=os.getenv("WATCH_DECODER", "lean").lower()!="full",
+                          label_selector=os.getenv("JOB_LABEL_SELECTOR", "app.kubernetes.io/managed-by=cdsresponder"),
+                          watch_timeout=int(os.getenv("WATCH_TIMEOUT_SECONDS", 300)),
+                          relist_page_size=int(os.getenv("RELIST_PAGE_SIZE", 500)),
+                          finished_record_ttl=finished_job_ttl if finished_job_ttl > 0 else None)
+
+    runners = []
+    if leader_election:
+        identity = "{0}-{1}".format(socket.gethostname(), uuid.uuid4().hex[0:8])
+        max_led = int(os.getenv("MAX_LEADER_NAMESPACES", 0))
+        slots = threading.Semaphore(max_led) if max_led > 0 else None
+        for shard in shards:
+            namespace, _, journal, _ = shard
+            lease = LeaderLease(journal.client, "cdsreaper:leader:{0}".format(namespace), identity,
+                                ttl_ms=int(os.getenv("LEADER_LEASE_MS", 10000)))
+            # a replica that loses the lease must not write over what the next leader writes
+            journal.fence_with(lease)
+            runners.append(LeaderElectedRunner(lease, partial(make_watcher, *shard), slots=slots, on_lost=journal.discard))
+        logger.info("Standing by for leadership as {0}".format(identity))
+
+    def shut_down():
+        for namespace, sender, journal, pipeline in shards:
+            if pipeline is not None and not pipeline.close(timeout=5):
+                logger.error("Could not publish everything queued for {0} before exit".format(namespace))
+            if outbox_path is not None and not sender.close(timeout=5):
+                logger.warning("Outbox for {0} still has {1} unsent messages, they will be sent on the next run".format(namespace, sender.pending()))
+            if confirm_window > 0:
+                try:
+                    sender.close(timeout=5)
+                except Exception as e:
+                    logger.error("Could not confirm outstanding messages for {0} before exit: {1}".format(namespace, str(e)))
+            journal.flush()
+        # give up our leases once the journals are written, so that a standby can take over without waiting for them
+        # to expire
+        for runner in runners:
+            runner.lease.release()
+
+    # set when a signal asks us to quit, or when a watcher fails
+    stopped = threading.Event()
+    quit_signals = []
+
+    def on_quit(signum, frame):
+        # signal handlers run on the main thread, in between whatever it was doing, so the shutdown is left to the main
+        # loop below rather than done here, where it could wait for a lock that the interrupted code holds
+        logger.info("Caught signal {0}, writing journal checkpoint and exiting...".format(signum))
+        quit_signals.append(signum)
+        stopped.set()
+
+    signal.signal(signal.SIGINT, on_quit)
+    signal.signal(signal.SIGTERM, on_quit)
+
+    # a watch that hasn't heard from the cluster for this long, not even the end of a watch request, is wedged
+    watch_health.max_staleness = float(os.getenv("WATCH_STALE_SECONDS", 2*int(os.getenv("WATCH_TIMEOUT_SECONDS", 300)) + 60))
+    metrics_port = int(os.getenv("METRICS_PORT", 9090))
+    if metrics_port > 0:
+        MetricsServer(metrics_port).start()
+    watch_health.mark_started()
+
+    # the watchers always run on threads of their own, so that the main thread is free to shut down when signalled
+    if leader_election:
+        for runner in runners:
+            run_in_thread(runner.lease.key, runner.run, stopped)
+    else:
+        for shard in shards:
+            run_in_thread(shard[0], make_watcher(*shard).run, stopped)
+    stopped.wait()
+    if len(quit_signals) > 0:
+        shut_down()
+        sys.exit(0)
+    sys.exit(2)
@@ -1,24 +1,68 @@
-from kubernetes import client, config, watch
+from kubernetes import client, config
 import kubernetes.client.exceptions
+import urllib3.exceptions
 from kubernetes.client.models.v1_job import V1Job
 from kubernetes.client.models.v1_job_status import V1JobStatus
 from kubernetes.client.models.v1_job_condition import V1JobCondition
 from kubernetes.client.models.v1_job_list import V1JobList
 from messagesender import MessageSender
-from journal import Journal
+from leanjob import LeanJob, LeanWatch, StrictWatch, parse_job_list
+from journal import Journal, ConfirmedEventTracker
+from metrics import watch_health, resource_version_number, WATCH_EVENTS, EVENT_TO_PUBLISH_SECONDS, \
+    LATEST_RESOURCE_VERSION, RESOURCE_VERSION_GAP, RELISTS, WATCH_RECONNECTS
 
 import sys
+import time
+from functools import partial
 from models import *
+from timeline import job_transitions, unix_time
 
 logger = logging.getLogger(__name__)
 
 
 class JobWatcher(object):
-    def __init__(self, api_client: client.BatchV1Api, sender: MessageSender, journal: Journal, namespace: str):
+    TERMINAL_STATUSES = JobState.FINISHED_STATUSES
+
+    def __init__(self, api_client: client.BatchV1Api, sender: MessageSender, journal: Journal, namespace: str,
+                 tracker: ConfirmedEventTracker=None, status_cache: StatusCache=None, debounce_seconds:float=0,
+                 lean_watch=False, label_selector:str=None, watch_timeout:int=300, relist_page_size:int=500,
+                 finished_record_ttl:float=None):
+        """
+        :param api_client: kubernetes BatchV1Api client
+        :param sender: MessageSender, or a PipelinedMessageSender
+        :param journal: Journal to record processed events in
+        :param namespace: namespace to watch
+        :param tracker: if given, events are journalled via the tracker once their messages have been confirmed, rather
+        than directly after sending. Use this with a PipelinedMessageSender.
+        :param status_cache: if given, a notification is only sent when the status of a job actually changes
+        :param debounce_seconds: if a status_cache is given, changes to a non-terminal status within this many seconds of
+        the last notification for the job are ignored. This collapses rapid flip-flops between running and retry.
+        :param lean_watch: if True, the watch stream is parsed straight into LeanJob objects rather than being
+        deserialized into full V1Job models
+        :param label_selector: if given, only jobs matching this label selector are watched, and the check for a "cds-"
+        name prefix is skipped. If not given, every job in the namespace is watched and non-CDS ones are ignored by name.
+        :param watch_timeout: number of seconds that each watch request should last before being renewed
+        :param relist_page_size: number of jobs to fetch per request when re-listing after a 410 Gone
+        :param finished_record_ttl: if the status cache's records of finished jobs expire, the number of seconds after
+        which they do. a finished job that we have no record of is not notified if it finished longer ago than this,
+        since it was notified before its record expired, e.g. a job kept with KEEP_JOBS that turns up in a re-list
+        """
         self._batchv1 = api_client
         self._namespace = namespace
         self._sender = sender
         self._journal = journal
+        self._tracker = tracker
+        self._status_cache = status_cache
+        self.debounce_seconds = debounce_seconds
+        self.lean_watch = lean_watch
+        self.label_selector = label_selector
+        self.watch_timeout = watch_timeout
+        self.relist_page_size = relist_page_size
+        self.finished_record_ttl = finished_record_ttl
+        self._stop = False
+        self._latest_version = None
+        self._resume_version = None     # resource version of the last event handled in the current watch request
+        RESOURCE_VERSION_GAP.labels(namespace).set_function(self._resource_version_gap)
 
     @staticmethod
     def job_is_starting(s: V1JobStatus)->bool:
@@ -67,7 +111,7 @@ class JobWatcher(object):
 
     @staticmethod
     def get_job_status_string(j:V1Job)->str:
-        logger.debug("Current job status dump: {0}".format(j.status))
+        logger.debug("Current job status dump: %s", j.status)
 
         if JobWatcher.job_is_running(j.status):
             return "running"
@@ -80,6 +124,21 @@ class JobWatcher(object):
         elif JobWatcher.job_is_success(j.status):
             return "success"
 
+    @staticmethod
+    def get_job_finish_time(s:V1JobStatus)->float:
+        """
+        returns the unix time at which the job succeeded or failed, or None if it hasn't or we can't tell
+        :param s: V1JobStatus or LeanJobStatus
+        :return: float or None
+        """
+        finished = unix_time(s.completion_time)
+        if finished is not None:
+            return finished
+        times = [unix_time(c.last_transition_time) for c in (s.conditions or [])
+                 if c.type in ("Complete", "Failed") and c.status=="True"]
+        times = [t for t in times if t is not None]
+        return max(times) if len(times)>0 else None
+
     @staticmethod
     def get_most_recent_condition(conditions:list) -> V1JobCondition:
         if len(conditions)==0:
@@ -96,9 +155,59 @@ class JobWatcher(object):
 
         return "{0} - {1}".format(maybe_cond.reason, maybe_cond.message)
 
-    def check_job(self, j:V1Job):
+    def is_transition(self, previous:JobState, status:str, now:float)->bool:
+        """
+        returns true if a job whose last notified state was `previous` has genuinely changed state, i.e. we should send
+        a notification about it
+        :param previous: the last notified JobState, or None if there isn't one
+        :param status: the job's current status string
+        :param now: current timestamp
+        :return: boolean
+        """
+        if previous is None:
+            return True
+        if previous.status == status:
+            return False
+        if status not in self.TERMINAL_STATUSES and now - previous.timestamp < self.debounce_seconds:
+            return False
+        return True
+
+    def check_job(self, j:V1Job, on_confirm=None):
+        """
+        works out the current status of the given job and sends a notification about it, if it has changed since the
+        last notification (when we have a status cache)
+        :param j: V1Job to check
+        :param on_confirm: optional callback for a PipelinedMessageSender, invoked once the message is confirmed
+        :return: the result of the notify call, True if no notification was needed, or False if we have been stopped
+        """
+        if self._stop:
+            # e.g. we have lost leadership, and the new leader will send anything that is needed
+            logger.debug("Watcher for %s has been stopped, not checking job %s", self._namespace, j.metadata.name)
+            return False
         status = self.get_job_status_string(j)
-        logger.info("Job {0} ({1}) is in status {2}".format(j.metadata.name, j.metadata.uid, status))
+
+        new_state = None
+        if self._status_cache is not None:
+            now = time.time()
+            previous = self._status_cache.get(j.metadata.uid)
+            if previous is None and self._record_has_expired(j, status, now):
+                logger.debug("Job %s (%s) finished before its record expired, not notifying again", j.metadata.name, j.metadata.uid)
+                if on_confirm is not None:
+                    on_confirm()
+                return True
+            if not self.is_transition(previous, status, now):
+                logger.debug("Job %s (%s) is still in status %s, not notifying", j.metadata.name, j.metadata.uid, previous.status)
+                if on_confirm is not None:
+                    on_confirm()
+                return True
+            new_state = JobState(j.metadata.uid, j.metadata.name, status, now, j.metadata.labels,
+                                 job_transitions(j, previous, status, now))
+            # remember straight away so that further events for this job are compared against the new status, but
+            # only store it once the message has gone, so that it is re-sent if we crash first
+            self._status_cache.remember(new_state)
+
+        logger.info("Job %s (%s) is in status %s", j.metadata.name, j.metadata.uid, status,
+                    extra={"namespace": self._namespace, "job_name": j.metadata.name, "job_uid": j.metadata.uid, "status": status})
         routing_key = "cds.job.{0}".format(status)
         message_body = {
             "job-id": j.metadata.uid,
@@ -110,51 +219,270 @@ class JobWatcher(object):
         if status=="failed":
             message_body["failure-reason"] = JobWatcher.get_job_failure_reason(j.status)
 
-        return self._sender.notify(routing_key, message_body)
+        if on_confirm is not None:
+            if new_state is not None:
+                on_confirm = partial(self._on_state_confirmed, new_state, on_confirm)
+            return self._sender.notify(routing_key, message_body, on_confirm=on_confirm)
+        else:
+            result = self._sender.notify(routing_key, message_body)
+            if result and new_state is not None:
+                self._status_cache.persist(new_state)
+            return result
 
-    def _watcher(self):
+    def _record_has_expired(self, j:V1Job, status:str, now:float)->bool:
+        """
+        returns true if the given job finished so long ago that its record would have expired, so a notification has
+        already been sent for it
         """
-        internal method, forming the job watcher loop. Does not return.
+        if not self.finished_record_ttl or status not in self.TERMINAL_STATUSES:
+            return False
+        finished = self.get_job_finish_time(j.status)
+        return finished is not None and now - finished >= self.finished_record_ttl
+
+    def _on_state_confirmed(self, state:JobState, on_confirm):
+        self._status_cache.persist(state)
+        on_confirm()
+
+    def stop(self):
+        """
+        asks the watch loop to exit. No more events are processed after this, but it does not return until the
+        current watch request yields its next event or finishes
         :return:
         """
-        watcher = watch.Watch()
+        self._stop = True
 
+    def _resource_version_gap(self)->float:
+        """
+        how far the journal is behind the most recent event we have seen, for the resource version gap metric
+        """
+        latest = resource_version_number(self._latest_version)
+        journalled = resource_version_number(self._journal.last_written)
+        if latest is None or journalled is None:
+            return 0
+        return max(latest - journalled, 0)
+
+    def _selector_args(self)->dict:
+        return {"label_selector": self.label_selector} if self.label_selector else {}
+
+    def _initial_resource_version(self):
+        """
+        works out where to start watching from: the journalled resource version if there is one, or the current one
+        from the cluster if not
+        :return:
+        """
         resource_version = self._journal.get_most_recent_event()
         if resource_version is None:
             logger.info("Could not find a journalled resource version to start watch at, starting from most recent")
-            initial_status:V1JobList = self._batchv1.list_namespaced_job(self._namespace)
-            resource_version = initial_status.metadata.resource_version
+            # we only need the list's resource version, not its contents, so ask for as little as possible. this keeps
+            # startup time and memory flat no matter how many completed jobs are being kept in the namespace
+            _, resource_version, _ = self._list_jobs_page(limit=1)
+        return resource_version
 
-        logger.info("Initiating job watch at resource version {0}".format(resource_version))
+    def _list_jobs_page(self, continue_token:str=None, limit:int=None):
+        """
+        fetches one page of jobs from the cluster
+        :param continue_token: continue token from the previous page, or None for the first page
+        :param limit: maximum number of jobs to fetch, defaults to relist_page_size
+        :return: tuple of (list of job objects, list resource version, continue token for the next page or None)
+        """
+        args = self._selector_args()
+        args["limit"] = limit if limit is not None else self.relist_page_size
+        if continue_token is not None:
+            args["_continue"] = continue_token
+        if self.lean_watch:
+            resp = self._batchv1.list_namespaced_job(self._namespace, _preload_content=False, **args)
+            page = parse_job_list(resp.data)
+            return page.items, page.resource_version, page.continue_token
+        else:
+            page:V1JobList = self._batchv1.list_namespaced_job(self._namespace, **args)
+            return page.items, page.metadata.resource_version, page.metadata._continue
 
-        try:
-            for event in watcher.stream(self._batchv1.list_namespaced_job,
-                                        self._namespace,
-                                        resource_version=resource_version):
-                logger.debug("Received job event: {0}".format(event['type']))
-                if isinstance(event["object"], V1Job):
-                    if not event["object"].metadata.name.startswith("cds-"):
-                        logger.info("Job {0} is not a cds job, ignoring".format(event["object"].metadata.name))
-                        continue
-                    if event["type"]=="DELETED":
-                        # we are not interested in the job object being deleted,
-                        # it will have already been registered as succeeded/failed at this point.
-                        continue
-
-                    self.check_job(event["object"])
-                    self._journal.record_processed(event["object"].metadata.resource_version)
+    def _reconcile(self):
+        """
+        brings the status store up to date after we have lost track of events, e.g. from a 410 Gone.
+        every job in the namespace is listed, a page at a time, and check_job is called on each so that a notification
+        goes out for any whose status has changed since the last one we sent. jobs that we had a stored status for
+        but no longer exist are forgotten.
+        :return: the resource version of the list, from which the watch can be resumed
+        """
+        logger.info("Re-listing jobs in {0} to catch up on missed events".format(self._namespace))
+        RELISTS.labels(self._namespace).inc()
+        seen_uids = set()
+        list_version = None
+        continue_token = None
+        sent = 0
+        while True:
+            try:
+                items, page_version, continue_token = self._list_jobs_page(continue_token)
+            except kubernetes.client.exceptions.ApiException as err:
+                if err.status==410 and continue_token is not None:
+                    # the list snapshot expired before we got to the end. start again; jobs that we have already
+                    # notified won't be notified twice
+                    logger.warning("Job list expired before we finished paging through it, starting again")
+                    list_version = None
+                    continue_token = None
+                    continue
+                raise
+
+            if list_version is None:
+                list_version = page_version
+
+            if self._stop:
+                logger.info("Watcher for {0} was stopped during a re-list".format(self._namespace))
+                return list_version
+
+            for job in items:
+                if not self.label_selector and not job.metadata.name.startswith("cds-"):
+                    continue
+                seen_uids.add(job.metadata.uid)
+                if self._tracker is None:
+                    self.check_job(job)
                 else:
-                    logger.warning("received notification with unexpected type {0}".format(type(event["object"])))
-
-        except kubernetes.client.exceptions.ApiException as err:
-            logger.warning("Could not watch resource: cluster said {0}".format(str(err)))
-            if err.status==410:
-                logger.warning("Restarting from the most recent event")
-                self._journal.clear_journal()
-                return self._watcher()
+                    self._tracker.add(list_version)
+                    self.check_job(job, on_confirm=partial(self._tracker.confirm, list_version))
+                sent += 1
+
+            if not continue_token:
+                break
+
+        vanished = self._status_cache.known_uids() - seen_uids
+        for uid in vanished:
+            previous = self._status_cache.get(uid)
+            if previous is not None and previous.status not in self.TERMINAL_STATUSES:
+                logger.warning("Job {0} ({1}) was last seen in status {2} but no longer exists".format(previous.name, uid, previous.status))
+            self._status_cache.forget(uid)
+
+        logger.info("Re-list complete: checked {0} jobs, forgot {1} deleted ones, resuming from {2}".format(sent, len(vanished), list_version))
+        self._record_progress(list_version)
+        return list_version
+
+    def _record_progress(self, resource_version):
+        """
+        journals a resource version that needs no notification, e.g. from a bookmark. if messages are still waiting
+        for confirmation this goes through the tracker so that it is not journalled ahead of them
+        :param resource_version:
+        :return:
+        """
+        if self._tracker is None:
+            self._journal.record_processed(resource_version)
+        else:
+            self._tracker.add(resource_version, message_count=0)
+
+    def _process_event(self, event:dict):
+        """
+        handles a single event from the watch stream
+        :param event: event dictionary from the watch
+        :return:
+        """
+        logger.debug("Received job event: %s", event["type"])
+        received = time.monotonic()
+        WATCH_EVENTS.labels(self._namespace, event["type"]).inc()
+        watch_health.mark_active(self._namespace)
+        if event["type"]!="ERROR":
+            self._latest_version = event["object"].metadata.resource_version
+            latest_number = resource_version_number(self._latest_version)
+            if latest_number is not None:
+                LATEST_RESOURCE_VERSION.labels(self._namespace).set(latest_number)
+        if event["type"]=="BOOKMARK":
+            # a bookmark carries nothing but a resource version, telling us that we are up to date as far as that.
+            # journalling it means that we can resume from here even if none of our jobs have changed for a long time
+            self._record_progress(event["object"].metadata.resource_version)
+            return
+
+        if isinstance(event["object"], (V1Job, LeanJob)):
+            if not self.label_selector and not event["object"].metadata.name.startswith("cds-"):
+                logger.info("Job %s is not a cds job, ignoring", event["object"].metadata.name)
+                return
+            if event["type"]=="DELETED":
+                # we are not interested in the job object being deleted,
+                # it will have already been registered as succeeded/failed at this point.
+                if self._status_cache is not None:
+                    self._status_cache.forget(event["object"].metadata.uid)
+                self._record_progress(event["object"].metadata.resource_version)
+                return
+
+            event_version = event["object"].metadata.resource_version
+            if self._tracker is None:
+                self.check_job(event["object"])
+                EVENT_TO_PUBLISH_SECONDS.labels(self._namespace).observe(time.monotonic() - received)
+                self._journal.record_processed(event_version)
             else:
-                logger.error("Can't recover from {0} error".format(err.status))
-                raise
+                self._tracker.add(event_version)
+                self.check_job(event["object"], on_confirm=partial(self._tracker.confirm, event_version))
+                EVENT_TO_PUBLISH_SECONDS.labels(self._namespace).observe(time.monotonic() - received)
+        else:
+            logger.warning("received notification with unexpected type {0}".format(type(event["object"])))
+
+    def _watch_once(self, resource_version):
+        """
+        runs a single watch request from the given resource version, until the server ends it after
+        `watch_timeout` seconds.
+        :param resource_version: resource version to start from
+        :return: the most recent resource version seen, to resume from
+        """
+        self._resume_version = resource_version
+        watcher = LeanWatch() if self.lean_watch else StrictWatch()
+        watch_health.mark_active(self._namespace)
+        for event in watcher.stream(self._batchv1.list_namespaced_job,
+                                    self._namespace,
+                                    resource_version=resource_version,
+                                    allow_watch_bookmarks=True,
+                                    timeout_seconds=self.watch_timeout,
+                                    **self._selector_args()):
+            if self._stop:
+                # e.g. we have lost leadership, so another replica may already be handling these events
+                break
+            self._process_event(event)
+            if event["type"]!="ERROR":
+                # kept as we go rather than returned at the end, so that if the connection drops part way through we
+                # resume from here rather than handling the events since resource_version again
+                self._resume_version = event["object"].metadata.resource_version
+
+        return self._resume_version
+
+    def _watcher(self):
+        """
+        internal method, forming the job watcher loop. Each watch request is ended by the server after `watch_timeout`
+        seconds, at which point we carry on from the last resource version we saw. Does not return until stop() is called.
+        :return:
+        """
+        try:
+            self._watch_loop()
+        finally:
+            watch_health.mark_stopped(self._namespace)
+
+    def _watch_loop(self):
+        resource_version = None
+        while not self._stop:
+            if resource_version is None:
+                resource_version = self._initial_resource_version()
+            logger.info("Initiating job watch at resource version {0}".format(resource_version))
+
+            try:
+                resource_version = self._watch_once(resource_version)
+            except kubernetes.client.exceptions.ApiException as err:
+                logger.warning("Could not watch resource: cluster said {0}".format(str(err)))
+                if err.status==410:
+                    if self._status_cache is None:
+                        logger.warning("Restarting from the most recent event, any missed events will be lost")
+                        self._journal.clear_journal()
+                        resource_version = None
+                    else:
+                        resource_version = self._reconcile()
+                else:
+                    logger.error("Can't recover from {0} error".format(err.status))
+                    raise
+            except (urllib3.exceptions.ProtocolError, urllib3.exceptions.ReadTimeoutError) as err:
+                resource_version = self._resume_version
+                logger.warning("Watch connection was interrupted: {0}. Resuming from {1}".format(str(err), resource_version))
+                WATCH_RECONNECTS.labels(self._namespace).inc()
+
+    def run(self):
+        """
+        runs the job watcher until stop() is called. Any error that can't be recovered from is raised to the caller
+        :return:
+        """
+        self._watcher()
 
     def run_sync(self):
         """
@@ -162,7 +490,7 @@ class JobWatcher(object):
         :return:
         """
         try:
-            self._watcher()
+            self.run()
         except Exception as e:
             logger.exception("Could not run the watcher: {0}".format(e))
             sys.exit(2)
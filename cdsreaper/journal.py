@@ -1,6 +1,12 @@
 import redis
 import logging
 import time
+import threading
+import collections
+import os
+import redispool
+from metrics import JOURNAL_WRITE_SECONDS
+from models import JobState, LeaseLost
 logger = logging.getLogger(__name__)
 
 
@@ -11,15 +17,26 @@ class Journal(object):
     """
     EVENT_KEY = "cdsreaper:most-recent-event"
 
-    def __init__(self, redis_host:str, redis_port:int, redis_db:int, redis_pw:str, max_retries=10):
+    def __init__(self, redis_host:str, redis_port:int, redis_db:int, redis_pw:str, max_retries=10, event_key:str=None,
+                 client:redis.Redis=None):
+        """
+        :param event_key: redis key to journal under. Defaults to EVENT_KEY; give each namespace its own key when
+        watching more than one
+        :param client: an existing redis client to use, rather than getting one from the shared pool for redis_host
+        """
         self.redis_host = redis_host
         self.redis_port = redis_port
         self.redis_db = redis_db
         self.redis_pw = redis_pw
 
         self.max_retries = max_retries
+        self.event_key = event_key if event_key is not None else Journal.EVENT_KEY
+        self.last_written = None    # most recent id written by this process, for the resource version gap metric
 
-        self._establish_connection()
+        if client is not None:
+            self._conn = client
+        else:
+            self._establish_connection()
 
     def _establish_connection(self, attempt=1):
         """
@@ -31,7 +48,7 @@ class Journal(object):
         :return: nothing
         """
         try:
-            self._conn = redis.Redis(self.redis_host, self.redis_port, self.redis_db, password=self.redis_pw)
+            self._conn = redispool.get_client(self.redis_host, self.redis_port, self.redis_db, self.redis_pw)
             self._conn.ping()
         except (redis.RedisError, ConnectionError) as err:
             if attempt>=self.max_retries:
@@ -43,20 +60,27 @@ class Journal(object):
             time.sleep(retry_delay)
             return self._establish_connection(attempt+1)
 
+    @property
+    def client(self)->redis.Redis:
+        """
+        the redis client used by the journal, so that other components can share the connection
+        """
+        return self._conn
+
     def get_most_recent_event(self)->int:
         """
         gets the most recent journalled event id
         :return: the id, or None if nothing was set.
         """
-        maybe_value = self._conn.get(Journal.EVENT_KEY)
+        maybe_value = self._conn.get(self.event_key)
         if maybe_value is None:
             return None
         else:
             try:
                 return int(maybe_value)
             except (TypeError, ValueError) as e:
-                logger.error("Invalid value {0} at cdsreaper:most-recent-event could not be converted to int. Processing will start from latest event.".format(maybe_value))
-                self._conn.delete(Journal.EVENT_KEY)
+                logger.error("Invalid value {0} at {1} could not be converted to int. Processing will start from latest event.".format(maybe_value, self.event_key))
+                self._conn.delete(self.event_key)
                 return None
 
     def record_processed(self, id:int):
@@ -65,7 +89,9 @@ class Journal(object):
         :param id:
         :return:
         """
-        self._conn.set(Journal.EVENT_KEY, id)
+        with JOURNAL_WRITE_SECONDS.time():
+            self._conn.set(self.event_key, id)
+        self.last_written = id
 
     def clear_journal(self):
         """
@@ -73,4 +99,280 @@ class Journal(object):
         this can be used if we have gone over the event horizon of the cluster and must start listing afresh
         :return:
         """
-        self._conn.delete(Journal.EVENT_KEY)
\ No newline at end of file
+        self._conn.delete(self.event_key)
+        self.last_written = None
+
+
+class CheckpointingJournal(Journal):
+    """
+    a Journal that keeps the most recent processed event in memory and only writes it to redis every
+    `checkpoint_events` events or every `checkpoint_interval_ms` milliseconds, whichever comes first.
+    writes happen on a background thread, so record_processed never waits for redis.
+    if redis can't be reached, the checkpoint is written to `fallback_path` instead (if set) and picked up again
+    by get_most_recent_event.
+    if a batched StatusCache is attached, its changes are written in the same round trip as each checkpoint.
+    if the journal is fenced with a LeaderLease, nothing is written unless the lease is still ours when the write
+    happens, and anything held when it is lost is thrown away, so that a replica that has stopped being leader can't
+    overwrite what the new leader has written since.
+    call flush() before exiting to make sure that the last processed event is written.
+    """
+    def __init__(self, redis_host:str, redis_port:int, redis_db:int, redis_pw:str, max_retries=10,
+                 checkpoint_events=100, checkpoint_interval_ms=2000, fallback_path:str=None, event_key:str=None,
+                 client:redis.Redis=None):
+        self.checkpoint_events = checkpoint_events
+        self.checkpoint_interval_ms = checkpoint_interval_ms
+        self.fallback_path = fallback_path
+
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._due = threading.Event()
+        self._unwritten = None
+        self._events_since_write = 0
+        self._status_cache = None
+        self._lease = None
+        super(CheckpointingJournal, self).__init__(redis_host, redis_port, redis_db, redis_pw, max_retries, event_key, client)
+
+        self._writer = threading.Thread(target=self._write_loop, name="CheckpointingJournal", daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        """
+        body of the background writer thread. waits until a checkpoint is due, or the interval expires, then writes
+        :return:
+        """
+        while True:
+            self._due.wait(self.checkpoint_interval_ms/1000.0)
+            self._due.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Could not write journal checkpoint: {0}".format(str(e)))
+
+    def fence_with(self, lease):
+        """
+        only write while we hold the given lease, see the class description
+        :param lease: LeaderLease
+        :return:
+        """
+        with self._write_lock:
+            self._lease = lease
+
+    def attach_status_cache(self, status_cache):
+        """
+        writes out the changes held by the given batched StatusCache along with each checkpoint, replacing any that
+        was attached before
+        :param status_cache: StatusCache, or None to detach
+        :return:
+        """
+        if self._lease is not None:
+            # a new term of leadership. anything still held from an earlier one is out of date
+            self.discard()
+        else:
+            # anything still held by the cache being replaced goes out first
+            self.flush()
+        with self._write_lock:
+            self._status_cache = status_cache
+
+    def discard(self):
+        """
+        throws away the unwritten checkpoint and the attached status cache's unwritten changes, and detaches the
+        cache. call this when the lease is lost
+        :return:
+        """
+        with self._write_lock:
+            self._discard_unwritten()
+
+    def _discard_unwritten(self):
+        """
+        must be called with the write lock held
+        """
+        with self._lock:
+            dropped = self._unwritten
+            self._unwritten = None
+            self._events_since_write = 0
+        dropped_states = self._status_cache.discard() if self._status_cache is not None else 0
+        self._status_cache = None
+        if dropped is not None or dropped_states > 0:
+            logger.warning("No longer leader, discarded journal checkpoint {0} and {1} job states".format(dropped, dropped_states))
+
+    def record_processed(self, id:int):
+        """
+        record that the given event has been processed. this only updates the in-memory checkpoint, it is written out
+        by the background thread
+        :param id:
+        :return:
+        """
+        id = int(id)
+        with self._lock:
+            if self._unwritten is None or id > self._unwritten:
+                self._unwritten = id
+            self._events_since_write += 1
+            if self._events_since_write >= self.checkpoint_events:
+                self._due.set()
+
+    def flush(self):
+        """
+        writes the current checkpoint, and any job states held by the attached status cache, out now if there is
+        anything new to write
+        :return:
+        """
+        with self._write_lock:
+            if self._lease is not None and not self._lease.is_held:
+                self._discard_unwritten()
+                return
+            fence = (self._lease.key, self._lease.identity) if self._lease is not None else None
+            with self._lock:
+                to_write = self._unwritten
+                self._unwritten = None
+                self._events_since_write = 0
+            status_cache = self._status_cache
+            if to_write is None and (status_cache is None or not status_cache.has_unwritten()):
+                return
+
+            try:
+                with JOURNAL_WRITE_SECONDS.time():
+                    if status_cache is not None:
+                        status_cache.flush(checkpoint=(self.event_key, to_write) if to_write is not None else None,
+                                           fence=fence)
+                    elif fence is not None:
+                        JobState.write_many(self._conn, [], checkpoint=(self.event_key, to_write), fence=fence)
+                    else:
+                        self._conn.set(self.event_key, to_write)
+                if to_write is not None:
+                    self.last_written = to_write
+                    self._remove_fallback()
+            except LeaseLost as err:
+                logger.warning("Not writing journal checkpoint {0}: {1}".format(to_write, str(err)))
+                self._discard_unwritten()
+            except (redis.RedisError, ConnectionError) as err:
+                # the status cache keeps hold of its changes if they could not be written, so only the checkpoint
+                # needs looking after here
+                if to_write is None:
+                    logger.error("Could not write job states to redis: {0}. Will try again.".format(str(err)))
+                elif self.fallback_path is None:
+                    logger.error("Could not write journal checkpoint {0} to redis: {1}. Will try again.".format(to_write, str(err)))
+                    self._requeue(to_write)
+                else:
+                    logger.warning("Could not write journal checkpoint {0} to redis: {1}. Writing to {2} instead".format(to_write, str(err), self.fallback_path))
+                    try:
+                        self._write_fallback(to_write)
+                    except IOError as e:
+                        logger.error("Could not write journal checkpoint to {0}: {1}".format(self.fallback_path, str(e)))
+                        self._requeue(to_write)
+
+    def _requeue(self, id:int):
+        """
+        puts an unwritten checkpoint back, unless a later one has been recorded since
+        """
+        with self._lock:
+            if self._unwritten is None or id > self._unwritten:
+                self._unwritten = id
+
+    def _write_fallback(self, id:int):
+        temp_path = self.fallback_path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(str(id))
+        os.replace(temp_path, self.fallback_path)
+
+    def _read_fallback(self):
+        if self.fallback_path is None:
+            return None
+        try:
+            with open(self.fallback_path, "r") as f:
+                return int(f.read().strip())
+        except FileNotFoundError:
+            return None
+        except (IOError, ValueError) as e:
+            logger.error("Journal fallback file {0} is not readable: {1}".format(self.fallback_path, str(e)))
+            return None
+
+    def _remove_fallback(self):
+        if self.fallback_path is not None and os.path.exists(self.fallback_path):
+            os.remove(self.fallback_path)
+
+    def get_most_recent_event(self)->int:
+        """
+        gets the most recent journalled event id, from redis or from the fallback file if that is more recent
+        :return: the id, or None if nothing was set.
+        """
+        try:
+            from_redis = super(CheckpointingJournal, self).get_most_recent_event()
+        except (redis.RedisError, ConnectionError) as err:
+            logger.warning("Could not read journal from redis: {0}".format(str(err)))
+            from_redis = None
+
+        from_file = self._read_fallback()
+        if from_file is not None and (from_redis is None or from_file > from_redis):
+            logger.info("Using journal checkpoint {0} from fallback file {1}".format(from_file, self.fallback_path))
+            return from_file
+        return from_redis
+
+    def clear_journal(self):
+        """
+        clears both the in-memory and the stored checkpoint
+        :return:
+        """
+        with self._write_lock:
+            with self._lock:
+                self._unwritten = None
+                self._events_since_write = 0
+            if self._lease is not None and not self._lease.is_held:
+                return
+            self._remove_fallback()
+            super(CheckpointingJournal, self).clear_journal()
+
+
+class ConfirmedEventTracker(object):
+    """
+    keeps track of watch events whose notifications are still waiting for a broker confirmation, and only moves the
+    journal forward once every event up to a given resource version has been confirmed.
+    this means that a crash can never leave the journal pointing past an event whose message was lost.
+    """
+    def __init__(self, journal:Journal):
+        self._journal = journal
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()   # resource version -> number of unconfirmed messages, in watch order
+
+    def add(self, resource_version:int, message_count=1):
+        """
+        register a watch event that will be confirmed by `message_count` calls to confirm()
+        :param resource_version: resource version of the event
+        :param message_count: number of messages sent for the event. If zero, the event counts as confirmed immediately
+        :return:
+        """
+        with self._lock:
+            self._pending[resource_version] = self._pending.get(resource_version, 0) + message_count
+        if message_count==0:
+            self._advance()
+
+    def confirm(self, resource_version:int):
+        """
+        record that one of the messages for the given event has been confirmed, and advance the journal if possible
+        :param resource_version: resource version of the event
+        :return:
+        """
+        with self._lock:
+            if resource_version in self._pending:
+                self._pending[resource_version] -= 1
+        self._advance()
+
+    def pending_count(self)->int:
+        with self._lock:
+            return len(self._pending)
+
+    def _advance(self):
+        """
+        pops every fully-confirmed event off the front of the queue and journals the last one of them
+        :return:
+        """
+        with self._lock:
+            most_recent = None
+            while len(self._pending)>0:
+                resource_version, remaining = next(iter(self._pending.items()))
+                if remaining>0:
+                    break
+                self._pending.popitem(last=False)
+                most_recent = resource_version
+
+            if most_recent is not None:
+                self._journal.record_processed(most_recent)
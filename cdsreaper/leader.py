@@ -0,0 +1,210 @@
+import redis
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLease(object):
+    """
+    a lease on a redis key, used so that only one cdsreaper replica at a time watches a given namespace.
+    the key holds the identity of the current leader and expires after `ttl_ms` milliseconds unless it is renewed, so
+    if the leader dies a standby can take over within roughly `ttl_ms`.
+    the leader renews the lease on a background thread every `renew_interval_ms` (a third of the ttl by default). if a
+    renewal finds that the lease has gone to someone else, or redis can't be reached until the lease would have expired
+    anyway, the `on_lost` callback is called and the lease is no longer held.
+    """
+    # only touch the key if we still own it, so that a leader which has been paused past its expiry can't extend or
+    # delete a lease that another replica now holds
+    RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+else
+    return 0
+end
+"""
+    RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+else
+    return 0
+end
+"""
+
+    def __init__(self, client:redis.Redis, key:str, identity:str, ttl_ms:int=10000, renew_interval_ms:int=None):
+        """
+        :param client: redis client to hold the lease with, e.g. Journal.client
+        :param key: redis key for the lease
+        :param identity: unique name for this replica
+        :param ttl_ms: how long the lease lasts without being renewed
+        :param renew_interval_ms: how often to renew the lease, and how often a standby tries to take it
+        """
+        self._client = client
+        self.key = key
+        self.identity = identity
+        self.ttl_ms = ttl_ms
+        self.renew_interval_ms = renew_interval_ms if renew_interval_ms is not None else max(ttl_ms//3, 1)
+        self._renew = client.register_script(LeaderLease.RENEW_SCRIPT)
+        self._release = client.register_script(LeaderLease.RELEASE_SCRIPT)
+
+        self._held = False
+        self._expires_at = 0        # time.monotonic() by which the lease has certainly expired, if it was not renewed
+        self._stop_renewing = threading.Event()
+        self._renewer = None
+
+    @property
+    def is_held(self)->bool:
+        return self._held
+
+    def try_acquire(self)->bool:
+        """
+        makes one attempt to take the lease
+        :return: True if we now hold it
+        """
+        started = time.monotonic()
+        try:
+            acquired = self._client.set(self.key, self.identity, nx=True, px=self.ttl_ms)
+        except (redis.RedisError, ConnectionError) as err:
+            logger.warning("Could not try for lease {0}: {1}".format(self.key, str(err)))
+            return False
+
+        if acquired:
+            self._held = True
+            self._expires_at = started + self.ttl_ms/1000.0
+        return bool(acquired)
+
+    def renew(self)->bool:
+        """
+        extends the lease, if we still hold it
+        :return: True if we still hold the lease
+        """
+        started = time.monotonic()
+        try:
+            renewed = self._renew(keys=[self.key], args=[self.identity, self.ttl_ms])
+        except (redis.RedisError, ConnectionError) as err:
+            # nobody else can take the lease until it expires, so we can carry on until then
+            still_held = started < self._expires_at
+            logger.warning("Could not renew lease {0}: {1}. {2}".format(self.key, str(err),
+                           "Will try again" if still_held else "The lease has expired"))
+            return still_held
+
+        if renewed:
+            self._expires_at = started + self.ttl_ms/1000.0
+        return bool(renewed)
+
+    def start_renewing(self, on_lost):
+        """
+        starts the background thread that keeps the lease alive
+        :param on_lost: called with no arguments, from the renewal thread, if the lease is lost
+        :return:
+        """
+        self._stop_renewing.clear()
+        self._renewer = threading.Thread(target=self._renew_loop, args=(on_lost,), name="LeaderLease", daemon=True)
+        self._renewer.start()
+
+    def _renew_loop(self, on_lost):
+        while not self._stop_renewing.wait(self.renew_interval_ms/1000.0):
+            if not self.renew():
+                logger.warning("{0} has lost lease {1}".format(self.identity, self.key))
+                self._held = False
+                on_lost()
+                return
+
+    def release(self):
+        """
+        stops renewing the lease and gives it up, so that a standby can take over straight away
+        :return:
+        """
+        self._stop_renewing.set()
+        if self._renewer is not None and self._renewer is not threading.current_thread():
+            self._renewer.join()
+        self._renewer = None
+        if not self._held:
+            return
+        self._held = False
+        try:
+            self._release(keys=[self.key], args=[self.identity])
+            logger.info("{0} released lease {1}".format(self.identity, self.key))
+        except (redis.RedisError, ConnectionError) as err:
+            logger.warning("Could not release lease {0}, it will expire in {1}ms: {2}".format(self.key, self.ttl_ms, str(err)))
+
+
+class LeaderElectedRunner(object):
+    """
+    runs a job watcher only while holding a LeaderLease. a fresh watcher is made, by calling `make_watcher`, each time
+    the lease is acquired so that nothing is carried over from an earlier term. if the lease is lost the watcher is
+    stopped, `on_lost` is called, and we go back to waiting for the lease.
+    """
+    def __init__(self, lease:LeaderLease, make_watcher, slots:threading.Semaphore=None, on_lost=None):
+        """
+        :param lease: LeaderLease to hold
+        :param make_watcher: callable that returns a new JobWatcher
+        :param slots: if given, a slot is held from this semaphore while we are leader. Share one between the
+        runners of a process to limit how many namespaces a single replica leads at once.
+        :param on_lost: called with no arguments, from the lease's renewal thread, once the watcher has been asked to
+        stop after losing the lease. Use it to throw away anything not yet written, e.g. CheckpointingJournal.discard
+        """
+        self.lease = lease
+        self._make_watcher = make_watcher
+        self._slots = slots
+        self._on_lost = on_lost
+        self._current = None
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+        current = self._current
+        if current is not None:
+            current.stop()
+
+    def _lost(self):
+        current = self._current
+        if current is not None:
+            current.stop()
+        if self._on_lost is not None:
+            self._on_lost()
+
+    def _wait_for_lease(self)->bool:
+        """
+        tries for the lease every `renew_interval_ms` until we get it. if we are limited by `slots`, we only try while
+        a slot is free and give the slot straight back if the attempt fails
+        :return: True once the lease is held, False if we were stopped first
+        """
+        interval = self.lease.renew_interval_ms/1000.0
+        while not self._stop:
+            if self._slots is not None and not self._slots.acquire(timeout=interval):
+                continue
+            if self.lease.try_acquire():
+                logger.info("{0} now holds lease {1}".format(self.lease.identity, self.lease.key))
+                return True
+            if self._slots is not None:
+                self._slots.release()
+            time.sleep(interval)
+        return False
+
+    def run_once(self):
+        """
+        waits for the lease, then runs a watcher until the lease is lost
+        :return: False if we were stopped before getting the lease
+        """
+        if not self._wait_for_lease():
+            return False
+        try:
+            self._current = self._make_watcher()
+            self.lease.start_renewing(on_lost=self._lost)
+            self._current.run()
+        finally:
+            self._current = None
+            self.lease.release()
+            if self._slots is not None:
+                self._slots.release()
+        return True
+
+    def run(self):
+        """
+        runs terms of leadership until stop() is called. exceptions from the watcher are raised to the caller
+        :return:
+        """
+        while not self._stop:
+            self.run_once()
@@ -0,0 +1,176 @@
+import logging
+import kubernetes.client.exceptions
+from kubernetes import watch
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
+logger = logging.getLogger(__name__)
+
+### The kubernetes client turns every watch event into a full V1Job object graph, including the whole pod template.
+### We only ever look at a handful of fields, so these slotted classes hold just those and are built straight from the
+### raw json of the watch stream. They have the same attribute names as the kubernetes models, so they can be passed to
+### JobWatcher.get_job_status_string and friends in place of V1Job.
+### Note that timestamps are left as the ISO-8601 strings that the server sends, rather than parsed into datetimes.
+### StrictWatch is used instead of LeanWatch when the full V1Job objects are wanted, and raises ERROR events in the same way.
+
+
+class LeanJobCondition(object):
+    __slots__ = ("type", "status", "reason", "message", "last_probe_time", "last_transition_time")
+
+    def __init__(self, source:dict):
+        self.type = source.get("type")
+        self.status = source.get("status")
+        self.reason = source.get("reason")
+        self.message = source.get("message")
+        self.last_probe_time = source.get("lastProbeTime")
+        self.last_transition_time = source.get("lastTransitionTime")
+
+
+class LeanJobStatus(object):
+    __slots__ = ("active", "failed", "succeeded", "start_time", "completion_time", "conditions")
+
+    def __init__(self, source:dict):
+        self.active = source.get("active")
+        self.failed = source.get("failed")
+        self.succeeded = source.get("succeeded")
+        self.start_time = source.get("startTime")
+        self.completion_time = source.get("completionTime")
+        conditions = source.get("conditions")
+        self.conditions = [LeanJobCondition(c) for c in conditions] if conditions is not None else None
+
+    def __repr__(self):
+        return "LeanJobStatus(active={0}, failed={1}, succeeded={2}, start_time={3}, completion_time={4})".format(
+            self.active, self.failed, self.succeeded, self.start_time, self.completion_time)
+
+
+class LeanObjectMeta(object):
+    __slots__ = ("name", "uid", "namespace", "resource_version", "labels", "annotations", "creation_timestamp")
+
+    def __init__(self, source:dict):
+        self.name = source.get("name")
+        self.uid = source.get("uid")
+        self.namespace = source.get("namespace")
+        self.resource_version = source.get("resourceVersion")
+        self.labels = source.get("labels")
+        self.annotations = source.get("annotations")
+        self.creation_timestamp = source.get("creationTimestamp")
+
+
+class LeanJob(object):
+    __slots__ = ("metadata", "status")
+
+    def __init__(self, source:dict):
+        self.metadata = LeanObjectMeta(source.get("metadata") or {})
+        self.status = LeanJobStatus(source.get("status") or {})
+
+
+class LeanJobList(object):
+    """
+    a page of jobs from a list call, along with the list metadata needed for paging and for starting a watch
+    """
+    __slots__ = ("items", "resource_version", "continue_token")
+
+    def __init__(self, source:dict):
+        metadata = source.get("metadata") or {}
+        self.resource_version = metadata.get("resourceVersion")
+        self.continue_token = metadata.get("continue")
+        self.items = [LeanJob(item) for item in (source.get("items") or [])]
+
+
+def parse_job_list(data:bytes)->LeanJobList:
+    """
+    parses the raw json body of a list_namespaced_job call made with _preload_content=False
+    :param data: raw response body
+    :return: LeanJobList
+    """
+    return LeanJobList(_loads(data))
+
+
+def iter_resp_lines(resp):
+    """
+    splits the chunked body of an unpreloaded watch response into lines, without decoding them
+    :param resp: urllib3 response from a call with _preload_content=False
+    :return: generator of bytes
+    """
+    remainder = b""
+    for chunk in resp.read_chunked(decode_content=False):
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if remainder:
+        yield remainder
+
+
+def parse_event(line:bytes)->dict:
+    """
+    parses a single line of a job watch stream.
+    :param line: raw json line
+    :return: a dict with `type` and `object` keys, like the ones from kubernetes.watch.Watch. `object` is a LeanJob,
+    or the raw dict for an ERROR event.
+    """
+    event = _loads(line)
+    if event["type"] != "ERROR":
+        event["object"] = LeanJob(event["object"])
+    return event
+
+
+class LeanWatch(object):
+    """
+    a cut-down replacement for kubernetes.watch.Watch that reads the raw watch stream and yields LeanJob objects.
+    like Watch, if the server closes the stream it is re-opened from the last resource version seen, unless
+    `timeout_seconds` was given. an ERROR event from the server is raised as an ApiException.
+    """
+    def __init__(self):
+        self.resource_version = None
+
+    def stream(self, func, *args, **kwargs):
+        """
+        calls the given list function in watch mode and yields its events
+        :param func: a list_namespaced_job style api function
+        :return: generator of event dicts, see parse_event
+        """
+        kwargs["watch"] = True
+        kwargs["_preload_content"] = False
+        if "resource_version" in kwargs:
+            self.resource_version = kwargs["resource_version"]
+
+        while True:
+            resp = func(*args, **kwargs)
+            try:
+                for line in iter_resp_lines(resp):
+                    event = parse_event(line)
+                    if event["type"] == "ERROR":
+                        obj = event["object"]
+                        raise kubernetes.client.exceptions.ApiException(status=obj.get("code"),
+                                                                        reason="{0}: {1}".format(obj.get("reason"), obj.get("message")))
+                    self.resource_version = event["object"].metadata.resource_version
+                    yield event
+            finally:
+                resp.close()
+                resp.release_conn()
+
+            if "timeout_seconds" in kwargs or self.resource_version is None:
+                break
+            kwargs["resource_version"] = self.resource_version
+
+
+class StrictWatch(watch.Watch):
+    """
+    kubernetes.watch.Watch, for when the full V1Job objects are wanted, except that an ERROR event from the server is
+    always raised as an ApiException, as LeanWatch does.  Watch itself ends the stream quietly on a 410 Gone when
+    `timeout_seconds` is given, which we couldn't tell apart from the server ending the request
+    """
+    def unmarshal_event(self, data, return_type):
+        event = super().unmarshal_event(data, return_type)
+        if event["type"] == "ERROR":
+            obj = event["raw_object"]
+            raise kubernetes.client.exceptions.ApiException(status=obj.get("code"),
+                                                            reason="{0}: {1}".format(obj.get("reason"), obj.get("message")))
+        return event
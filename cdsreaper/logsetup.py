@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+import threading
+
+### Logging setup shared by cdsreaper and cdsresponder. The two are built as separate images, so this file is kept
+### identical in both directories; change them together.
+###
+### Configuration comes from the environment:
+###   LOG_LEVEL         - root log level, default INFO
+###   LOG_FORMAT        - "text" (default) for the traditional single-line format, or "json" for one json object per line
+###   LOG_SAMPLE_RATES  - comma-separated logger=rate pairs, e.g. "jobwatcher=0.01,pika=0.1". Only that fraction of the
+###                       DEBUG messages from each named logger (and its children) are output; other levels always are.
+###   LOG_QUIET         - comma-separated loggers that are only allowed to log warnings and above, default "pika,kubernetes"
+###
+### In hot paths, pass arguments to the logger rather than formatting the message yourself, so that nothing is built
+### unless the message is actually going to be output:
+###     logger.debug("Job %s is in status %s", name, status)
+### anything given as `extra` is output as fields of its own in json format, e.g.
+###     logger.info("Job %s is in status %s", name, status, extra={"job_uid": uid, "status": status})
+
+TEXT_FORMAT = "{asctime} {name}|{funcName} [{levelname}] {message}"
+
+# attributes that every LogRecord has, so anything else on a record came from `extra`
+_STANDARD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__.keys()) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    formats each record as a single json object, including any `extra` fields
+    """
+    def format(self, record:logging.LogRecord)->str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "func": record.funcName,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DebugSampler(logging.Filter):
+    """
+    lets through only one in every `1/rate` DEBUG records from a given logger and its children. other levels are
+    always let through. sampling is by count rather than at random, so that it is cheap and predictable
+    """
+    def __init__(self, name:str, rate:float):
+        super(DebugSampler, self).__init__(name)
+        self.every = max(int(round(1.0/rate)), 1) if rate > 0 else 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record:logging.LogRecord)->bool:
+        if record.levelno != logging.DEBUG or not super(DebugSampler, self).filter(record):
+            return True
+        if self.every==0:
+            return False
+        with self._lock:
+            let_through = self._count==0
+            self._count = (self._count + 1) % self.every
+            return let_through
+
+
+def parse_sample_rates(spec:str)->dict:
+    """
+    parses a LOG_SAMPLE_RATES value
+    :param spec: string like "jobwatcher=0.01,pika=0.1"
+    :return: dict of logger name -> rate
+    """
+    rates = {}
+    if not spec:
+        return rates
+    for part in spec.split(","):
+        if part.strip()=="":
+            continue
+        name, _, rate = part.partition("=")
+        try:
+            rates[name.strip()] = float(rate)
+        except ValueError:
+            raise ValueError("Invalid LOG_SAMPLE_RATES entry '{0}', expected logger=rate".format(part))
+    return rates
+
+
+def configure_logging(environ=None)->logging.Handler:
+    """
+    sets up the root logger from the environment, as described at the top of this file.
+    call this once at startup, before anything is logged
+    :param environ: mapping to read configuration from, defaults to os.environ
+    :return: the handler that was installed
+    """
+    if environ is None:
+        environ = os.environ
+
+    handler = logging.StreamHandler()
+    if environ.get("LOG_FORMAT", "text").lower()=="json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT, style='{'))
+
+    for name, rate in parse_sample_rates(environ.get("LOG_SAMPLE_RATES", "")).items():
+        handler.addFilter(DebugSampler(name, rate))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(environ.get("LOG_LEVEL", "INFO").upper())
+
+    for name in environ.get("LOG_QUIET", "pika,kubernetes").split(","):
+        if name.strip()!="":
+            logging.getLogger(name.strip()).setLevel(logging.WARN)
+    return handler
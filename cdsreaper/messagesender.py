@@ -1,18 +1,25 @@
 import pika
 import pika.exceptions
+import pika.spec
 import logging
 import json
 import time
+import threading
+import collections
+from metrics import BROKER_CONFIRM_SECONDS, BROKER_RECONNECTS, BROKER_RETURNS
 
 logger = logging.getLogger(__name__)
 
 ### NOTE: It may be more appropriate to use an async delivery mechanism, in order to prevent rabbitmq issues from
 ### making us miss k8s notifications.  But, if we have rmq issues, would we just miss those messages _anyway_? Would it
 ### do any good to hold them in memory? Should we buffer them to redis or something? What if something happens to that?
-### Therefore this is currently a simple, blocking implementation that won't return until a delivery confirmation has been
+### Therefore MessageSender is a simple, blocking implementation that won't return until a delivery confirmation has been
 ### received from the broker.
 ### We now use a journal to pick up from the last _processed_ k8s notification on startup as opposed to the most recent
-### so this implementation is probably enough
+### so this implementation is probably enough for quiet clusters.
+### When many jobs change state at once the round-trip per message becomes the bottleneck, so PipelinedMessageSender
+### keeps a bounded window of unconfirmed messages in flight instead, and tells the caller when each one is confirmed
+### so that the journal only moves forward past notifications that the broker has actually accepted.
 
 
 class MessageSender(object):
@@ -61,9 +68,11 @@ class MessageSender(object):
         """
         error_exit = False
         try:
-            logger.debug("Sending {0} via {1} to {2}".format(msg_content, routing_key, self.exchange))
+            logger.debug("Sending %s via %s to %s", msg_content, routing_key, self.exchange)
             string_content = json.dumps(msg_content)
-            self._channel.basic_publish(self.exchange, routing_key, string_content.encode(encoding="UTF-8"))
+            # the channel is in confirm mode, so this does not return until the broker has confirmed the message
+            with BROKER_CONFIRM_SECONDS.time():
+                self._channel.basic_publish(self.exchange, routing_key, string_content.encode(encoding="UTF-8"))
             return True
         except pika.exceptions.BodyTooLongError as e:
             logger.error("Could not send message {0} as the body is too long for the server".format(msg_content))
@@ -78,14 +87,278 @@ class MessageSender(object):
                 logger.error("Could not send message on attempt {0}: {1}. Retrying in {2} seconds".format(attempt, str(e), retry_delay))
                 time.sleep(retry_delay)
                 return self.notify(routing_key, msg_content, attempt+1)
-        except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPHeartbeatTimeout) as e:
+        except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPHeartbeatTimeout,
+                pika.exceptions.ConnectionWrongStateError, pika.exceptions.ChannelWrongStateError,
+                pika.exceptions.ChannelClosed) as e:
+            # the wrong-state errors mean that an earlier attempt to re-open the connection failed, e.g. when a caller
+            # carries on after a RuntimeError from us
             if attempt >= self.max_retry_attempts:
                 logger.error("Could not deliver message after {0} attempts: {1}, exiting".format(attempt, str(e)))
                 error_exit = True
             else:
                 logger.error("Connection error: {0}. Attempting to re-open....".format(str(e)))
+                BROKER_RECONNECTS.inc()
                 self._setup_channel()
                 return self.notify(routing_key, msg_content, attempt+1)
 
         if error_exit:  #avoid ugly "exception handling this exception" messages
-            raise RuntimeError("Could not deliver message after {0} retries".format(self.max_retry_attempts))
\ No newline at end of file
+            raise RuntimeError("Could not deliver message after {0} retries".format(self.max_retry_attempts))
+
+class PendingMessage(object):
+    """
+    a message that has been handed to PipelinedMessageSender but not yet confirmed by the broker
+    """
+    __slots__ = ("message_id", "routing_key", "body", "on_confirm", "attempt", "published_at")
+
+    def __init__(self, message_id:str, routing_key:str, body:bytes, on_confirm=None):
+        self.message_id = message_id
+        self.routing_key = routing_key
+        self.body = body
+        self.on_confirm = on_confirm
+        self.attempt = 1
+        self.published_at = None
+
+
+class PipelinedMessageSender(object):
+    """
+    Object that maintains a rabbitmq connection on a background ioloop thread and sends messages to a given exchange
+    without waiting for each delivery confirmation in turn.
+    Up to `max_outstanding` messages can be waiting for confirmation at once; notify() blocks when the window is full.
+    Messages that are nacked by the broker are re-published, up to `max_retry_attempts` times.  Messages are published
+    without the mandatory flag, as MessageSender does, so one that no queue is bound for is dropped by the broker.
+    Delivery confirmations are reported through the `on_confirm` callback given to notify(), which is called on the
+    ioloop thread.
+    """
+    DELAY_SECONDS_PER_RETRY = 5
+
+    def __init__(self, params: pika.connection.ConnectionParameters, exchange_name:str, max_retry_attempts=10, max_outstanding=100):
+        self._params = params
+        self.max_retry_attempts = max_retry_attempts
+        self.max_outstanding = max_outstanding
+        self.exchange = exchange_name
+
+        self._lock = threading.Condition()
+        self._backlog = collections.deque()     # PendingMessage objects waiting to be (re-)published
+        self._outstanding = collections.OrderedDict()   # delivery tag -> PendingMessage awaiting confirmation
+        self._next_delivery_tag = 1
+        self._next_message_id = 1
+        self._conn = None
+        self._channel = None
+        self._stopping = False
+        self._failure = None
+        self._thread = None
+        self._start_ioloop()
+
+    def _start_ioloop(self):
+        """
+        starts the background thread that owns the rabbitmq connection.
+        this is called at construction so you shouldn't need to call it manually
+        :return:
+        """
+        self._thread = threading.Thread(target=self._run, name="PipelinedMessageSender", daemon=True)
+        self._thread.start()
+
+    def _run(self, attempt=1):
+        """
+        body of the background thread. (re-)connects to the broker and runs the ioloop until we are closed, or until we
+        have failed to connect `max_retry_attempts` times in a row.
+        :return:
+        """
+        while not self._stopping:
+            self._conn = pika.SelectConnection(self._params,
+                                               on_open_callback=self._on_connection_open,
+                                               on_open_error_callback=self._on_connection_closed,
+                                               on_close_callback=self._on_connection_closed)
+            self._conn.ioloop.start()
+            if self._stopping:
+                break
+            if self._channel is None:
+                # the ioloop stopped before we got a usable channel
+                if attempt >= self.max_retry_attempts:
+                    logger.error("Could not establish rabbitmq connection after {0} attempts, giving up".format(attempt))
+                    self._fail(RuntimeError("Could not deliver message after {0} retries".format(self.max_retry_attempts)))
+                    return
+                retry_delay = 2*attempt
+                logger.error("Could not establish rabbitmq connection on attempt {0}. Retrying in {1}s".format(attempt, retry_delay))
+                time.sleep(retry_delay)
+                attempt += 1
+            else:
+                attempt = 1
+                self._channel = None
+                BROKER_RECONNECTS.inc()
+
+    def _fail(self, err:Exception):
+        with self._lock:
+            self._failure = err
+            self._lock.notify_all()
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_closed(self, connection, error=None):
+        if not self._stopping:
+            logger.error("RabbitMQ connection closed: {0}".format(str(error)))
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.add_on_return_callback(self._on_message_returned)
+        channel.exchange_declare(self.exchange,
+                                 exchange_type="topic",
+                                 durable=True,
+                                 auto_delete=False,
+                                 callback=lambda frame: channel.confirm_delivery(self._on_delivery_confirmation,
+                                                                                 callback=lambda f: self._on_channel_ready(channel)))
+
+    def _on_channel_closed(self, channel, error=None):
+        if not self._stopping:
+            logger.error("RabbitMQ channel closed: {0}".format(str(error)))
+        if self._conn is not None and self._conn.is_open:
+            self._conn.close()
+
+    def _on_channel_ready(self, channel):
+        """
+        called once the exchange is declared and the channel is in confirm mode.
+        delivery tags restart at 1 on a new channel, so anything that was unconfirmed on the previous channel is put
+        back at the front of the backlog and sent again
+        :param channel:
+        :return:
+        """
+        with self._lock:
+            unconfirmed = list(self._outstanding.values())
+            self._outstanding.clear()
+            self._backlog.extendleft(reversed(unconfirmed))
+            self._next_delivery_tag = 1
+            self._channel = channel
+        if len(unconfirmed)>0:
+            logger.warning("Re-sending {0} unconfirmed messages on new channel".format(len(unconfirmed)))
+        self._publish_backlog()
+
+    def _publish_backlog(self):
+        """
+        publishes everything waiting in the backlog. must be called on the ioloop thread.
+        :return:
+        """
+        with self._lock:
+            if self._channel is None or not self._channel.is_open:
+                return
+            while len(self._backlog)>0:
+                msg = self._backlog.popleft()
+                msg.published_at = time.monotonic()
+                self._channel.basic_publish(self.exchange,
+                                            msg.routing_key,
+                                            msg.body,
+                                            properties=pika.spec.BasicProperties(message_id=msg.message_id))
+                self._outstanding[self._next_delivery_tag] = msg
+                self._next_delivery_tag += 1
+
+    def _on_message_returned(self, channel, method, properties, body):
+        """
+        called by pika if the broker returns a message that it could not route.  We don't publish with the mandatory flag,
+        so this should not happen, but if it does the message is only logged and counted; the broker still acks it, and
+        it is treated as confirmed like any other
+        :return:
+        """
+        BROKER_RETURNS.inc()
+        logger.warning("Message {0} to {1} was returned: {2}".format(properties.message_id, method.routing_key, method.reply_text))
+
+    def _on_delivery_confirmation(self, method_frame):
+        """
+        called by pika when the broker acks or nacks one or more messages
+        :param method_frame: pika.frame.Method containing either Basic.Ack or Basic.Nack
+        :return:
+        """
+        method = method_frame.method
+        is_ack = isinstance(method, pika.spec.Basic.Ack)
+        confirmed = []
+        with self._lock:
+            if method.multiple:
+                tags = [t for t in self._outstanding.keys() if t<=method.delivery_tag]
+            else:
+                tags = [method.delivery_tag] if method.delivery_tag in self._outstanding else []
+
+            for t in tags:
+                msg = self._outstanding.pop(t)
+                if is_ack:
+                    confirmed.append(msg)
+                elif msg.attempt >= self.max_retry_attempts:
+                    logger.error("Could not deliver message {0} to {1} after {2} attempts, exiting".format(msg.message_id, msg.routing_key, msg.attempt))
+                    self._failure = RuntimeError("Could not deliver message after {0} retries".format(self.max_retry_attempts))
+                else:
+                    msg.attempt += 1
+                    logger.error("Message {0} to {1} was not accepted by the broker, retrying (attempt {2})".format(msg.message_id, msg.routing_key, msg.attempt))
+                    self._backlog.append(msg)
+            should_retry = len(self._backlog)>0
+            self._lock.notify_all()
+
+        now = time.monotonic()
+        for msg in confirmed:
+            BROKER_CONFIRM_SECONDS.observe(now - msg.published_at)
+            if msg.on_confirm is not None:
+                msg.on_confirm()
+        if should_retry:
+            self._conn.ioloop.call_later(self.DELAY_SECONDS_PER_RETRY, self._publish_backlog)
+
+    def _raise_if_failed(self):
+        if self._failure is not None:
+            raise self._failure
+
+    def in_flight(self)->int:
+        """
+        returns the number of messages that have been accepted by notify() but not yet confirmed by the broker
+        """
+        with self._lock:
+            return len(self._backlog) + len(self._outstanding)
+
+    def notify(self, routing_key: str, msg_content: dict, on_confirm=None)->bool:
+        """
+        queue the given message (formatted to json) for sending to the given routing key on the exchange configured
+        at construction.  This returns as soon as the message is in the send window, and blocks while the window is full.
+        This can raise a JSON encoding exception if the message is not serializable, or a RuntimeError if the sending
+        retries have been exceeded
+        :param routing_key:
+        :param msg_content:
+        :param on_confirm: optional no-argument callable, invoked on the ioloop thread once the broker has confirmed the message
+        :return: boolean indicating if the message was queued
+        """
+        logger.debug("Queueing %s via %s to %s", msg_content, routing_key, self.exchange)
+        body = json.dumps(msg_content).encode(encoding="UTF-8")
+
+        with self._lock:
+            while len(self._backlog) + len(self._outstanding) >= self.max_outstanding and self._failure is None:
+                self._lock.wait()
+            self._raise_if_failed()
+            msg = PendingMessage(str(self._next_message_id), routing_key, body, on_confirm)
+            self._next_message_id += 1
+            self._backlog.append(msg)
+            conn = self._conn
+
+        if conn is not None:
+            conn.ioloop.add_callback_threadsafe(self._publish_backlog)
+        return True
+
+    def flush(self, timeout:float=None)->bool:
+        """
+        blocks until every queued message has been confirmed by the broker, or until the timeout expires
+        :param timeout: maximum time to wait in seconds, or None to wait indefinitely
+        :return: True if everything was confirmed, False if the timeout expired first
+        """
+        with self._lock:
+            result = self._lock.wait_for(lambda: self._failure is not None or len(self._backlog)+len(self._outstanding)==0, timeout)
+            self._raise_if_failed()
+            return result
+
+    def close(self, timeout:float=None):
+        """
+        waits for outstanding messages to be confirmed then closes the connection and stops the ioloop thread
+        :param timeout: maximum time to wait for confirmations in seconds, or None to wait indefinitely
+        :return:
+        """
+        try:
+            self.flush(timeout)
+        finally:
+            self._stopping = True
+            if self._conn is not None:
+                self._conn.ioloop.add_callback_threadsafe(self._conn.close)
+            if self._thread is not None:
+                self._thread.join(timeout)
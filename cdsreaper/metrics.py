@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+
+logger = logging.getLogger(__name__)
+
+### Prometheus metrics for cdsreaper. These are module-level, as prometheus_client expects, and are updated directly
+### from the code that does the work. MetricsServer serves them at /metrics, along with /healthz and /readyz probes
+### based on how recently each running watch has heard from the cluster.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+WATCH_EVENTS = Counter("cdsreaper_watch_events_total", "Job watch events received", ["namespace", "type"])
+EVENT_TO_PUBLISH_SECONDS = Histogram("cdsreaper_event_to_publish_seconds",
+                                     "Time from receiving a watch event to handing its notification to the sender",
+                                     ["namespace"], buckets=LATENCY_BUCKETS)
+BROKER_CONFIRM_SECONDS = Histogram("cdsreaper_broker_confirm_seconds",
+                                   "Time from publishing a message to the broker confirming it", buckets=LATENCY_BUCKETS)
+JOURNAL_WRITE_SECONDS = Histogram("cdsreaper_journal_write_seconds", "Time taken to write the journal to redis",
+                                  buckets=LATENCY_BUCKETS)
+LATEST_RESOURCE_VERSION = Gauge("cdsreaper_latest_resource_version", "Most recent resource version seen on the watch",
+                                ["namespace"])
+RESOURCE_VERSION_GAP = Gauge("cdsreaper_resource_version_gap",
+                             "Difference between the latest resource version seen and the one journalled",
+                             ["namespace"])
+RELISTS = Counter("cdsreaper_relists_total", "Times that jobs were re-listed after a 410 Gone", ["namespace"])
+WATCH_RECONNECTS = Counter("cdsreaper_watch_reconnects_total", "Times that the watch connection was interrupted and re-opened",
+                           ["namespace"])
+BROKER_RECONNECTS = Counter("cdsreaper_broker_reconnects_total", "Times that the rabbitmq connection was re-opened")
+BROKER_RETURNS = Counter("cdsreaper_broker_returns_total", "Messages that the broker returned as unroutable")
+PIPELINE_QUEUE_DEPTH = Gauge("cdsreaper_pipeline_queue_depth", "Items waiting in each stage queue of the event pipeline",
+                             ["namespace", "stage"])
+LAST_WATCH_ACTIVITY = Gauge("cdsreaper_last_watch_activity_timestamp_seconds",
+                            "Unix time at which the watch last heard from the cluster", ["namespace"])
+
+
+def resource_version_number(resource_version):
+    """
+    resource versions are opaque strings, but in practice they are integers. returns the integer value, or None if it
+    isn't one
+    """
+    try:
+        return int(resource_version)
+    except (TypeError, ValueError):
+        return None
+
+
+class WatchHealth(object):
+    """
+    keeps track of when each running watch last heard from the cluster, for the health probes.
+    a watch that is not running (e.g. a namespace that another replica is leader for) does not count.
+    """
+    def __init__(self, max_staleness:float):
+        """
+        :param max_staleness: number of seconds without any activity after which a running watch is considered wedged
+        """
+        self.max_staleness = max_staleness
+        self._lock = threading.Lock()
+        self._last_activity = {}
+        self._started = False
+
+    def mark_started(self):
+        """
+        call this once startup has finished, i.e. all connections are established
+        """
+        self._started = True
+
+    def mark_active(self, namespace:str):
+        now = time.time()
+        with self._lock:
+            self._last_activity[namespace] = now
+        LAST_WATCH_ACTIVITY.labels(namespace).set(now)
+
+    def mark_stopped(self, namespace:str):
+        with self._lock:
+            self._last_activity.pop(namespace, None)
+
+    def stale_watches(self)->list:
+        """
+        returns the namespaces of running watches that have been quiet for longer than max_staleness
+        """
+        now = time.time()
+        with self._lock:
+            return [ns for ns, last in self._last_activity.items() if now - last > self.max_staleness]
+
+    def is_live(self)->bool:
+        return len(self.stale_watches())==0
+
+    def is_ready(self)->bool:
+        return self._started and self.is_live()
+
+
+# shared by every JobWatcher in the process. replace max_staleness at startup if the watch timeout is changed
+watch_health = WatchHealth(max_staleness=660)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path=="/metrics":
+            self._respond(200, generate_latest(REGISTRY), CONTENT_TYPE_LATEST)
+        elif self.path=="/healthz":
+            self._probe(watch_health.is_live())
+        elif self.path=="/readyz":
+            self._probe(watch_health.is_ready())
+        else:
+            self._respond(404, b"Not found\n")
+
+    def _probe(self, ok:bool):
+        if ok:
+            self._respond(200, b"ok\n")
+        else:
+            self._respond(503, "stale watches: {0}\n".format(",".join(watch_health.stale_watches())).encode("UTF-8"))
+
+    def _respond(self, status:int, body:bytes, content_type="text/plain; charset=utf-8"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - " + format, self.address_string(), *args)
+
+
+class MetricsServer(object):
+    """
+    serves /metrics, /healthz and /readyz on a background thread
+    """
+    def __init__(self, port:int, address:str=""):
+        self._server = ThreadingHTTPServer((address, port), MetricsHandler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="MetricsServer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logger.info("Serving metrics and health checks on port {0}".format(self.port))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -2,43 +2,144 @@ import redis
 import json
 import time
 import logging
+import threading
+import collections
 
 logger = logging.getLogger(__name__)
 
 
+class LeaseLost(Exception):
+    """
+    raised by a fenced write when the leader lease that it is fenced on is no longer held by us
+    """
+    pass
+
+
 class JobState(object):
-    def __init__(self,uid:str, name:str, status:str, timestamp:float):
+    FINISHED_STATUSES = ("success", "failed")
+    # job states are stored at <prefix>:<uid>. when several namespaces are watched each has a prefix of its own, see
+    # StatusCache
+    KEY_PREFIX = "cds:job"
+
+    def __init__(self,uid:str, name:str, status:str, timestamp:float, labels:dict=None, transitions:dict=None):
+        """
+        :param labels: the job's labels
+        :param transitions: dict of lifecycle stage -> unix time at which the job first reached it, see timeline.py
+        """
         self.uid = uid
         self.name = name
         self.status = status
-        self.float = timestamp if timestamp else time.time()
+        self.timestamp = timestamp if timestamp else time.time()
+        self.labels = labels
+        self.transitions = transitions
 
     def to_json(self):
         return json.dumps(self.__dict__)
 
-    def key(self):
-        return "cds:job:{0}".format(self.uid)
+    def key(self, prefix:str=KEY_PREFIX):
+        return JobState.key_for(self.uid, prefix)
 
-    def write(self, client:redis.client.Redis):
-        client.set(self.key(), self.to_json())
+    @staticmethod
+    def key_for(uid:str, prefix:str=KEY_PREFIX)->str:
+        return "{0}:{1}".format(prefix, uid)
 
-    def delete(self, client:redis.client.Redis):
-        client.delete(self.key())
+    def is_finished(self)->bool:
+        return self.status in JobState.FINISHED_STATUSES
+
+    def write(self, client:redis.client.Redis, ttl:int=None, prefix:str=KEY_PREFIX):
+        """
+        stores this job state
+        :param client: redis client, or pipeline
+        :param ttl: if set, the record expires after this many seconds
+        :param prefix: key prefix to store it under
+        :return:
+        """
+        if ttl:
+            client.set(self.key(prefix), self.to_json(), ex=ttl)
+        else:
+            client.set(self.key(prefix), self.to_json())
+
+    def delete(self, client:redis.client.Redis, prefix:str=KEY_PREFIX):
+        client.delete(self.key(prefix))
 
     @staticmethod
-    def read(client:redis.client.Redis, uid:str):
+    def write_many(client:redis.client.Redis, states:list, finished_ttl:int=None, deleted_uids:list=(), checkpoint:tuple=None,
+                   indexers:list=(), prefix:str=KEY_PREFIX, fence:tuple=None):
+        """
+        stores any number of job states, removes deleted ones and optionally writes a journal checkpoint, all in a single
+        round trip. this is done as a transaction, so the checkpoint is never stored without the states that go with it
+        :param client: redis client
+        :param states: list of JobState to write
+        :param finished_ttl: if set, records for finished jobs expire after this many seconds, so that they don't
+        build up forever
+        :param deleted_uids: uids of jobs whose records should be removed
+        :param checkpoint: optional tuple of (key, value) to set in the same transaction
+        :param indexers: objects such as JobRegistry and RouteTimeline, whose index(pipe, state) methods are called
+        for each state so that they are updated in the same transaction
+        :param prefix: key prefix that the job states are stored under
+        :param fence: optional tuple of (key, value). if given, nothing is written unless the key still holds the value
+        when the transaction runs, e.g. a leader lease and our identity. raises LeaseLost if it doesn't
+        :return:
+        """
+        def queue_writes(pipe):
+            for state in states:
+                state.write(pipe, finished_ttl if state.is_finished() else None, prefix)
+                for indexer in indexers:
+                    indexer.index(pipe, state)
+            for uid in deleted_uids:
+                pipe.delete(JobState.key_for(uid, prefix))
+            if checkpoint is not None:
+                pipe.set(*checkpoint)
+
+        if fence is None:
+            pipe = client.pipeline(transaction=True)
+            queue_writes(pipe)
+            pipe.execute()
+            return
+
+        fence_key, fence_value = fence
+        for attempt in range(3):
+            with client.pipeline(transaction=True) as pipe:
+                # if the lease changes hands between this check and EXEC, e.g. because it expired, the transaction is
+                # not run. renewing the lease touches the key too, hence the retries
+                pipe.watch(fence_key)
+                holder = pipe.get(fence_key)
+                if isinstance(holder, bytes):
+                    holder = holder.decode("UTF-8")
+                if holder != fence_value:
+                    raise LeaseLost("{0} is held by {1}, not {2}".format(fence_key, holder, fence_value))
+                pipe.multi()
+                queue_writes(pipe)
+                try:
+                    pipe.execute()
+                    return
+                except redis.WatchError:
+                    if attempt==2:
+                        raise
+
+    @staticmethod
+    def from_json(json_data):
+        """
+        parses the content written by to_json. raises KeyError or json.JSONDecodeError if it is not valid
+        """
+        parsed_dict = json.loads(json_data)
+        return JobState(parsed_dict["uid"],parsed_dict["name"],parsed_dict["status"], parsed_dict["timestamp"],
+                        parsed_dict.get("labels"), parsed_dict.get("transitions"))
+
+    @staticmethod
+    def read(client:redis.client.Redis, uid:str, prefix:str=KEY_PREFIX):
         """
         look up the given job uid in the datastore. Returns the object as JobState or None.
         :param client:
         :param uid:
+        :param prefix: key prefix that the job state is stored under
         :return:
         """
-        key = "cds:job:{0}".format(uid)
+        key = JobState.key_for(uid, prefix)
         json_data = client.get(key)
         if json_data is not None:
             try:
-                parsed_dict = json.loads(json_data)
-                return JobState(parsed_dict["uid"],parsed_dict["name"],parsed_dict["status"], parsed_dict["timestamp"])
+                return JobState.from_json(json_data)
             except KeyError as e:
                 logger.error("Data for job {0} was invalid, missing key {1}.".format(uid, str(e)))
                 client.delete(key)
@@ -48,4 +149,181 @@ class JobState(object):
                 client.delete(key)
                 return None
         else:
-            return None
\ No newline at end of file
+            return None
+
+
+class StatusCache(object):
+    """
+    remembers the last status that was notified for each job, so that repeated events for a job whose status has not
+    changed can be ignored.
+    the `max_entries` most recently used jobs are kept in memory. if a redis client is given then every entry is also
+    stored there as a JobState, so that the cache survives a restart and jobs that fell out of memory can be looked up.
+    if `batched` is set, changes are not written to redis straight away but held until flush() is called, normally by
+    the journal when it writes its checkpoint, so that they all go in the same round trip.
+    every job state written is also passed to the given indexers, such as JobRegistry and RouteTimeline.
+    when several namespaces are watched, each one's cache should have its own `key_prefix`, so that a re-list of one
+    namespace doesn't see the other namespaces' jobs as having been deleted.
+    """
+    def __init__(self, client:redis.client.Redis=None, max_entries=1000, finished_ttl:int=None, batched=False,
+                 indexers:list=None, key_prefix:str=JobState.KEY_PREFIX):
+        """
+        :param client: redis client to store job states in, or None to only keep them in memory
+        :param max_entries: number of jobs to keep in memory
+        :param finished_ttl: if set, stored records for finished jobs expire after this many seconds
+        :param batched: hold changes until flush() is called, rather than writing each one as it happens
+        :param indexers: list of objects with an index(pipe, state) method, see JobState.write_many
+        :param key_prefix: key prefix to store job states under
+        """
+        self._client = client
+        self.max_entries = max_entries
+        self.finished_ttl = finished_ttl
+        self.batched = batched
+        self.indexers = indexers if indexers is not None else []
+        self.key_prefix = key_prefix
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()   # uid -> JobState, least recently used first
+        self._unwritten = {}    # uid -> JobState to write, or None to delete, when batched
+
+    def get(self, uid:str):
+        """
+        returns the last notified JobState for the given job uid, or None if we don't know about it
+        :param uid:
+        :return:
+        """
+        with self._lock:
+            if uid in self._entries:
+                self._entries.move_to_end(uid)
+                return self._entries[uid]
+
+        if self._client is None:
+            return None
+        with self._lock:
+            if uid in self._unwritten:
+                return self._unwritten[uid]
+        try:
+            state = JobState.read(self._client, uid, self.key_prefix)
+        except (redis.RedisError, ConnectionError) as e:
+            logger.warning("Could not look up job state for {0}: {1}".format(uid, str(e)))
+            return None
+        if state is not None:
+            self.remember(state)
+        return state
+
+    def remember(self, state:JobState):
+        """
+        updates the in-memory entry for the given job, evicting the least recently used one if we are full
+        :param state:
+        :return:
+        """
+        with self._lock:
+            self._entries[state.uid] = state
+            self._entries.move_to_end(state.uid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def persist(self, state:JobState):
+        """
+        writes the given job state to redis, if we have a client
+        :param state:
+        :return:
+        """
+        if self._client is None:
+            return
+        if self.batched:
+            with self._lock:
+                self._unwritten[state.uid] = state
+            return
+        try:
+            if len(self.indexers)>0:
+                JobState.write_many(self._client, [state], finished_ttl=self.finished_ttl, indexers=self.indexers,
+                                    prefix=self.key_prefix)
+            else:
+                state.write(self._client, self.finished_ttl if state.is_finished() else None, self.key_prefix)
+        except (redis.RedisError, ConnectionError) as e:
+            logger.warning("Could not store job state for {0}: {1}".format(state.uid, str(e)))
+
+    def put(self, state:JobState):
+        self.remember(state)
+        self.persist(state)
+
+    def known_uids(self)->set:
+        """
+        returns the uids of every job that we have a stored state for under our key prefix, in memory or in redis
+        :return: set of uid strings
+        """
+        with self._lock:
+            uids = set(self._entries.keys())
+        if self._client is not None:
+            prefix = self.key_prefix + ":"
+            for key in self._client.scan_iter(match=prefix + "*", count=1000):
+                if isinstance(key, bytes):
+                    key = key.decode("UTF-8")
+                uid = key[len(prefix):]
+                if ":" not in uid:      # another namespace's prefix nested under ours
+                    uids.add(uid)
+        return uids
+
+    def forget(self, uid:str):
+        """
+        removes the given job from memory and from redis
+        :param uid:
+        :return:
+        """
+        with self._lock:
+            state = self._entries.pop(uid, None)
+            if self.batched and self._client is not None:
+                self._unwritten[uid] = None
+                return
+        if self._client is None:
+            return
+        try:
+            (state if state is not None else JobState(uid, None, None, None)).delete(self._client, self.key_prefix)
+        except (redis.RedisError, ConnectionError) as e:
+            logger.warning("Could not remove job state for {0}: {1}".format(uid, str(e)))
+
+    def discard(self)->int:
+        """
+        throws away every change held since the last flush, e.g. because we are no longer leader and another replica
+        may have written newer states
+        :return: number of changes thrown away
+        """
+        with self._lock:
+            count = len(self._unwritten)
+            self._unwritten = {}
+        return count
+
+    def has_unwritten(self)->bool:
+        with self._lock:
+            return len(self._unwritten)>0
+
+    def flush(self, checkpoint:tuple=None, fence:tuple=None):
+        """
+        writes out every change held since the last flush, along with the given journal checkpoint, in one round trip.
+        if the write fails the changes are kept for next time, and the exception is raised
+        :param checkpoint: optional tuple of (key, value) to write in the same transaction
+        :param fence: optional tuple of (key, value) that must still be in redis for the write to go ahead, see
+        JobState.write_many
+        :return: number of job states written or removed
+        """
+        with self._lock:
+            to_write = self._unwritten
+            self._unwritten = {}
+        if self._client is None or (len(to_write)==0 and checkpoint is None):
+            return 0
+
+        try:
+            JobState.write_many(self._client,
+                                [state for state in to_write.values() if state is not None],
+                                finished_ttl=self.finished_ttl,
+                                deleted_uids=[uid for uid, state in to_write.items() if state is None],
+                                checkpoint=checkpoint,
+                                indexers=self.indexers,
+                                prefix=self.key_prefix,
+                                fence=fence)
+        except Exception:
+            with self._lock:
+                # anything changed again in the meantime is newer than what we failed to write
+                to_write.update(self._unwritten)
+                self._unwritten = to_write
+            raise
+        return len(to_write)
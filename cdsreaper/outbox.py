@@ -0,0 +1,239 @@
+import json
+import logging
+import os
+import threading
+from messagesender import MessageSender
+
+logger = logging.getLogger(__name__)
+
+
+class SpoolOutbox(object):
+    """
+    a durable outbox for notifications. notify() appends each message to a spool file and syncs it to disk, then returns
+    straight away; a background drainer sends the spooled messages to rabbitmq in order, via a MessageSender.
+    if the broker is down, the drainer backs off and keeps trying the same message, while notify() carries on spooling,
+    so a broker outage neither stops us reading watch events nor brings the process down.
+    the position of the next message to send is kept in `<spool_path>.offset`, so messages that were spooled but not
+    sent before a restart are sent when we start up again. a message may be sent twice if we crash between sending it
+    and recording the new offset, but none will be lost. once more than `compact_bytes` of the spool has been sent, and
+    the sent part is at least as big as the unsent part, the unsent part is copied to a fresh spool, so that the file
+    doesn't grow for ever under a steady load. the offset is reset before the new spool replaces the old one, so a crash
+    part way through can only cause messages to be sent again, never skipped.
+    """
+    MAX_BACKOFF_SECONDS = 60
+
+    def __init__(self, spool_path:str, sender:MessageSender, fsync=True, compact_bytes=1024*1024):
+        """
+        :param spool_path: file to spool messages to. Put this on a volume that survives container restarts
+        :param sender: MessageSender to forward messages with
+        :param fsync: if False, don't wait for each message to reach the disk. This is much faster but messages can be
+        lost if the node itself goes down
+        :param compact_bytes: only compact the spool once this much of it has been sent, to save rewriting it constantly
+        """
+        self.spool_path = spool_path
+        self.offset_path = spool_path + ".offset"
+        self.fsync = fsync
+        self.compact_bytes = compact_bytes
+        self._sender = sender
+
+        self._lock = threading.Condition()
+        self._stopping = False
+        self._stopped = threading.Event()
+        self._offset = self._read_offset()
+        self._repair()
+        self._spool = open(self.spool_path, "ab")
+        self._pending = self._count_pending()
+        if self._pending > 0:
+            logger.info("Outbox {0} has {1} unsent messages from a previous run".format(self.spool_path, self._pending))
+
+        self._drainer = threading.Thread(target=self._drain_loop, name="SpoolOutbox", daemon=True)
+        self._drainer.start()
+
+    def _read_offset(self)->int:
+        try:
+            with open(self.offset_path, "r") as f:
+                return int(f.read().strip())
+        except FileNotFoundError:
+            return 0
+        except (IOError, ValueError) as e:
+            logger.error("Outbox offset file {0} is not readable: {1}. Sending the whole spool again".format(self.offset_path, str(e)))
+            return 0
+
+    def _write_offset(self, offset:int):
+        temp_path = self.offset_path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(str(offset))
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, self.offset_path)
+        self._sync_directory()
+
+    def _sync_directory(self):
+        """
+        makes sure that a file that has just been renamed into place survives a crash of the node
+        """
+        if not self.fsync:
+            return
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.spool_path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _repair(self):
+        """
+        cuts off a partly-written message left at the end of the spool by a crash. it was never confirmed to the caller,
+        so the event it came from will be seen again
+        """
+        if not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path, "rb+") as f:
+            content = f.read()
+            if len(content)==0 or content.endswith(b"\n"):
+                return
+            complete_length = content.rfind(b"\n") + 1
+            logger.warning("Discarding {0} bytes of incomplete message at the end of outbox {1}".format(len(content)-complete_length, self.spool_path))
+            f.truncate(complete_length)
+
+    def _count_pending(self)->int:
+        if not os.path.exists(self.spool_path):
+            return 0
+        with open(self.spool_path, "rb") as f:
+            f.seek(self._offset)
+            return sum(1 for line in f if line.endswith(b"\n"))
+
+    def pending(self)->int:
+        """
+        returns the number of spooled messages that have not been sent yet
+        """
+        with self._lock:
+            return self._pending
+
+    def notify(self, routing_key:str, msg_content:dict, on_confirm=None)->bool:
+        """
+        spools a message for sending. same signature as MessageSender.notify
+        :param routing_key: routing key to send with
+        :param msg_content: message content, must be json serializable
+        :param on_confirm: called with no arguments once the message is safely spooled
+        :return: True
+        """
+        line = json.dumps({"routing_key": routing_key, "body": msg_content}).encode("UTF-8") + b"\n"
+        with self._lock:
+            if self._stopping:
+                raise RuntimeError("Outbox {0} is closed".format(self.spool_path))
+            self._spool.write(line)
+            self._spool.flush()
+            if self.fsync:
+                os.fsync(self._spool.fileno())
+            self._pending += 1
+            self._lock.notify_all()
+        if on_confirm is not None:
+            on_confirm()
+        return True
+
+    def _next_entry(self):
+        """
+        waits for the next unsent entry in the spool
+        :return: tuple of (entry dict, offset after it), or None if we are stopping
+        """
+        with self._lock:
+            while self._pending==0 and not self._stopping:
+                self._lock.wait()
+            if self._pending==0:
+                return None
+        with open(self.spool_path, "rb") as f:
+            f.seek(self._offset)
+            line = f.readline()
+        try:
+            return json.loads(line.decode("UTF-8")), self._offset + len(line)
+        except ValueError as e:
+            logger.error("Skipping unreadable outbox entry {0}: {1}".format(line, str(e)))
+            return None, self._offset + len(line)
+
+    def _send(self, entry:dict)->bool:
+        """
+        sends one entry, retrying with increasing delays until the sender succeeds or we are stopped
+        :return: False if we were stopped before it could be sent
+        """
+        backoff = min(1, SpoolOutbox.MAX_BACKOFF_SECONDS)
+        while True:
+            try:
+                if not self._sender.notify(entry["routing_key"], entry["body"]):
+                    logger.error("Dropping outbox message to {0} that can never be sent: {1}".format(entry["routing_key"], entry["body"]))
+                return True
+            except Exception as e:
+                logger.error("Could not send outbox message to {0}: {1}. {2} unsent, trying again in {3}s".format(
+                    entry["routing_key"], str(e), self.pending(), backoff))
+            if self._stopped.wait(backoff):
+                return False
+            backoff = min(backoff*2, SpoolOutbox.MAX_BACKOFF_SECONDS)
+
+    def _drain_loop(self):
+        while True:
+            next_entry = self._next_entry()
+            if next_entry is None:
+                return
+            entry, next_offset = next_entry
+            if entry is not None and not self._send(entry):
+                return
+            self._write_offset(next_offset)
+            with self._lock:
+                self._offset = next_offset
+                self._pending -= 1
+                if self._pending==0:
+                    self._lock.notify_all()
+                if self._offset >= self.compact_bytes and self._offset >= self._spool.tell() - self._offset:
+                    try:
+                        self._compact()
+                    except (IOError, OSError) as e:
+                        logger.error("Could not compact outbox {0}: {1}".format(self.spool_path, str(e)))
+
+    def _compact(self):
+        """
+        replaces the spool with one holding only the messages that have not been sent yet. must be called with the lock
+        held
+        """
+        temp_path = self.spool_path + ".compact"
+        with open(self.spool_path, "rb") as source, open(temp_path, "wb") as dest:
+            source.seek(self._offset)
+            while True:
+                chunk = source.read(1024*1024)
+                if not chunk:
+                    break
+                dest.write(chunk)
+            dest.flush()
+            if self.fsync:
+                os.fsync(dest.fileno())
+        # the offset goes first: if we crash before the new spool is in place, the old one is sent again from the start
+        self._write_offset(0)
+        os.replace(temp_path, self.spool_path)
+        self._sync_directory()
+        self._spool.close()
+        self._spool = open(self.spool_path, "ab")
+        self._offset = 0
+        logger.debug("Compacted outbox {0}, {1} unsent messages kept".format(self.spool_path, self._pending))
+
+    def flush(self, timeout:float=None)->bool:
+        """
+        waits until every spooled message has been sent
+        :param timeout: maximum number of seconds to wait, or None to wait forever
+        :return: True if everything was sent, False on timeout
+        """
+        with self._lock:
+            return self._lock.wait_for(lambda: self._pending==0, timeout)
+
+    def close(self, timeout:float=None)->bool:
+        """
+        gives the drainer up to `timeout` seconds to send what is left, then stops it. anything still unsent stays in
+        the spool for the next run
+        :return: True if everything was sent
+        """
+        sent = self.flush(timeout)
+        with self._lock:
+            self._stopping = True
+            self._lock.notify_all()
+        self._stopped.set()
+        self._drainer.join(timeout)
+        self._spool.close()
+        return sent
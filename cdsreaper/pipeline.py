@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from messagesender import MessageSender, PipelinedMessageSender
+from journal import Journal
+from metrics import PIPELINE_QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+
+class EventPipeline(object):
+    """
+    decouples reading the watch stream from publishing messages and writing the journal.
+    the JobWatcher hands notifications to `notify` and journal updates to `journal.record_processed`; these are put onto
+    bounded asyncio queues and taken off by a publish stage and a journal stage, which run on their own event loop
+    thread. the blocking sender and redis calls are made from a single-thread executor per stage, so each stage works
+    in order without holding up the other.
+    when a queue is full the caller waits until there is room, so a slow broker or redis slows the watch down rather than
+    letting memory grow without limit. `depths()` shows how full each queue is, and is exported as the
+    cdsreaper_pipeline_queue_depth gauge.
+    since messages are sent after notify() returns, use this with a ConfirmedEventTracker built on `journal` so
+    that an event is only journalled once its messages have gone.
+    """
+    def __init__(self, sender:MessageSender, journal:Journal, queue_size:int=1000, namespace:str=""):
+        """
+        :param sender: MessageSender or PipelinedMessageSender to publish with
+        :param journal: Journal to write to
+        :param queue_size: maximum number of items waiting in each stage's queue
+        :param namespace: namespace whose events this pipeline carries, to label its queue depth metrics with
+        """
+        self._sender = sender
+        self._target_journal = journal
+        self.queue_size = queue_size
+        self.journal = PipelineJournal(self, journal)
+
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._publish_queue = None
+        self._journal_queue = None
+        self._publish_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="EventPipeline-publish")
+        self._journal_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="EventPipeline-journal")
+        self._failure = None
+        self._tasks = []
+        self._thread = None
+        for stage in ("publish", "journal"):
+            PIPELINE_QUEUE_DEPTH.labels(namespace, stage).set_function(lambda stage=stage: self.depths()[stage])
+
+    def start(self):
+        """
+        starts the event loop thread and the stages
+        :return:
+        """
+        self._thread = threading.Thread(target=self._run_loop, name="EventPipeline", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._setup())
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _setup(self):
+        self._publish_queue = asyncio.Queue(maxsize=self.queue_size)
+        self._journal_queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [
+            self._loop.create_task(self._publish_stage()),
+            self._loop.create_task(self._journal_stage()),
+        ]
+
+    def depths(self)->dict:
+        """
+        returns the number of items waiting in each stage's queue
+        :return: dict of stage name -> queue depth
+        """
+        if self._publish_queue is None:
+            return {"publish": 0, "journal": 0}
+        return {"publish": self._publish_queue.qsize(), "journal": self._journal_queue.qsize()}
+
+    def _put(self, queue:asyncio.Queue, stage:str, item):
+        """
+        puts an item onto a stage queue from another thread, waiting while the queue is full
+        """
+        if self._failure is not None:
+            raise RuntimeError("Event pipeline has stopped: {0}".format(str(self._failure)))
+        if queue.full():
+            logger.warning("{0} queue is full with {1} items, waiting for room".format(stage, queue.qsize()))
+        asyncio.run_coroutine_threadsafe(queue.put(item), self._loop).result()
+
+    def notify(self, routing_key:str, msg_content:dict, on_confirm=None):
+        """
+        queues a message to be published. same signature as MessageSender.notify
+        :param routing_key: routing key to send with
+        :param msg_content: message content, will be json encoded
+        :param on_confirm: called with no arguments once the message has been sent
+        :return: True
+        """
+        self._put(self._publish_queue, "publish", (routing_key, msg_content, on_confirm))
+        return True
+
+    def record_processed(self, id:int):
+        self._put(self._journal_queue, "journal", int(id))
+
+    def _send(self, routing_key:str, msg_content:dict, on_confirm):
+        """
+        sends a message, from the publish executor thread
+        """
+        if isinstance(self._sender, PipelinedMessageSender):
+            self._sender.notify(routing_key, msg_content, on_confirm=on_confirm)
+        else:
+            self._sender.notify(routing_key, msg_content)
+            if on_confirm is not None:
+                on_confirm()
+
+    async def _publish_stage(self):
+        while True:
+            routing_key, msg_content, on_confirm = await self._publish_queue.get()
+            try:
+                # once a stage has failed, anything still queued is dropped unsent (and so never journalled) so that
+                # callers waiting for room are let through to see the failure
+                if self._failure is None:
+                    await self._loop.run_in_executor(self._publish_executor, self._send, routing_key, msg_content, on_confirm)
+            except Exception as e:
+                logger.error("Could not publish {0} message: {1}".format(routing_key, str(e)))
+                self._failure = e
+            finally:
+                self._publish_queue.task_done()
+
+    async def _journal_stage(self):
+        while True:
+            most_recent = await self._journal_queue.get()
+            # only the latest value matters, so take everything else that is waiting and write once
+            count = 1
+            while not self._journal_queue.empty():
+                most_recent = max(most_recent, self._journal_queue.get_nowait())
+                count += 1
+            try:
+                if self._failure is None:
+                    await self._loop.run_in_executor(self._journal_executor, self._target_journal.record_processed, most_recent)
+            except Exception as e:
+                logger.error("Could not journal event {0}: {1}".format(most_recent, str(e)))
+                self._failure = e
+            finally:
+                for _ in range(count):
+                    self._journal_queue.task_done()
+
+    async def _cancel_stages(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def drain(self, timeout:float=None)->bool:
+        """
+        waits until everything queued so far has gone through both stages
+        :param timeout: maximum number of seconds to wait, or None to wait forever
+        :return: True if the queues were drained, False on timeout or if a stage has failed
+        """
+        async def join_all():
+            await self._publish_queue.join()
+            await self._journal_queue.join()
+
+        future = asyncio.run_coroutine_threadsafe(join_all(), self._loop)
+        try:
+            future.result(timeout)
+        except Exception:
+            future.cancel()
+            return False
+        return self._failure is None
+
+    def close(self, timeout:float=None):
+        """
+        drains the queues, then stops the stages and the event loop
+        :param timeout: maximum number of seconds to wait for the queues to drain
+        :return: True if everything queued was processed
+        """
+        drained = self.drain(timeout)
+        if not drained:
+            logger.warning("Event pipeline closed with {0} still queued".format(self.depths()))
+        asyncio.run_coroutine_threadsafe(self._cancel_stages(), self._loop).result(timeout)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        self._publish_executor.shutdown(wait=False)
+        self._journal_executor.shutdown(wait=False)
+        return drained
+
+
+class PipelineJournal(object):
+    """
+    Journal-like front end that queues writes onto an EventPipeline's journal stage. reads and clears go straight to the
+    underlying journal, once any queued writes have been made.
+    """
+    def __init__(self, pipeline:EventPipeline, journal:Journal):
+        self._pipeline = pipeline
+        self._journal = journal
+
+    @property
+    def client(self):
+        return self._journal.client
+
+    @property
+    def last_written(self):
+        return self._journal.last_written
+
+    def record_processed(self, id:int):
+        self._pipeline.record_processed(id)
+
+    def get_most_recent_event(self):
+        return self._journal.get_most_recent_event()
+
+    def clear_journal(self):
+        self._pipeline.drain()
+        self._journal.clear_journal()
@@ -0,0 +1,48 @@
+import redis
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+### Every component that talks to redis (the journals, status caches and leader leases) gets its client from here, so
+### that they all share one connection pool per server rather than each holding connections of their own.
+### The pool blocks for up to `timeout` seconds when all of its connections are in use, rather than failing straight away.
+
+DEFAULT_MAX_CONNECTIONS = 20
+
+_pools = {}
+_lock = threading.Lock()
+
+
+def get_client(host:str, port:int=6379, db:int=0, password:str=None, max_connections:int=None, timeout:float=20)->redis.Redis:
+    """
+    returns a redis client using the shared connection pool for the given server, creating the pool if necessary.
+    the pool's size is fixed by the first call for each server
+    :param host: redis host
+    :param port: redis port
+    :param db: database number
+    :param password: password, or None
+    :param max_connections: maximum number of connections in the pool, defaults to DEFAULT_MAX_CONNECTIONS
+    :param timeout: number of seconds to wait for a free connection before raising a ConnectionError
+    :return: redis.Redis client
+    """
+    key = (host, port, db)
+    with _lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = redis.BlockingConnectionPool(host=host, port=port, db=db, password=password,
+                                                max_connections=max_connections if max_connections else DEFAULT_MAX_CONNECTIONS,
+                                                timeout=timeout, health_check_interval=30)
+            _pools[key] = pool
+            logger.debug("Created redis connection pool for %s:%s/%s with %s connections", host, port, db, pool.max_connections)
+    return redis.Redis(connection_pool=pool)
+
+
+def close_all():
+    """
+    disconnects and forgets every pool, e.g. before exiting
+    """
+    with _lock:
+        for pool in _pools.values():
+            pool.disconnect()
+        _pools.clear()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""
+a queryable history of the jobs that cdsreaper has seen, kept in redis alongside the job states.
+
+    python registry.py query --status failed --since 1h --label deliverable-bundle-id=1234
+    python registry.py prune
+
+the redis connection is configured with the same REDIS_HOST, REDIS_PORT, REDIS_DB_NUM and REDIS_PASS variables as
+cdsreaper.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+import redis
+
+import redispool
+from models import JobState
+
+logger = logging.getLogger(__name__)
+
+### Each job status written by cdsreaper is also indexed here, so that jobs can be found by status, label and time
+### without a list call to the API server. The keys are:
+###   cds:registry:job:<uid>                  - the JobState, expiring a day after the retention period
+###   cds:registry:updated                    - sorted set of every job uid, scored by when its status last changed
+###   cds:registry:status:<status>            - sorted set of the uids of jobs currently in that status, scored the same way
+###   cds:registry:label:<label>:<value>      - set of the uids of jobs with that label value, for INDEXED_LABELS
+### Unlike the status cache entries, these are kept once a job has been deleted from the cluster, until they are older
+### than the retention period and are pruned.
+
+
+class JobRegistry(object):
+    KEY_PREFIX = "cds:registry"
+    STATUSES = ("starting", "running", "retry", "failed", "success")
+    INDEXED_LABELS = ("deliverable-asset-id", "deliverable-bundle-id", "online-id", "cds-route")
+    # the responder sets a label to this when it has no value for it
+    MISSING_LABEL_VALUE = "None"
+    PRUNE_BATCH = 500
+
+    def __init__(self, client:redis.Redis, retention_seconds:int=7*24*3600, indexed_labels:tuple=None):
+        """
+        :param client: redis client
+        :param retention_seconds: jobs whose status has not changed for this long are removed by prune()
+        :param indexed_labels: job labels that can be searched on, defaults to INDEXED_LABELS
+        """
+        self._client = client
+        self.retention_seconds = retention_seconds
+        self.indexed_labels = indexed_labels if indexed_labels is not None else JobRegistry.INDEXED_LABELS
+        self._stop_pruning = threading.Event()
+
+    @staticmethod
+    def job_key(uid:str)->str:
+        return "{0}:job:{1}".format(JobRegistry.KEY_PREFIX, uid)
+
+    @staticmethod
+    def updated_key()->str:
+        return "{0}:updated".format(JobRegistry.KEY_PREFIX)
+
+    @staticmethod
+    def status_key(status:str)->str:
+        return "{0}:status:{1}".format(JobRegistry.KEY_PREFIX, status)
+
+    @staticmethod
+    def label_key(label:str, value:str)->str:
+        return "{0}:label:{1}:{2}".format(JobRegistry.KEY_PREFIX, label, value)
+
+    def _indexed_label_keys(self, state:JobState)->list:
+        if not state.labels:
+            return []
+        return [JobRegistry.label_key(label, state.labels[label]) for label in self.indexed_labels
+                if state.labels.get(label) not in (None, JobRegistry.MISSING_LABEL_VALUE)]
+
+    def index(self, pipe:redis.client.Pipeline, state:JobState):
+        """
+        adds the commands to index the given job state to a pipeline, e.g. the one that JobState.write_many uses
+        :param pipe: redis pipeline
+        :param state: JobState to index
+        :return:
+        """
+        pipe.set(JobRegistry.job_key(state.uid), state.to_json(), ex=self.retention_seconds + 24*3600)
+        pipe.zadd(JobRegistry.updated_key(), {state.uid: state.timestamp})
+        # the job can only be indexed under statuses that it has been in before
+        previous_statuses = state.transitions.keys() if state.transitions else JobRegistry.STATUSES
+        for status in JobRegistry.STATUSES:
+            if status!=state.status and status in previous_statuses:
+                pipe.zrem(JobRegistry.status_key(status), state.uid)
+        if state.status is not None:
+            pipe.zadd(JobRegistry.status_key(state.status), {state.uid: state.timestamp})
+        for key in self._indexed_label_keys(state):
+            pipe.sadd(key, state.uid)
+
+    def find(self, status:str=None, since:float=None, until:float=None, labels:dict=None, limit:int=None)->list:
+        """
+        finds jobs by their current status, when that status was last changed, and their labels
+        :param status: only return jobs in this status
+        :param since: only return jobs whose status changed at or after this unix time
+        :param until: only return jobs whose status changed at or before this unix time
+        :param labels: dict of label -> value that returned jobs must all have. The labels must be in indexed_labels
+        :param limit: maximum number of jobs to return
+        :return: list of JobState, most recently changed first
+        """
+        low = since if since is not None else "-inf"
+        high = until if until is not None else "+inf"
+        scored_key = JobRegistry.status_key(status) if status is not None else JobRegistry.updated_key()
+
+        if labels:
+            for label in labels.keys():
+                if label not in self.indexed_labels:
+                    raise ValueError("Label {0} is not indexed, indexed labels are {1}".format(label, ", ".join(self.indexed_labels)))
+            # a label is expected to pick out few jobs, so look them up in the time index rather than the other way round
+            candidates = self._client.sinter([JobRegistry.label_key(label, value) for label, value in labels.items()])
+            pipe = self._client.pipeline(transaction=False)
+            for uid in candidates:
+                pipe.zscore(scored_key, uid)
+            scores = pipe.execute()
+            matches = [(uid, score) for uid, score in zip(candidates, scores)
+                       if score is not None and (since is None or score >= since) and (until is None or score <= until)]
+            matches.sort(key=lambda m: m[1], reverse=True)
+            if limit is not None:
+                matches = matches[0:limit]
+        else:
+            matches = self._client.zrevrangebyscore(scored_key, high, low, start=0 if limit is not None else None,
+                                                    num=limit, withscores=True)
+
+        if len(matches)==0:
+            return []
+        records = self._client.mget([JobRegistry.job_key(self._decode(uid)) for uid, _ in matches])
+        results = []
+        for (uid, score), record in zip(matches, records):
+            if record is None:
+                # the record has expired before being pruned, we still know enough to say that the job matched
+                results.append(JobState(self._decode(uid), None, status, score))
+                continue
+            try:
+                results.append(JobState.from_json(record))
+            except (KeyError, json.JSONDecodeError) as e:
+                logger.warning("Registry record for {0} is invalid: {1}".format(self._decode(uid), str(e)))
+        return results
+
+    @staticmethod
+    def _decode(value):
+        return value.decode("UTF-8") if isinstance(value, bytes) else value
+
+    def prune(self, now:float=None)->int:
+        """
+        removes jobs whose status has not changed for longer than the retention period
+        :param now: current time, defaults to time.time()
+        :return: number of jobs removed
+        """
+        cutoff = (now if now is not None else time.time()) - self.retention_seconds
+        removed = 0
+        while True:
+            uids = self._client.zrangebyscore(JobRegistry.updated_key(), "-inf", cutoff, start=0, num=JobRegistry.PRUNE_BATCH)
+            if len(uids)==0:
+                return removed
+            records = self._client.mget([JobRegistry.job_key(self._decode(uid)) for uid in uids])
+
+            pipe = self._client.pipeline(transaction=False)
+            for uid, record in zip(uids, records):
+                uid = self._decode(uid)
+                pipe.zrem(JobRegistry.updated_key(), uid)
+                for status in JobRegistry.STATUSES:
+                    pipe.zrem(JobRegistry.status_key(status), uid)
+                pipe.delete(JobRegistry.job_key(uid))
+                if record is None:
+                    logger.debug("Registry record for %s has already expired, cannot remove it from the label indexes", uid)
+                    continue
+                try:
+                    for key in self._indexed_label_keys(JobState.from_json(record)):
+                        pipe.srem(key, uid)
+                except (KeyError, json.JSONDecodeError):
+                    pass
+            pipe.execute()
+            removed += len(uids)
+
+    def start_pruning(self, interval:float=3600):
+        """
+        prunes the registry every `interval` seconds on a background thread, until stop_pruning() is called
+        :param interval: number of seconds between prunes
+        :return: the thread
+        """
+        def prune_loop():
+            while not self._stop_pruning.wait(interval):
+                try:
+                    removed = self.prune()
+                    if removed > 0:
+                        logger.info("Removed {0} jobs older than {1}s from the registry".format(removed, self.retention_seconds))
+                except (redis.RedisError, ConnectionError) as e:
+                    logger.warning("Could not prune job registry: {0}".format(str(e)))
+
+        t = threading.Thread(target=prune_loop, name="JobRegistryPruner", daemon=True)
+        t.start()
+        return t
+
+    def stop_pruning(self):
+        self._stop_pruning.set()
+
+
+def parse_duration(spec:str)->float:
+    """
+    parses a duration like "90s", "15m", "1h" or "2d" into seconds. a plain number is taken as seconds
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*$', spec)
+    if match is None:
+        raise ValueError("Invalid duration '{0}', expected something like 30m, 1h or 2d".format(spec))
+    return float(match.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+
+
+def parse_labels(specs:list)->dict:
+    labels = {}
+    for spec in specs or []:
+        name, sep, value = spec.partition("=")
+        if sep=="":
+            raise ValueError("Invalid label '{0}', expected label=value".format(spec))
+        labels[name] = value
+    return labels
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Query the history of jobs that cdsreaper has seen")
+    parser.add_argument("--retention", type=parse_duration, default=None, help="retention period, as for REGISTRY_RETENTION_SECONDS")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    query_parser = subparsers.add_parser("query", help="find jobs by status, label and time")
+    query_parser.add_argument("--status", choices=JobRegistry.STATUSES, default=None)
+    query_parser.add_argument("--since", type=parse_duration, default=None, help="only jobs that changed status within this long, e.g. 1h")
+    query_parser.add_argument("--until", type=parse_duration, default=None, help="only jobs that changed status at least this long ago")
+    query_parser.add_argument("--label", action="append", help="label=value, can be given more than once")
+    query_parser.add_argument("--limit", type=int, default=100)
+    query_parser.add_argument("--json", action="store_true", help="output one json object per line")
+
+    subparsers.add_parser("prune", help="remove jobs older than the retention period")
+
+    args = parser.parse_args()
+    logging.basicConfig(format="{asctime} {name}|{funcName} [{levelname}] {message}", level=logging.WARNING, style='{')
+
+    client = redispool.get_client(os.getenv("REDIS_HOST"),
+                                  int(os.getenv("REDIS_PORT", 6379)),
+                                  int(os.getenv("REDIS_DB_NUM", 0)),
+                                  os.getenv("REDIS_PASS"))
+    retention = args.retention if args.retention is not None else int(os.getenv("REGISTRY_RETENTION_SECONDS", 7*24*3600))
+    registry = JobRegistry(client, retention_seconds=retention)
+
+    if args.command=="prune":
+        print("Removed {0} jobs".format(registry.prune()))
+        sys.exit(0)
+
+    now = time.time()
+    started = time.perf_counter()
+    try:
+        jobs = registry.find(status=args.status,
+                             since=now - args.since if args.since is not None else None,
+                             until=now - args.until if args.until is not None else None,
+                             labels=parse_labels(args.label),
+                             limit=args.limit)
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(2)
+    elapsed = time.perf_counter() - started
+
+    for job in jobs:
+        if args.json:
+            print(job.to_json())
+        else:
+            print("{0}  {1:<8} {2}  {3}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job.timestamp)),
+                                               job.status, job.uid, job.name))
+    print("{0} jobs in {1:.1f}ms".format(len(jobs), elapsed*1000), file=sys.stderr)
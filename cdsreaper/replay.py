@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+"""
+records job watch streams from a cluster, and replays them through JobWatcher to measure its throughput without one.
+
+    python replay.py record --namespace cds --output watch.jsonl.gz --duration 600
+    python replay.py synth --jobs 5000 --output synthetic.jsonl.gz
+    python replay.py bench watch.jsonl.gz [--decoder full] [--max-p99-ms 5] [--min-events-per-sec 2000]
+
+a recording is a gzipped file of the raw watch stream, one json event per line, exactly as the API server sent it.
+the replay uses a fake BatchV1Api that serves the recording, an in-memory MessageSender and a CheckpointingJournal and
+StatusCache on fakeredis, set up as cdsreaper does, so it measures the watch loop itself: decoding, status checks, message encoding and journalling.
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import fakeredis
+from kubernetes.client.models.v1_job_list import V1JobList
+from kubernetes.client.models.v1_list_meta import V1ListMeta
+
+from jobwatcher import JobWatcher
+from journal import Journal, CheckpointingJournal
+from leanjob import iter_resp_lines
+from logsetup import configure_logging
+from models import StatusCache
+from registry import JobRegistry
+from timeline import RouteTimeline
+
+logger = logging.getLogger(__name__)
+
+
+class RecordedResponse(object):
+    """
+    stands in for the urllib3 response of a watch request, yielding one recorded event per chunk
+    """
+    def __init__(self, lines:list, on_chunk=None, on_finished=None):
+        self._lines = lines
+        self._on_chunk = on_chunk
+        self._on_finished = on_finished
+
+    def read_chunked(self, decode_content=False):
+        for line in self._lines:
+            if self._on_chunk is not None:
+                self._on_chunk()
+            yield line + b"\n"
+        if self._on_finished is not None:
+            self._on_finished()
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class ReplayBatchV1Api(object):
+    """
+    fake BatchV1Api that answers watch requests with a recording, once, and list requests with an empty list
+    """
+    def __init__(self, lines:list, on_chunk=None, on_finished=None):
+        self._lines = lines
+        self._on_chunk = on_chunk
+        self._on_finished = on_finished
+        self._served = False
+
+    def list_namespaced_job(self, namespace, **kwargs):
+        """
+        the return type below is read by kubernetes.watch.Watch to decide what to deserialize events into
+
+        :return: V1JobList
+        """
+        if kwargs.get("watch"):
+            lines = [] if self._served else self._lines
+            self._served = True
+            return RecordedResponse(lines, self._on_chunk, self._on_finished)
+        if kwargs.get("_preload_content") is False:
+            return SimpleNamespace(data=b'{"metadata": {"resourceVersion": "1"}, "items": []}')
+        return V1JobList(items=[], metadata=V1ListMeta(resource_version="1"))
+
+
+class MemorySender(object):
+    """
+    MessageSender that encodes messages the same way, but keeps them in memory instead of sending them
+    """
+    def __init__(self):
+        self.messages = []
+
+    def notify(self, routing_key:str, msg_content:dict, on_confirm=None)->bool:
+        self.messages.append((routing_key, json.dumps(msg_content).encode(encoding="UTF-8")))
+        if on_confirm is not None:
+            on_confirm()
+        return True
+
+
+class ReplayResult(object):
+    def __init__(self, events:int, elapsed:float, latencies:list, allocations:list, messages:list, journalled):
+        self.events = events
+        self.elapsed = elapsed
+        self.latencies = sorted(latencies)
+        self.allocations = allocations
+        self.messages = messages
+        self.journalled = journalled
+
+    @property
+    def events_per_second(self)->float:
+        return self.events/self.elapsed if self.elapsed > 0 else 0
+
+    def latency_percentile(self, pct:float)->float:
+        """
+        :param pct: percentile, between 0 and 100
+        :return: latency in seconds
+        """
+        if len(self.latencies)==0:
+            return 0
+        index = min(int(len(self.latencies)*pct/100.0), len(self.latencies)-1)
+        return self.latencies[index]
+
+    @property
+    def mean_allocation(self)->float:
+        return sum(self.allocations)/len(self.allocations) if len(self.allocations)>0 else 0
+
+    def summary(self)->str:
+        return ("{0} events in {1:.3f}s: {2:.0f} events/sec, latency p50 {3:.1f}us p99 {4:.1f}us max {5:.1f}us, "
+                "{6:.0f} bytes allocated per event, {7} messages sent, journalled up to {8}").format(
+            self.events, self.elapsed, self.events_per_second,
+            self.latency_percentile(50)*1e6, self.latency_percentile(99)*1e6, self.latency_percentile(100)*1e6,
+            self.mean_allocation, len(self.messages), self.journalled)
+
+
+def load_recording(path:str)->list:
+    with gzip.open(path, "rb") as f:
+        return [line.rstrip(b"\n") for line in f if line.strip()!=b""]
+
+
+def replay(lines:list, lean_watch=True, use_status_cache=True, label_selector="app.kubernetes.io/managed-by=cdsresponder",
+           trace_allocations=False, batched_writes=True)->ReplayResult:
+    """
+    feeds a recorded watch stream through a JobWatcher
+    :param lines: raw watch events, as returned by load_recording
+    :param lean_watch: use the lean decoder rather than the kubernetes models
+    :param use_status_cache: give the watcher a StatusCache, as cdsreaper does
+    :param label_selector: label selector to give the watcher. This only affects whether jobs are filtered by name
+    :param trace_allocations: measure the memory allocated while handling each event. This makes everything else
+    much slower, so don't compare the timings from such a run
+    :param batched_writes: write job states along with journal checkpoints, as cdsreaper does. If false, every event
+    and job state is written to redis as it happens
+    :return: ReplayResult
+    """
+    latencies = []
+    allocations = []
+    chunk_started = [0.0, 0]
+
+    def on_chunk():
+        if trace_allocations:
+            tracemalloc.reset_peak()
+            chunk_started[1] = tracemalloc.get_traced_memory()[0]
+        chunk_started[0] = time.perf_counter()
+
+    client = fakeredis.FakeRedis()
+    if batched_writes:
+        # fakeredis does the work of the redis server in this process, so a checkpoint written in the background would
+        # hold the GIL and show up as latency on the watch thread, which a real server doesn't cause. the checkpoint is
+        # written once at the end instead, which is still counted in the throughput
+        journal = CheckpointingJournal(None, 0, 0, None, client=client, checkpoint_events=len(lines)+1,
+                                       checkpoint_interval_ms=3600*1000)
+        status_cache = StatusCache(client, max_entries=1000, batched=True, indexers=[JobRegistry(client), RouteTimeline(client)])
+        journal.attach_status_cache(status_cache)
+    else:
+        journal = Journal(None, 0, 0, None, client=client)
+        status_cache = StatusCache(client, max_entries=1000)
+    sender = MemorySender()
+    # the watcher is stopped once the recording has been read, rather than waiting for another watch request
+    api = ReplayBatchV1Api(lines, on_chunk=on_chunk, on_finished=lambda: watcher.stop())
+    watcher = JobWatcher(api, sender, journal, "replay",
+                         status_cache=status_cache if use_status_cache else None,
+                         lean_watch=lean_watch,
+                         label_selector=label_selector)
+
+    process_event = watcher._process_event
+
+    def timed_process_event(event):
+        # timed from the chunk arriving, so that decoding is included
+        process_event(event)
+        latencies.append(time.perf_counter() - chunk_started[0])
+        if trace_allocations:
+            allocations.append(tracemalloc.get_traced_memory()[1] - chunk_started[1])
+
+    watcher._process_event = timed_process_event
+
+    if trace_allocations:
+        tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        watcher.run()
+        if batched_writes:
+            journal.flush()
+        elapsed = time.perf_counter() - started
+    finally:
+        if trace_allocations:
+            tracemalloc.stop()
+
+    return ReplayResult(len(latencies), elapsed, latencies, allocations, sender.messages, journal.get_most_recent_event())
+
+
+def make_synthetic_job(index:int, resource_version:int, status:dict)->dict:
+    """
+    builds a job document shaped like the ones cdsresponder creates, including a realistic pod template, since the
+    size of that is most of the cost of decoding an event
+    """
+    name = "cds-synthetic-{0}".format(index)
+    return {
+        "kind": "Job",
+        "apiVersion": "batch/v1",
+        "metadata": {
+            "name": name,
+            "namespace": "replay",
+            "uid": "00000000-0000-0000-0000-{0:012d}".format(index),
+            "resourceVersion": str(resource_version),
+            "creationTimestamp": "2021-01-01T00:00:00Z",
+            "annotations": {"cdsresponder/upload-received": "1609459198.500"},
+            "labels": {"app.kubernetes.io/managed-by": "cdsresponder", "job-name": name, "cds-route": "synthetic-route",
+                       "deliverable-asset-id": str(index), "deliverable-bundle-id": str(index // 10),
+                       "online-id": "VX-{0}".format(index), "nearline-id": "None", "archive-id": "None"},
+        },
+        "spec": {
+            "parallelism": 1,
+            "completions": 1,
+            "backoffLimit": 3,
+            "selector": {"matchLabels": {"controller-uid": "00000000-0000-0000-0000-{0:012d}".format(index)}},
+            "template": {
+                "metadata": {"labels": {"job-name": name, "controller-uid": "00000000-0000-0000-0000-{0:012d}".format(index)}},
+                "spec": {
+                    "containers": [{
+                        "name": "cds",
+                        "image": "guardianmultimedia/cds-backend:latest",
+                        "command": ["/usr/local/bin/cds_run.pl", "--input-inmeta", "/data/inmeta/{0}.xml".format(name),
+                                    "--route", "synthetic-route"],
+                        "env": [{"name": "ENV_VAR_{0}".format(i), "value": "value-{0}".format(i)} for i in range(20)],
+                        "resources": {"limits": {"cpu": "1", "memory": "1Gi"}, "requests": {"cpu": "500m", "memory": "512Mi"}},
+                        "volumeMounts": [{"name": "vol-{0}".format(i), "mountPath": "/mnt/vol-{0}".format(i)} for i in range(6)],
+                        "terminationMessagePath": "/dev/termination-log",
+                        "terminationMessagePolicy": "File",
+                        "imagePullPolicy": "Always",
+                    }],
+                    "volumes": [{"name": "vol-{0}".format(i), "persistentVolumeClaim": {"claimName": "claim-{0}".format(i)}} for i in range(6)],
+                    "restartPolicy": "Never",
+                    "terminationGracePeriodSeconds": 30,
+                    "dnsPolicy": "ClusterFirst",
+                    "securityContext": {},
+                    "schedulerName": "default-scheduler",
+                },
+            },
+        },
+        "status": status,
+    }
+
+
+def synthesize(job_count:int, concurrency:int=50, seed:int=0)->list:
+    """
+    generates a watch stream for `job_count` jobs going through their lifecycles, with up to `concurrency` of them in
+    progress at once, and an occasional bookmark
+    :return: list of raw event lines
+    """
+    rand = random.Random(seed)
+    lines = []
+    resource_version = 1000
+    next_index = 0
+    in_progress = {}    # index -> list of remaining (type, status) steps
+
+    def lifecycle():
+        steps = [("ADDED", {}),
+                 ("MODIFIED", {"active": 1, "startTime": "2021-01-01T00:00:01Z"})]
+        if rand.random() < 0.1:
+            steps.append(("MODIFIED", {"active": 1, "failed": 1, "startTime": "2021-01-01T00:00:01Z"}))
+        if rand.random() < 0.05:
+            steps.append(("MODIFIED", {"failed": 4, "startTime": "2021-01-01T00:00:01Z",
+                                       "conditions": [{"type": "Failed", "status": "True", "reason": "BackoffLimitExceeded",
+                                                       "message": "Job has reached the specified backoff limit",
+                                                       "lastProbeTime": "2021-01-01T00:10:00Z",
+                                                       "lastTransitionTime": "2021-01-01T00:10:00Z"}]}))
+        else:
+            steps.append(("MODIFIED", {"succeeded": 1, "startTime": "2021-01-01T00:00:01Z",
+                                       "completionTime": "2021-01-01T00:10:00Z",
+                                       "conditions": [{"type": "Complete", "status": "True",
+                                                       "lastProbeTime": "2021-01-01T00:10:00Z",
+                                                       "lastTransitionTime": "2021-01-01T00:10:00Z"}]}))
+        steps.append(("DELETED", steps[-1][1]))
+        return steps
+
+    while next_index < job_count or len(in_progress)>0:
+        while next_index < job_count and len(in_progress) < concurrency:
+            in_progress[next_index] = lifecycle()
+            next_index += 1
+        index = rand.choice(list(in_progress.keys()))
+        event_type, status = in_progress[index].pop(0)
+        if len(in_progress[index])==0:
+            del in_progress[index]
+        resource_version += 1
+        lines.append(json.dumps({"type": event_type, "object": make_synthetic_job(index, resource_version, status)}).encode("UTF-8"))
+        if rand.random() < 0.01:
+            resource_version += 1
+            lines.append(json.dumps({"type": "BOOKMARK", "object": {"kind": "Job", "apiVersion": "batch/v1",
+                                                                    "metadata": {"resourceVersion": str(resource_version)}}}).encode("UTF-8"))
+    return lines
+
+
+def record(namespace:str, output:str, duration:int, label_selector:str=None, resource_version:str=None)->int:
+    """
+    records the raw watch stream of a namespace for `duration` seconds
+    :return: number of events recorded
+    """
+    import kubernetes
+    try:
+        kubernetes.config.load_incluster_config()
+    except kubernetes.config.config_exception.ConfigException:
+        kubernetes.config.load_kube_config()
+
+    args = {"watch": True, "_preload_content": False, "allow_watch_bookmarks": True, "timeout_seconds": duration}
+    if label_selector:
+        args["label_selector"] = label_selector
+    if resource_version is not None:
+        args["resource_version"] = resource_version
+    resp = kubernetes.client.BatchV1Api().list_namespaced_job(namespace, **args)
+    count = 0
+    try:
+        with gzip.open(output, "wb") as f:
+            for line in iter_resp_lines(resp):
+                f.write(line + b"\n")
+                count += 1
+    finally:
+        resp.close()
+        resp.release_conn()
+    return count
+
+
+def write_recording(lines:list, output:str):
+    with gzip.open(output, "wb") as f:
+        for line in lines:
+            f.write(line + b"\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record and replay job watch streams, to benchmark JobWatcher")
+    parser.add_argument("--log-level", default="WARNING", help="log level while replaying. Default WARNING, since logging is part of what is measured")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="record a namespace's job watch stream from the cluster")
+    record_parser.add_argument("--namespace", required=True)
+    record_parser.add_argument("--output", required=True)
+    record_parser.add_argument("--duration", type=int, default=600, help="seconds to record for")
+    record_parser.add_argument("--label-selector", default="app.kubernetes.io/managed-by=cdsresponder")
+    record_parser.add_argument("--resource-version", default=None, help="start from this resource version rather than the current state")
+
+    synth_parser = subparsers.add_parser("synth", help="generate a synthetic watch stream")
+    synth_parser.add_argument("--jobs", type=int, default=5000)
+    synth_parser.add_argument("--concurrency", type=int, default=50)
+    synth_parser.add_argument("--seed", type=int, default=0)
+    synth_parser.add_argument("--output", required=True)
+
+    bench_parser = subparsers.add_parser("bench", help="replay a recording through JobWatcher and report its performance")
+    bench_parser.add_argument("recording")
+    bench_parser.add_argument("--decoder", choices=["lean", "full"], default="lean")
+    bench_parser.add_argument("--no-status-cache", action="store_true")
+    bench_parser.add_argument("--unbatched", action="store_true", help="write each event and job state to redis as it happens")
+    bench_parser.add_argument("--repeat", type=int, default=3, help="number of timed runs, the best is reported")
+    bench_parser.add_argument("--min-events-per-sec", type=float, default=None, help="fail if throughput is lower than this")
+    bench_parser.add_argument("--max-p99-ms", type=float, default=None, help="fail if p99 latency is higher than this")
+    bench_parser.add_argument("--max-bytes-per-event", type=float, default=None, help="fail if mean allocation per event is higher than this")
+
+    args = parser.parse_args()
+    # LOG_FORMAT and LOG_SAMPLE_RATES are honoured, so that their cost can be benchmarked too
+    configure_logging(dict(os.environ, LOG_LEVEL=args.log_level))
+
+    if args.command=="record":
+        recorded = record(args.namespace, args.output, args.duration, args.label_selector, args.resource_version)
+        print("Recorded {0} events to {1}".format(recorded, args.output))
+    elif args.command=="synth":
+        generated = synthesize(args.jobs, args.concurrency, args.seed)
+        write_recording(generated, args.output)
+        print("Wrote {0} events for {1} jobs to {2}".format(len(generated), args.jobs, args.output))
+    else:
+        recording = load_recording(args.recording)
+        lean = args.decoder=="lean"
+        runs = [replay(recording, lean_watch=lean, use_status_cache=not args.no_status_cache,
+                       batched_writes=not args.unbatched) for _ in range(args.repeat)]
+        best = max(runs, key=lambda r: r.events_per_second)
+        traced = replay(recording, lean_watch=lean, use_status_cache=not args.no_status_cache, trace_allocations=True,
+                        batched_writes=not args.unbatched)
+        best.allocations = traced.allocations
+        print(best.summary())
+
+        failures = []
+        if args.min_events_per_sec is not None and best.events_per_second < args.min_events_per_sec:
+            failures.append("throughput {0:.0f} events/sec is below {1}".format(best.events_per_second, args.min_events_per_sec))
+        if args.max_p99_ms is not None and best.latency_percentile(99)*1000 > args.max_p99_ms:
+            failures.append("p99 latency {0:.3f}ms is above {1}ms".format(best.latency_percentile(99)*1000, args.max_p99_ms))
+        if args.max_bytes_per_event is not None and best.mean_allocation > args.max_bytes_per_event:
+            failures.append("{0:.0f} bytes allocated per event is above {1}".format(best.mean_allocation, args.max_bytes_per_event))
+        for f in failures:
+            print("FAILED: {0}".format(f))
+        sys.exit(1 if len(failures)>0 else 0)
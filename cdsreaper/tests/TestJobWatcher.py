@@ -107,4 +107,495 @@ class TestJobWatcher(TestCase):
             "failure-reason": "it hit the ground falling - it went splat"
         }
         mock_sender.notify.assert_called_once_with("cds.job.failed", expected_content)
-        self.assertTrue(result)
\ No newline at end of file
+        self.assertTrue(result)
+
+    @staticmethod
+    def make_running_job():
+        fake_job = MagicMock(target=V1Job)
+        fake_job.metadata = MagicMock()
+        fake_job.metadata.uid = "some-uid"
+        fake_job.metadata.name = "job-name"
+        fake_job.metadata.namespace = "some-namespace"
+        fake_job.status = V1JobStatus(active=1, start_time=datetime.now(), conditions=None, failed=None, succeeded=None)
+        return fake_job
+
+    def test_check_job_on_confirm(self):
+        """
+        check_job should pass an on_confirm callback through to the sender if one is given
+        :return:
+        """
+        from messagesender import PipelinedMessageSender
+        from journal import Journal
+        fake_job = self.make_running_job()
+        fake_job.status = V1JobStatus(active=0, completion_time=datetime.now(), conditions=None, failed=None,succeeded=1)
+
+        mock_sender = MagicMock(target=PipelinedMessageSender)
+        mock_sender.notify = MagicMock(return_value=True)
+        on_confirm = MagicMock()
+
+        w = JobWatcher(MagicMock(target=BatchV1Api), mock_sender, MagicMock(target=Journal), "some-namespace")
+        w.check_job(fake_job, on_confirm=on_confirm)
+
+        self.assertEqual(mock_sender.notify.call_args[1]["on_confirm"], on_confirm)
+
+    def test_check_job_stopped(self):
+        """
+        check_job should not notify anything once the watcher has been stopped, e.g. because leadership was lost
+        :return:
+        """
+        from messagesender import MessageSender
+        from journal import Journal
+        mock_sender = MagicMock(target=MessageSender)
+        on_confirm = MagicMock()
+        w = JobWatcher(MagicMock(target=BatchV1Api), mock_sender, MagicMock(target=Journal), "some-namespace")
+        w.stop()
+        self.assertFalse(w.check_job(self.make_running_job(), on_confirm=on_confirm))
+        mock_sender.notify.assert_not_called()
+        on_confirm.assert_not_called()
+
+    def test_check_job_dedup(self):
+        """
+        check_job should not send a second message if the status of the job has not changed
+        :return:
+        """
+        from messagesender import MessageSender
+        from journal import Journal
+        from models import StatusCache
+
+        mock_sender = MagicMock(target=MessageSender)
+        mock_sender.notify = MagicMock(return_value=True)
+        w = JobWatcher(MagicMock(target=BatchV1Api), mock_sender, MagicMock(target=Journal), "some-namespace",
+                       status_cache=StatusCache())
+
+        self.assertTrue(w.check_job(self.make_running_job()))
+        self.assertTrue(w.check_job(self.make_running_job()))
+        mock_sender.notify.assert_called_once()
+        self.assertEqual(mock_sender.notify.call_args[0][0], "cds.job.running")
+
+        finished_job = self.make_running_job()
+        finished_job.status = V1JobStatus(active=0, completion_time=datetime.now(), conditions=None, failed=None,succeeded=1)
+        w.check_job(finished_job)
+        self.assertEqual(mock_sender.notify.call_count, 2)
+        self.assertEqual(mock_sender.notify.call_args[0][0], "cds.job.success")
+
+    def test_check_job_debounce(self):
+        """
+        check_job should ignore a change to a non-terminal status within the debounce window, but not a terminal one
+        :return:
+        """
+        from messagesender import MessageSender
+        from journal import Journal
+        from models import StatusCache, JobState
+        import time
+
+        mock_sender = MagicMock(target=MessageSender)
+        mock_sender.notify = MagicMock(return_value=True)
+        cache = StatusCache()
+        cache.put(JobState("some-uid", "job-name", "retry", time.time()))
+        w = JobWatcher(MagicMock(target=BatchV1Api), mock_sender, MagicMock(target=Journal), "some-namespace",
+                       status_cache=cache, debounce_seconds=30)
+
+        w.check_job(self.make_running_job())
+        mock_sender.notify.assert_not_called()
+        self.assertEqual(cache.get("some-uid").status, "retry")
+
+        finished_job = self.make_running_job()
+        finished_job.status = V1JobStatus(active=0, completion_time=datetime.now(), conditions=None, failed=None,succeeded=1)
+        w.check_job(finished_job)
+        mock_sender.notify.assert_called_once()
+
+    def test_check_job_dedup_confirms(self):
+        """
+        if check_job does not need to send a message it should call on_confirm straight away, and if it does it should
+        only store the new state once the message is confirmed
+        :return:
+        """
+        from messagesender import PipelinedMessageSender
+        from journal import Journal
+        from models import StatusCache
+
+        mock_sender = MagicMock(target=PipelinedMessageSender)
+        mock_sender.notify = MagicMock(return_value=True)
+        cache = StatusCache()
+        cache.persist = MagicMock()
+        w = JobWatcher(MagicMock(target=BatchV1Api), mock_sender, MagicMock(target=Journal), "some-namespace",
+                       status_cache=cache)
+
+        first_confirm = MagicMock()
+        w.check_job(self.make_running_job(), on_confirm=first_confirm)
+        first_confirm.assert_not_called()
+        cache.persist.assert_not_called()
+        mock_sender.notify.call_args[1]["on_confirm"]()
+        first_confirm.assert_called_once_with()
+        cache.persist.assert_called_once()
+
+        second_confirm = MagicMock()
+        w.check_job(self.make_running_job(), on_confirm=second_confirm)
+        second_confirm.assert_called_once_with()
+        mock_sender.notify.assert_called_once()
+
+    @staticmethod
+    def make_mock_watch(watcher:JobWatcher, streams:list, resource_version=None):
+        """
+        builds a mock kubernetes Watch that yields each of the given lists of events from successive stream() calls,
+        then stops the watcher. Items in the lists that are exceptions are raised instead of yielded.
+        """
+        remaining = list(streams)
+        mock_watch = MagicMock()
+        mock_watch.resource_version = resource_version
+
+        def fake_stream(*args, **kwargs):
+            events = remaining.pop(0)
+            is_last = len(remaining)==0
+            try:
+                for e in events:
+                    if isinstance(e, Exception):
+                        raise e
+                    yield e
+            finally:
+                if is_last:
+                    watcher.stop()
+
+        mock_watch.stream = MagicMock(side_effect=fake_stream)
+        return mock_watch
+
+    def test_watcher_label_selector(self):
+        """
+        _watcher should pass the label selector to the cluster and not filter jobs by name if one is set
+        :return:
+        """
+        from messagesender import MessageSender
+        from journal import Journal
+        job = MagicMock(spec=V1Job)
+        job.metadata = MagicMock()
+        job.metadata.name = "job-name"
+        job.metadata.resource_version = "1235"
+        mock_journal = MagicMock(target=Journal)
+        mock_journal.get_most_recent_event = MagicMock(return_value=1234)
+        mock_sender = MagicMock(target=MessageSender)
+        mock_api = MagicMock(target=BatchV1Api)
+
+        w = JobWatcher(mock_api, mock_sender, mock_journal, "some-namespace", label_selector="app.kubernetes.io/managed-by=cdsresponder")
+        w.check_job = MagicMock(return_value=True)
+        mock_watch = self.make_mock_watch(w, [[{"type": "MODIFIED", "object": job}]])
+        with patch("jobwatcher.StrictWatch", return_value=mock_watch):
+            w._watcher()
+
+        mock_watch.stream.assert_called_once_with(mock_api.list_namespaced_job, "some-namespace", resource_version=1234,
+                                                  allow_watch_bookmarks=True, timeout_seconds=300,
+                                                  label_selector="app.kubernetes.io/managed-by=cdsresponder")
+        w.check_job.assert_called_once_with(job)
+        mock_journal.record_processed.assert_called_once_with("1235")
+
+    def test_watcher_no_label_selector(self):
+        """
+        _watcher should ignore jobs whose name does not start with cds- if there is no label selector
+        :return:
+        """
+        from messagesender import MessageSender
+        from journal import Journal
+        job = MagicMock(spec=V1Job)
+        job.metadata = MagicMock()
+        job.metadata.name = "job-name"
+        mock_journal = MagicMock(target=Journal)
+        mock_journal.get_most_recent_event = MagicMock(return_value=1234)
+
+        w = JobWatcher(MagicMock(target=BatchV1Api), MagicMock(target=MessageSender), mock_journal, "some-namespace")
+        w.check_job = MagicMock(return_value=True)
+        mock_watch = self.make_mock_watch(w, [[{"type": "MODIFIED", "object": job}]])
+        with patch("jobwatcher.StrictWatch", return_value=mock_watch):
+            w._watcher()
+
+        w.check_job.assert_not_called()
+
+    def test_watcher_stop(self):
+        """
+        _watcher should not process any more events from the stream once stop() has been called
+        :return:
+        """
+        from messagesender import MessageSender
+        from journal import Journal
+        first = MagicMock(spec=V1Job)
+        first.metadata = MagicMock()
+        first.metadata.name = "cds-first"
+        first.metadata.resource_version = "1235"
+        second = MagicMock(spec=V1Job)
+        second.metadata = MagicMock()
+        second.metadata.name = "cds-second"
+        mock_journal = MagicMock(target=Journal)
+        mock_journal.get_most_recent_event = MagicMock(return_value=1234)
+
+        w = JobWatcher(MagicMock(target=BatchV1Api), MagicMock(target=MessageSender), mock_journal, "some-namespace")
+        w.check_job = MagicMock(side_effect=lambda job: w.stop())
+        mock_watch = self.make_mock_watch(w, [[{"type": "MODIFIED", "object": first}, {"type": "MODIFIED", "object": second}]])
+        with patch("jobwatcher.StrictWatch", return_value=mock_watch):
+            w._watcher()
+
+        w.check_job.assert_called_once_with(first)
+        mock_journal.record_processed.assert_called_once_with("1235")
+
+    def test_watcher_resumes(self):
+        """
+        _watcher should start a new watch from the most recent resource version when the server ends the previous one,
+        or the connection drops part way through, and journal bookmarks
+        :return:
+        """
+        from messagesender import MessageSender
+        from journal import Journal
+        import urllib3.exceptions
+        bookmark = MagicMock(spec=V1Job)
+        bookmark.metadata = MagicMock()
+        bookmark.metadata.resource_version = "2000"
+        job = MagicMock(spec=V1Job)
+        job.metadata = MagicMock()
+        job.metadata.name = "cds-job"
+        job.metadata.resource_version = "2001"
+        mock_journal = MagicMock(target=Journal)
+        mock_journal.get_most_recent_event = MagicMock(return_value=1234)
+        mock_api = MagicMock(target=BatchV1Api)
+
+        w = JobWatcher(mock_api, MagicMock(target=MessageSender), mock_journal, "some-namespace", watch_timeout=10)
+        w.check_job = MagicMock(return_value=True)
+        mock_watch = self.make_mock_watch(w, [
+            [{"type": "BOOKMARK", "object": bookmark}],
+            [{"type": "MODIFIED", "object": job}, urllib3.exceptions.ProtocolError("connection broken")],
+            [],
+        ])
+        with patch("jobwatcher.StrictWatch", return_value=mock_watch):
+            w._watcher()
+
+        self.assertEqual(mock_watch.stream.call_count, 3)
+        self.assertEqual(mock_watch.stream.call_args_list[0][1]["resource_version"], 1234)
+        self.assertEqual(mock_watch.stream.call_args_list[1][1]["resource_version"], "2000")
+        # the retry carries on after the last event handled, not from where the broken request started
+        self.assertEqual(mock_watch.stream.call_args_list[2][1]["resource_version"], "2001")
+        self.assertEqual(mock_watch.stream.call_args_list[0][1]["timeout_seconds"], 10)
+        w.check_job.assert_called_once_with(job)
+        self.assertEqual([c[0][0] for c in mock_journal.record_processed.call_args_list], ["2000", "2001"])
+        mock_api.list_namespaced_job.assert_not_called()
+
+    def test_watcher_gone(self):
+        """
+        _watcher should restart from the current cluster resource version if the server says that ours is too old
+        :return:
+        """
+        from messagesender import MessageSender
+        from journal import Journal
+        import kubernetes.client.exceptions
+        mock_journal = MagicMock(target=Journal)
+        mock_journal.get_most_recent_event = MagicMock(side_effect=[1234, None])
+        mock_api = MagicMock(target=BatchV1Api)
+        mock_api.list_namespaced_job = MagicMock(return_value=MagicMock(items=[], metadata=MagicMock(resource_version="5000")))
+
+        w = JobWatcher(mock_api, MagicMock(target=MessageSender), mock_journal, "some-namespace")
+        mock_watch = self.make_mock_watch(w, [
+            [kubernetes.client.exceptions.ApiException(status=410)],
+            [],
+        ])
+        with patch("jobwatcher.StrictWatch", return_value=mock_watch):
+            w._watcher()
+
+        mock_journal.clear_journal.assert_called_once()
+        self.assertEqual(mock_watch.stream.call_args_list[1][1]["resource_version"], "5000")
+
+    def test_reconcile_on_gone(self):
+        """
+        on a 410 Gone, _watcher should page through the job list, notify any jobs whose status has changed since the
+        last notification, forget jobs that no longer exist, and resume watching from the list's resource version
+        :return:
+        """
+        from messagesender import MessageSender
+        from journal import Journal
+        from models import StatusCache, JobState
+        from kubernetes.client.models.v1_job_list import V1JobList
+        from kubernetes.client.models.v1_list_meta import V1ListMeta
+        import kubernetes.client.exceptions
+
+        def make_job(uid, status):
+            return V1Job(metadata=V1ObjectMeta(uid=uid, name="cds-" + uid, namespace="some-namespace"), status=status)
+
+        finished = make_job("finished-uid", V1JobStatus(active=0, succeeded=1, start_time=datetime.now()))
+        unchanged = make_job("running-uid", V1JobStatus(active=1, start_time=datetime.now()))
+        mock_api = MagicMock(target=BatchV1Api)
+        mock_api.list_namespaced_job = MagicMock(side_effect=[
+            V1JobList(items=[finished], metadata=V1ListMeta(resource_version="9000", _continue="page-2")),
+            V1JobList(items=[unchanged], metadata=V1ListMeta(resource_version="9000")),
+        ])
+        cache = StatusCache()
+        cache.put(JobState("finished-uid", "cds-finished-uid", "running", 1))
+        cache.put(JobState("running-uid", "cds-running-uid", "running", 1))
+        cache.put(JobState("deleted-uid", "cds-deleted-uid", "success", 1))
+        mock_sender = MagicMock(target=MessageSender)
+        mock_sender.notify = MagicMock(return_value=True)
+        mock_journal = MagicMock(target=Journal)
+        mock_journal.get_most_recent_event = MagicMock(return_value=1234)
+
+        w = JobWatcher(mock_api, mock_sender, mock_journal, "some-namespace", status_cache=cache, relist_page_size=1)
+        mock_watch = self.make_mock_watch(w, [
+            [kubernetes.client.exceptions.ApiException(status=410)],
+            [],
+        ])
+        with patch("jobwatcher.StrictWatch", return_value=mock_watch):
+            w._watcher()
+
+        mock_sender.notify.assert_called_once()
+        self.assertEqual(mock_sender.notify.call_args[0][0], "cds.job.success")
+        self.assertEqual(mock_sender.notify.call_args[0][1]["job-id"], "finished-uid")
+        self.assertEqual(mock_api.list_namespaced_job.call_args_list[1][1]["_continue"], "page-2")
+        self.assertEqual(mock_api.list_namespaced_job.call_args_list[1][1]["limit"], 1)
+        self.assertIsNone(cache.get("deleted-uid"))
+        mock_journal.clear_journal.assert_not_called()
+        mock_journal.record_processed.assert_called_once_with("9000")
+        self.assertEqual(mock_watch.stream.call_args_list[1][1]["resource_version"], "9000")
+
+    def test_reconcile_on_gone_full_decoder(self):
+        """
+        with the full decoder, a 410 ERROR event from the server should lead to a re-list and a watch from the list's
+        resource version, rather than another watch from the expired one. This runs a real kubernetes Watch over a
+        fake HTTP response
+        :return:
+        """
+        import json
+        from messagesender import MessageSender
+        from journal import Journal
+        from models import StatusCache, JobState
+        from kubernetes.client.models.v1_job_list import V1JobList
+        from kubernetes.client.models.v1_list_meta import V1ListMeta
+
+        class FakeResponse(object):
+            def __init__(self, events):
+                self._chunks = [(json.dumps(e) + "\n").encode("UTF-8") for e in events]
+                self.close = MagicMock()
+                self.release_conn = MagicMock()
+
+            def read_chunked(self, decode_content=False):
+                return iter(self._chunks)
+
+        finished = V1Job(metadata=V1ObjectMeta(uid="finished-uid", name="cds-finished-uid", namespace="some-namespace"),
+                         status=V1JobStatus(active=0, succeeded=1, start_time=datetime.now()))
+        calls = []
+
+        def fake_call_api(resource_path, method, path_params, query_params, *args, **kwargs):
+            params = dict(query_params)
+            calls.append(params)
+            if not params.get("watch"):
+                return V1JobList(items=[finished], metadata=V1ListMeta(resource_version="9000"))
+            if len(calls)==1:
+                return FakeResponse([{"type": "ERROR", "object": {"kind": "Status", "code": 410, "reason": "Expired",
+                                                                  "message": "too old resource version: 100"}}])
+            # the second watch ends the test, whether or not it is from the right version
+            w.stop()
+            return FakeResponse([])
+
+        api_client = MagicMock()
+        api_client.call_api = MagicMock(side_effect=fake_call_api)
+        cache = StatusCache()
+        cache.put(JobState("finished-uid", "cds-finished-uid", "running", 1))
+        mock_sender = MagicMock(target=MessageSender)
+        mock_sender.notify = MagicMock(return_value=True)
+        mock_journal = MagicMock(target=Journal)
+        mock_journal.get_most_recent_event = MagicMock(return_value="100")
+
+        w = JobWatcher(BatchV1Api(api_client), mock_sender, mock_journal, "some-namespace", status_cache=cache, lean_watch=False)
+        w._watcher()
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(calls[0]["resourceVersion"], "100")
+        self.assertNotIn("watch", calls[1])
+        self.assertEqual(calls[1]["limit"], 500)
+        self.assertEqual(calls[2]["resourceVersion"], "9000")
+        mock_sender.notify.assert_called_once()
+        self.assertEqual(mock_sender.notify.call_args[0][0], "cds.job.success")
+        mock_journal.record_processed.assert_called_once_with("9000")
+
+    def test_reconcile_expired_records(self):
+        """
+        a re-list should not notify or index a finished job whose record has expired, but should still notify one that
+        finished recently without our having seen it
+        :return:
+        """
+        from messagesender import MessageSender
+        from journal import Journal
+        from models import StatusCache
+        from kubernetes.client.models.v1_job_list import V1JobList
+        from kubernetes.client.models.v1_list_meta import V1ListMeta
+        from datetime import timezone
+
+        long_ago = self.make_running_job()
+        long_ago.metadata.uid = "kept-uid"
+        long_ago.status = V1JobStatus(active=0, succeeded=1, start_time=datetime.now(timezone.utc) - timedelta(days=9),
+                                      completion_time=datetime.now(timezone.utc) - timedelta(days=8))
+        recent = self.make_running_job()
+        recent.metadata.uid = "recent-uid"
+        recent.metadata.labels = {}
+        recent.metadata.annotations = None
+        recent.metadata.creation_timestamp = None
+        recent.status = V1JobStatus(active=0, succeeded=1, start_time=datetime.now(timezone.utc) - timedelta(minutes=9),
+                                    completion_time=datetime.now(timezone.utc) - timedelta(minutes=8))
+        mock_api = MagicMock(target=BatchV1Api)
+        mock_api.list_namespaced_job = MagicMock(return_value=V1JobList(items=[long_ago, recent], metadata=V1ListMeta(resource_version="9000")))
+        mock_sender = MagicMock(target=MessageSender)
+        mock_sender.notify = MagicMock(return_value=True)
+        indexer = MagicMock()
+        cache = StatusCache(MagicMock(), indexers=[indexer])
+        cache.get = MagicMock(return_value=None)
+        cache.known_uids = MagicMock(return_value=set())
+
+        w = JobWatcher(mock_api, mock_sender, MagicMock(target=Journal), "some-namespace", status_cache=cache,
+                       label_selector="app.kubernetes.io/managed-by=cdsresponder", finished_record_ttl=7*24*3600)
+        w._reconcile()
+
+        mock_sender.notify.assert_called_once()
+        self.assertEqual(mock_sender.notify.call_args[0][1]["job-id"], "recent-uid")
+        self.assertEqual(indexer.index.call_count, 1)
+        self.assertEqual(indexer.index.call_args[0][1].uid, "recent-uid")
+
+    def test_reconcile_sharded_namespaces(self):
+        """
+        when each namespace's status cache has its own key prefix, a re-list of one namespace should only forget that
+        namespace's vanished jobs and leave the other namespace's records alone
+        :return:
+        """
+        import fakeredis
+        from messagesender import MessageSender
+        from journal import Journal
+        from models import StatusCache, JobState
+        from kubernetes.client.models.v1_job_list import V1JobList
+        from kubernetes.client.models.v1_list_meta import V1ListMeta
+
+        client = fakeredis.FakeRedis()
+        cache_a = StatusCache(client, key_prefix="cds:job:namespace-a")
+        cache_b = StatusCache(client, key_prefix="cds:job:namespace-b")
+        cache_a.put(JobState("deleted-uid", "cds-deleted-uid", "success", 1))
+        cache_b.put(JobState("other-uid", "cds-other-uid", "running", 1))
+        self.assertEqual(cache_b.known_uids(), {"other-uid"})
+
+        mock_api = MagicMock(target=BatchV1Api)
+        mock_api.list_namespaced_job = MagicMock(return_value=V1JobList(items=[], metadata=V1ListMeta(resource_version="9000")))
+        w = JobWatcher(mock_api, MagicMock(target=MessageSender), MagicMock(target=Journal), "namespace-a", status_cache=cache_a)
+        self.assertEqual(w._reconcile(), "9000")
+
+        self.assertIsNone(client.get("cds:job:namespace-a:deleted-uid"))
+        self.assertIsNotNone(client.get("cds:job:namespace-b:other-uid"))
+        self.assertEqual(StatusCache(client, key_prefix="cds:job:namespace-b").get("other-uid").status, "running")
+
+    def test_initial_resource_version(self):
+        """
+        if there is no journal, _initial_resource_version should ask the cluster for a single job to get the current
+        resource version, rather than listing everything
+        :return:
+        """
+        from messagesender import MessageSender
+        from journal import Journal
+        from leanjob import LeanJob
+        mock_journal = MagicMock(target=Journal)
+        mock_journal.get_most_recent_event = MagicMock(return_value=None)
+        mock_api = MagicMock(target=BatchV1Api)
+        mock_api.list_namespaced_job = MagicMock(return_value=MagicMock(data=b"""{"kind":"JobList","metadata":{"resourceVersion":"7777","continue":"more"},"items":[{"metadata":{"name":"cds-one"}}]}"""))
+
+        w = JobWatcher(mock_api, MagicMock(target=MessageSender), mock_journal, "some-namespace",
+                       lean_watch=True, label_selector="app.kubernetes.io/managed-by=cdsresponder")
+        result = w._initial_resource_version()
+        self.assertEqual(result, "7777")
+        mock_api.list_namespaced_job.assert_called_once_with("some-namespace", _preload_content=False, limit=1,
+                                                             label_selector="app.kubernetes.io/managed-by=cdsresponder")
@@ -13,10 +13,10 @@ class TestJournal(TestCase):
         mock_client = MagicMock(target=redis.Redis)
         mock_client.ping = MagicMock()
 
-        with patch("redis.Redis", return_value=mock_client) as mock_constructor:
+        with patch("redispool.get_client", return_value=mock_client) as mock_constructor:
             from journal import Journal
             j = Journal("somehost",6379, 1, "somepassword",1)
-            mock_constructor.assert_called_once_with("somehost", 6379,1,password="somepassword")
+            mock_constructor.assert_called_once_with("somehost", 6379,1,"somepassword")
             mock_client.ping.assert_called_once()
 
     def test_setup_ping_failed(self):
@@ -28,11 +28,11 @@ class TestJournal(TestCase):
         mock_client = MagicMock(target=redis.Redis)
         mock_client.ping = MagicMock(side_effect=ConnectionError)
 
-        with patch("redis.Redis", return_value=mock_client) as mock_constructor:
+        with patch("redispool.get_client", return_value=mock_client) as mock_constructor:
             from journal import Journal
             with self.assertRaises(ConnectionError):
                 j = Journal("somehost",6379, 1, "somepassword",2)
-            mock_constructor.assert_called_with("somehost", 6379,1,password="somepassword")
+            mock_constructor.assert_called_with("somehost", 6379,1,"somepassword")
             self.assertEqual(mock_client.ping.call_count, 2)
             self.assertEqual(mock_constructor.call_count, 2)
 
@@ -48,7 +48,7 @@ class TestJournal(TestCase):
         mock_client.get = MagicMock(return_value="123456")
         mock_client.delete = MagicMock()
 
-        with patch("redis.Redis", return_value=mock_client) as mock_constructor:
+        with patch("redispool.get_client", return_value=mock_client) as mock_constructor:
             from journal import Journal
             j = Journal("somehost",6379, 1, "somepassword",1)
             result = j.get_most_recent_event()
@@ -67,7 +67,7 @@ class TestJournal(TestCase):
         mock_client.get = MagicMock(return_value=None)
         mock_client.delete = MagicMock()
 
-        with patch("redis.Redis", return_value=mock_client) as mock_constructor:
+        with patch("redispool.get_client", return_value=mock_client) as mock_constructor:
             from journal import Journal
             j = Journal("somehost",6379, 1, "somepassword",1)
             result = j.get_most_recent_event()
@@ -86,7 +86,7 @@ class TestJournal(TestCase):
         mock_client.get = MagicMock(return_value="abcde")
         mock_client.delete = MagicMock()
 
-        with patch("redis.Redis", return_value=mock_client) as mock_constructor:
+        with patch("redispool.get_client", return_value=mock_client) as mock_constructor:
             from journal import Journal
             j = Journal("somehost", 6379, 1, "somepassword",1)
             result = j.get_most_recent_event()
@@ -105,7 +105,7 @@ class TestJournal(TestCase):
         mock_client.set = MagicMock()
         mock_client.delete = MagicMock()
 
-        with patch("redis.Redis", return_value=mock_client) as mock_constructor:
+        with patch("redispool.get_client", return_value=mock_client) as mock_constructor:
             from journal import Journal
             j = Journal("somehost",6379, 1, "somepassword",1)
             j.record_processed(5678)
@@ -123,8 +123,226 @@ class TestJournal(TestCase):
         mock_client.set = MagicMock()
         mock_client.delete = MagicMock()
 
-        with patch("redis.Redis", return_value=mock_client) as mock_constructor:
+        with patch("redispool.get_client", return_value=mock_client) as mock_constructor:
             from journal import Journal
             j = Journal("somehost",6379, 1, "somepassword",1)
             j.clear_journal()
-            mock_client.delete.assert_called_once_with(Journal.EVENT_KEY)
\ No newline at end of file
+            mock_client.delete.assert_called_once_with(Journal.EVENT_KEY)
+
+    def test_event_key(self):
+        """
+        Journal should read and write the event key that it is given, if one is given
+        :return:
+        """
+        import redis
+        mock_client = MagicMock(target=redis.Redis)
+        mock_client.ping = MagicMock()
+        mock_client.get = MagicMock(return_value=b"1234")
+
+        with patch("redispool.get_client", return_value=mock_client) as mock_constructor:
+            from journal import Journal
+            j = Journal("somehost",6379, 1, "somepassword",1, event_key="cdsreaper:most-recent-event:ns1")
+            self.assertEqual(j.get_most_recent_event(), 1234)
+            j.record_processed(5678)
+            mock_client.get.assert_called_once_with("cdsreaper:most-recent-event:ns1")
+            mock_client.set.assert_called_once_with("cdsreaper:most-recent-event:ns1", 5678)
+
+class TestConfirmedEventTracker(TestCase):
+    def test_advance_in_order(self):
+        """
+        the tracker should only journal an event once it and every event before it have been confirmed
+        :return:
+        """
+        from journal import Journal, ConfirmedEventTracker
+        mock_journal = MagicMock(target=Journal)
+        t = ConfirmedEventTracker(mock_journal)
+        t.add(1)
+        t.add(2)
+        t.add(3)
+
+        t.confirm(2)
+        mock_journal.record_processed.assert_not_called()
+        t.confirm(1)
+        mock_journal.record_processed.assert_called_once_with(2)
+        t.confirm(3)
+        mock_journal.record_processed.assert_called_with(3)
+        self.assertEqual(t.pending_count(), 0)
+
+    def test_no_messages(self):
+        """
+        an event that sent no messages should count as confirmed straight away
+        :return:
+        """
+        from journal import Journal, ConfirmedEventTracker
+        mock_journal = MagicMock(target=Journal)
+        t = ConfirmedEventTracker(mock_journal)
+        t.add(1, message_count=0)
+        mock_journal.record_processed.assert_called_once_with(1)
+
+
+class TestCheckpointingJournal(TestCase):
+    def make_journal(self, mock_client, **kwargs):
+        with patch("redispool.get_client", return_value=mock_client):
+            from journal import CheckpointingJournal
+            return CheckpointingJournal("somehost", 6379, 1, "somepassword", 1, **kwargs)
+
+    def test_record_processed_coalesces(self):
+        """
+        record_processed should not write to redis until the checkpoint is due, and should then write only the highest id
+        :return:
+        """
+        import redis
+        from journal import Journal
+        mock_client = MagicMock(target=redis.Redis)
+        j = self.make_journal(mock_client, checkpoint_events=3, checkpoint_interval_ms=60000)
+
+        j.record_processed(100)
+        j.record_processed("102")
+        mock_client.set.assert_not_called()
+        j.record_processed(101)
+        j._writer.join(0.5)
+        mock_client.set.assert_called_once_with(Journal.EVENT_KEY, 102)
+
+    def test_flush(self):
+        """
+        flush should write the current checkpoint immediately, and do nothing if there is nothing new
+        :return:
+        """
+        import redis
+        from journal import Journal
+        mock_client = MagicMock(target=redis.Redis)
+        j = self.make_journal(mock_client, checkpoint_events=100, checkpoint_interval_ms=60000)
+
+        j.record_processed(1234)
+        j.flush()
+        mock_client.set.assert_called_once_with(Journal.EVENT_KEY, 1234)
+        j.flush()
+        mock_client.set.assert_called_once_with(Journal.EVENT_KEY, 1234)
+
+    def test_interval(self):
+        """
+        the checkpoint should be written when the interval expires even if not enough events have been seen
+        :return:
+        """
+        import redis
+        from journal import Journal
+        mock_client = MagicMock(target=redis.Redis)
+        j = self.make_journal(mock_client, checkpoint_events=100, checkpoint_interval_ms=50)
+
+        j.record_processed(1234)
+        j._writer.join(0.3)
+        mock_client.set.assert_called_once_with(Journal.EVENT_KEY, 1234)
+
+    def test_fallback_file(self):
+        """
+        if redis is not available the checkpoint should be written to the fallback file, and read back from there
+        :return:
+        """
+        import redis
+        import tempfile
+        import os
+        mock_client = MagicMock(target=redis.Redis)
+        mock_client.set = MagicMock(side_effect=redis.ConnectionError)
+        mock_client.get = MagicMock(side_effect=redis.ConnectionError)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            fallback = os.path.join(tempdir, "journal")
+            j = self.make_journal(mock_client, checkpoint_events=100, checkpoint_interval_ms=60000, fallback_path=fallback)
+            j.record_processed(5678)
+            j.flush()
+            with open(fallback, "r") as f:
+                self.assertEqual(f.read(), "5678")
+            self.assertEqual(j.get_most_recent_event(), 5678)
+
+            mock_client.set = MagicMock()
+            j.record_processed(5679)
+            j.flush()
+            self.assertFalse(os.path.exists(fallback))
+
+    def test_no_fallback_retries(self):
+        """
+        if redis is not available and there is no fallback file, the checkpoint should be kept for the next write
+        :return:
+        """
+        import redis
+        from journal import Journal
+        mock_client = MagicMock(target=redis.Redis)
+        mock_client.set = MagicMock(side_effect=redis.ConnectionError)
+        j = self.make_journal(mock_client, checkpoint_events=100, checkpoint_interval_ms=60000)
+
+        j.record_processed(5678)
+        j.flush()
+        mock_client.set = MagicMock()
+        j.flush()
+        mock_client.set.assert_called_once_with(Journal.EVENT_KEY, 5678)
+
+    def test_status_cache_flushed_with_checkpoint(self):
+        """
+        when a batched status cache is attached, its changes should be written along with each checkpoint, and a cache
+        being replaced should be flushed first
+        :return:
+        """
+        import redis
+        from journal import Journal
+        from models import StatusCache, JobState
+        mock_client = MagicMock(target=redis.Redis)
+        j = self.make_journal(mock_client, checkpoint_events=100, checkpoint_interval_ms=60000)
+        first_cache = MagicMock(target=StatusCache)
+        first_cache.has_unwritten = MagicMock(return_value=False)
+        j.attach_status_cache(first_cache)
+
+        j.record_processed(100)
+        j.flush()
+        first_cache.flush.assert_called_once_with(checkpoint=(Journal.EVENT_KEY, 100), fence=None)
+        mock_client.set.assert_not_called()
+        self.assertEqual(j.last_written, 100)
+
+        first_cache.has_unwritten = MagicMock(return_value=True)
+        j.attach_status_cache(MagicMock(target=StatusCache))
+        first_cache.flush.assert_called_with(checkpoint=None, fence=None)
+        self.assertEqual(first_cache.flush.call_count, 2)
+
+    def test_fenced_by_lease(self):
+        """
+        a journal fenced with a lease should only write while the lease holds our identity, throw away what it holds
+        when the lease is lost, and not flush an earlier term's changes when a new status cache is attached
+        :return:
+        """
+        import fakeredis
+        from journal import Journal
+        from leader import LeaderLease
+        from models import StatusCache, JobState
+        client = fakeredis.FakeRedis()
+        j = self.make_journal(client, checkpoint_events=100, checkpoint_interval_ms=60000)
+        lease = LeaderLease(client, "cdsreaper:leader:some-namespace", "replica-a")
+        self.assertTrue(lease.try_acquire())
+        j.fence_with(lease)
+        cache = StatusCache(client, batched=True)
+        j.attach_status_cache(cache)
+
+        cache.put(JobState("uid-1", "job-1", "running", 1))
+        j.record_processed(100)
+        j.flush()
+        self.assertEqual(client.get(Journal.EVENT_KEY), b"100")
+        self.assertEqual(JobState.read(client, "uid-1").status, "running")
+
+        # another replica takes over, and writes its own progress
+        client.set("cdsreaper:leader:some-namespace", "replica-b")
+        client.set(Journal.EVENT_KEY, 300)
+        cache.put(JobState("uid-1", "job-1", "success", 2))
+        j.record_processed(200)
+        j.flush()
+        self.assertEqual(client.get(Journal.EVENT_KEY), b"300")
+        self.assertEqual(JobState.read(client, "uid-1").status, "running")
+        self.assertFalse(cache.has_unwritten())
+
+        # we get the lease back, but the stale watcher recorded more before it stopped
+        lease._held = False
+        cache.put(JobState("uid-1", "job-1", "failed", 3))
+        j.record_processed(250)
+        client.delete("cdsreaper:leader:some-namespace")
+        self.assertTrue(lease.try_acquire())
+        j.attach_status_cache(StatusCache(client, batched=True))
+        j.flush()
+        self.assertEqual(client.get(Journal.EVENT_KEY), b"300")
+        self.assertEqual(JobState.read(client, "uid-1").status, "running")
@@ -0,0 +1,188 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import redis
+import threading
+import time
+
+
+class TestLeaderLease(TestCase):
+    @staticmethod
+    def make_client(set_result=True, renew_result=1):
+        """
+        builds a mock redis client. register_script returns the renew script first and the release script second,
+        in the order that LeaderLease registers them
+        """
+        mock_client = MagicMock(target=redis.Redis)
+        mock_client.set = MagicMock(return_value=set_result)
+        mock_renew = MagicMock(return_value=renew_result)
+        mock_release = MagicMock(return_value=1)
+        mock_client.register_script = MagicMock(side_effect=[mock_renew, mock_release])
+        return mock_client, mock_renew, mock_release
+
+    def test_try_acquire(self):
+        """
+        try_acquire should set the lease key only if it does not already exist, with the ttl
+        :return:
+        """
+        from leader import LeaderLease
+        mock_client, _, _ = self.make_client()
+        lease = LeaderLease(mock_client, "cdsreaper:leader:ns1", "replica-1", ttl_ms=5000)
+        self.assertTrue(lease.try_acquire())
+        self.assertTrue(lease.is_held)
+        mock_client.set.assert_called_once_with("cdsreaper:leader:ns1", "replica-1", nx=True, px=5000)
+
+    def test_try_acquire_taken(self):
+        """
+        try_acquire should return False if somebody else holds the lease, or if redis can't be reached
+        :return:
+        """
+        from leader import LeaderLease
+        mock_client, _, _ = self.make_client(set_result=None)
+        lease = LeaderLease(mock_client, "cdsreaper:leader:ns1", "replica-1")
+        self.assertFalse(lease.try_acquire())
+        self.assertFalse(lease.is_held)
+
+        mock_client.set = MagicMock(side_effect=redis.ConnectionError("no redis"))
+        self.assertFalse(lease.try_acquire())
+        self.assertFalse(lease.is_held)
+
+    def test_renew(self):
+        """
+        renew should run the renew script with our identity, and report whether we still hold the lease
+        :return:
+        """
+        from leader import LeaderLease
+        mock_client, mock_renew, _ = self.make_client()
+        lease = LeaderLease(mock_client, "cdsreaper:leader:ns1", "replica-1", ttl_ms=5000)
+        lease.try_acquire()
+        self.assertTrue(lease.renew())
+        mock_renew.assert_called_once_with(keys=["cdsreaper:leader:ns1"], args=["replica-1", 5000])
+
+        mock_renew.return_value = 0
+        self.assertFalse(lease.renew())
+
+    def test_renew_redis_down(self):
+        """
+        if redis can't be reached, renew should carry on reporting the lease as held until it would have expired
+        :return:
+        """
+        from leader import LeaderLease
+        mock_client, mock_renew, _ = self.make_client()
+        lease = LeaderLease(mock_client, "cdsreaper:leader:ns1", "replica-1", ttl_ms=100)
+        lease.try_acquire()
+        mock_renew.side_effect = redis.ConnectionError("no redis")
+        self.assertTrue(lease.renew())
+        time.sleep(0.15)
+        self.assertFalse(lease.renew())
+
+    def test_lost_while_renewing(self):
+        """
+        the renewal thread should call on_lost once a renewal fails
+        :return:
+        """
+        from leader import LeaderLease
+        mock_client, mock_renew, mock_release = self.make_client(renew_result=0)
+        lease = LeaderLease(mock_client, "cdsreaper:leader:ns1", "replica-1", ttl_ms=1000, renew_interval_ms=10)
+        lease.try_acquire()
+        lost = threading.Event()
+        lease.start_renewing(on_lost=lost.set)
+        self.assertTrue(lost.wait(2))
+        self.assertFalse(lease.is_held)
+
+        lease.release()
+        mock_release.assert_not_called()
+
+    def test_release(self):
+        """
+        release should run the release script with our identity if we hold the lease
+        :return:
+        """
+        from leader import LeaderLease
+        mock_client, _, mock_release = self.make_client()
+        lease = LeaderLease(mock_client, "cdsreaper:leader:ns1", "replica-1", ttl_ms=1000, renew_interval_ms=10)
+        lease.try_acquire()
+        lease.start_renewing(on_lost=MagicMock())
+        lease.release()
+        self.assertFalse(lease.is_held)
+        mock_release.assert_called_once_with(keys=["cdsreaper:leader:ns1"], args=["replica-1"])
+
+
+class TestLeaderElectedRunner(TestCase):
+    def test_run_once(self):
+        """
+        run_once should wait for the lease, run a new watcher, and release the lease once the watcher stops
+        :return:
+        """
+        from leader import LeaderLease, LeaderElectedRunner
+        mock_lease = MagicMock(target=LeaderLease)
+        mock_lease.renew_interval_ms = 1
+        mock_lease.try_acquire = MagicMock(side_effect=[False, False, True])
+        mock_watcher = MagicMock()
+        make_watcher = MagicMock(return_value=mock_watcher)
+
+        runner = LeaderElectedRunner(mock_lease, make_watcher)
+        self.assertTrue(runner.run_once())
+        self.assertEqual(mock_lease.try_acquire.call_count, 3)
+        make_watcher.assert_called_once_with()
+        mock_lease.start_renewing.assert_called_once_with(on_lost=runner._lost)
+        mock_watcher.run.assert_called_once_with()
+        mock_lease.release.assert_called_once_with()
+
+    def test_on_lost(self):
+        """
+        losing the lease should stop the watcher, then call on_lost
+        :return:
+        """
+        from leader import LeaderLease, LeaderElectedRunner
+        mock_lease = MagicMock(target=LeaderLease)
+        mock_lease.renew_interval_ms = 1
+        mock_lease.try_acquire = MagicMock(return_value=True)
+        mock_watcher = MagicMock()
+        on_lost = MagicMock(side_effect=lambda: mock_watcher.stop.assert_called_once_with())
+        mock_lease.start_renewing = MagicMock(side_effect=lambda on_lost: on_lost())
+
+        runner = LeaderElectedRunner(mock_lease, MagicMock(return_value=mock_watcher), on_lost=on_lost)
+        runner.run_once()
+        on_lost.assert_called_once_with()
+
+    def test_run_once_error(self):
+        """
+        run_once should release the lease and raise if the watcher fails
+        :return:
+        """
+        from leader import LeaderLease, LeaderElectedRunner
+        mock_lease = MagicMock(target=LeaderLease)
+        mock_lease.renew_interval_ms = 1
+        mock_lease.try_acquire = MagicMock(return_value=True)
+        mock_watcher = MagicMock()
+        mock_watcher.run = MagicMock(side_effect=RuntimeError("kaboom"))
+        slots = threading.Semaphore(1)
+
+        runner = LeaderElectedRunner(mock_lease, MagicMock(return_value=mock_watcher), slots=slots)
+        with self.assertRaises(RuntimeError):
+            runner.run_once()
+        mock_lease.release.assert_called_once_with()
+        self.assertTrue(slots.acquire(blocking=False))
+
+    def test_slots(self):
+        """
+        a runner should not try for its lease while the replica is already leading as many namespaces as it may
+        :return:
+        """
+        from leader import LeaderLease, LeaderElectedRunner
+        mock_lease = MagicMock(target=LeaderLease)
+        mock_lease.renew_interval_ms = 1
+        mock_lease.try_acquire = MagicMock(return_value=True)
+        slots = threading.Semaphore(1)
+        slots.acquire()
+
+        runner = LeaderElectedRunner(mock_lease, MagicMock(), slots=slots)
+        t = threading.Thread(target=runner.run_once)
+        t.start()
+        time.sleep(0.05)
+        mock_lease.try_acquire.assert_not_called()
+
+        runner.stop()
+        t.join(1)
+        self.assertFalse(t.is_alive())
+        mock_lease.try_acquire.assert_not_called()
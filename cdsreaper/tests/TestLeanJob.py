@@ -0,0 +1,159 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import json
+import kubernetes.client.exceptions
+from leanjob import LeanJob, LeanWatch, StrictWatch, parse_event, iter_resp_lines
+from jobwatcher import JobWatcher
+
+
+def make_job_dict(name="cds-test-job", resource_version="1234", status=None):
+    return {
+        "apiVersion": "batch/v1",
+        "kind": "Job",
+        "metadata": {
+            "name": name,
+            "namespace": "some-namespace",
+            "uid": "some-uid",
+            "resourceVersion": resource_version,
+            "labels": {"job-name": name},
+        },
+        "spec": {
+            "template": {
+                "spec": {
+                    "containers": [{"name": "cds", "image": "cds-backend:latest", "command": ["/usr/local/bin/cds_run.pl"]}]
+                }
+            }
+        },
+        "status": status if status is not None else {},
+    }
+
+
+class FakeResponse(object):
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self.close = MagicMock()
+        self.release_conn = MagicMock()
+
+    def read_chunked(self, decode_content=False):
+        return iter(self._chunks)
+
+
+class TestLeanJob(TestCase):
+    def test_parse_event(self):
+        """
+        parse_event should build a LeanJob with the metadata and status fields that we need
+        :return:
+        """
+        line = json.dumps({"type": "MODIFIED", "object": make_job_dict(status={"active": 1, "startTime": "2021-01-02T03:04:05Z"})}).encode("UTF-8")
+        event = parse_event(line)
+        self.assertEqual(event["type"], "MODIFIED")
+        job = event["object"]
+        self.assertIsInstance(job, LeanJob)
+        self.assertEqual(job.metadata.name, "cds-test-job")
+        self.assertEqual(job.metadata.uid, "some-uid")
+        self.assertEqual(job.metadata.namespace, "some-namespace")
+        self.assertEqual(job.metadata.resource_version, "1234")
+        self.assertEqual(job.status.active, 1)
+        self.assertIsNone(job.status.failed)
+        self.assertEqual(JobWatcher.get_job_status_string(job), "running")
+
+    def test_status_strings(self):
+        """
+        LeanJob objects should be classified the same way as V1Job ones
+        :return:
+        """
+        starting = LeanJob(make_job_dict(status={}))
+        self.assertEqual(JobWatcher.get_job_status_string(starting), "starting")
+        retry = LeanJob(make_job_dict(status={"active": 1, "failed": 1, "startTime": "2021-01-02T03:04:05Z"}))
+        self.assertEqual(JobWatcher.get_job_status_string(retry), "retry")
+        success = LeanJob(make_job_dict(status={"succeeded": 1, "startTime": "2021-01-02T03:04:05Z"}))
+        self.assertEqual(JobWatcher.get_job_status_string(success), "success")
+        failed = LeanJob(make_job_dict(status={
+            "failed": 2,
+            "startTime": "2021-01-02T03:04:05Z",
+            "conditions": [
+                {"type": "Failed", "status": "True", "reason": "BackoffLimitExceeded", "message": "too many retries",
+                 "lastProbeTime": "2021-01-02T03:10:05Z"},
+                {"type": "Other", "status": "True", "reason": "Old", "message": "older condition",
+                 "lastProbeTime": "2021-01-02T03:05:05Z"},
+            ]
+        }))
+        self.assertEqual(JobWatcher.get_job_status_string(failed), "failed")
+        self.assertEqual(JobWatcher.get_job_failure_reason(failed.status), "BackoffLimitExceeded - too many retries")
+
+    def test_iter_resp_lines(self):
+        """
+        iter_resp_lines should re-assemble lines that are split across chunks
+        :return:
+        """
+        resp = FakeResponse([b'{"a":1}\n{"b"', b':2}\n', b'\n{"c":3}'])
+        self.assertEqual(list(iter_resp_lines(resp)), [b'{"a":1}', b'{"b":2}', b'{"c":3}'])
+
+    def test_lean_watch_stream(self):
+        """
+        LeanWatch.stream should call the list function in watch mode without preloading, and yield parsed events
+        :return:
+        """
+        lines = [json.dumps({"type": "ADDED", "object": make_job_dict(resource_version=str(v))}).encode("UTF-8") + b"\n"
+                 for v in (10, 11)]
+        resp = FakeResponse(lines)
+        list_func = MagicMock(return_value=resp)
+
+        w = LeanWatch()
+        events = list(w.stream(list_func, "some-namespace", resource_version=9, timeout_seconds=10))
+        list_func.assert_called_once_with("some-namespace", resource_version=9, timeout_seconds=10, watch=True, _preload_content=False)
+        self.assertEqual([e["object"].metadata.resource_version for e in events], ["10", "11"])
+        self.assertEqual(w.resource_version, "11")
+        resp.close.assert_called_once()
+
+    def test_lean_watch_error(self):
+        """
+        LeanWatch.stream should raise an ApiException if the server sends an ERROR event
+        :return:
+        """
+        resp = FakeResponse([json.dumps({"type": "ERROR", "object": {"code": 410, "reason": "Gone", "message": "too old"}}).encode("UTF-8")])
+        w = LeanWatch()
+        with self.assertRaises(kubernetes.client.exceptions.ApiException) as ctx:
+            list(w.stream(MagicMock(return_value=resp), "some-namespace", timeout_seconds=10))
+        self.assertEqual(ctx.exception.status, 410)
+
+    def test_strict_watch(self):
+        """
+        StrictWatch.stream should yield V1Job objects like kubernetes.watch.Watch, but raise an ApiException for a 410
+        ERROR event rather than ending the stream quietly
+        :return:
+        """
+        from kubernetes.client import BatchV1Api
+        from kubernetes.client.models.v1_job import V1Job
+        lines = [json.dumps({"type": "MODIFIED", "object": make_job_dict(resource_version="10")}).encode("UTF-8") + b"\n",
+                 json.dumps({"type": "ERROR", "object": {"kind": "Status", "code": 410, "reason": "Expired", "message": "too old"}}).encode("UTF-8") + b"\n"]
+        resp = FakeResponse(lines)
+        api_client = MagicMock()
+        api_client.call_api = MagicMock(return_value=resp)
+        w = StrictWatch()
+        events = []
+        with self.assertRaises(kubernetes.client.exceptions.ApiException) as ctx:
+            for event in w.stream(BatchV1Api(api_client).list_namespaced_job, "some-namespace", resource_version="9",
+                                  timeout_seconds=10):
+                events.append(event)
+        self.assertEqual(ctx.exception.status, 410)
+        self.assertEqual(len(events), 1)
+        self.assertIsInstance(events[0]["object"], V1Job)
+        self.assertEqual(w.resource_version, "10")
+        resp.close.assert_called_once()
+
+    def test_parse_job_list(self):
+        """
+        parse_job_list should return the jobs on the page along with the list resource version and continue token
+        :return:
+        """
+        from leanjob import parse_job_list
+        data = json.dumps({
+            "kind": "JobList",
+            "metadata": {"resourceVersion": "5555", "continue": "next-page"},
+            "items": [make_job_dict(name="cds-one"), make_job_dict(name="cds-two")]
+        }).encode("UTF-8")
+        page = parse_job_list(data)
+        self.assertEqual(page.resource_version, "5555")
+        self.assertEqual(page.continue_token, "next-page")
+        self.assertEqual([j.metadata.name for j in page.items], ["cds-one", "cds-two"])
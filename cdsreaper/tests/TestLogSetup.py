@@ -0,0 +1,95 @@
+from unittest import TestCase
+import json
+import logging
+
+
+class TestJsonFormatter(TestCase):
+    def test_extra_fields(self):
+        """
+        JsonFormatter should output the formatted message along with anything given as `extra`
+        :return:
+        """
+        from logsetup import JsonFormatter
+        logger = logging.getLogger("test_json_formatter")
+        record = logger.makeRecord(logger.name, logging.INFO, __file__, 1, "Job %s is in status %s", ("cds-job", "running"),
+                                   None, func="check_job", extra={"job_uid": "abc", "status": "running"})
+        content = json.loads(JsonFormatter().format(record))
+        self.assertEqual(content["message"], "Job cds-job is in status running")
+        self.assertEqual(content["level"], "INFO")
+        self.assertEqual(content["logger"], "test_json_formatter")
+        self.assertEqual(content["func"], "check_job")
+        self.assertEqual(content["job_uid"], "abc")
+        self.assertEqual(content["status"], "running")
+        self.assertNotIn("args", content)
+
+
+class TestDebugSampler(TestCase):
+    def make_record(self, name, level):
+        return logging.LogRecord(name, level, __file__, 1, "test", (), None)
+
+    def test_sampling(self):
+        """
+        DebugSampler should let through one in every 1/rate debug records from its logger and children, and leave
+        everything else alone
+        :return:
+        """
+        from logsetup import DebugSampler
+        sampler = DebugSampler("jobwatcher", 0.25)
+        results = [sampler.filter(self.make_record("jobwatcher", logging.DEBUG)) for _ in range(8)]
+        self.assertEqual(results, [True, False, False, False, True, False, False, False])
+
+        self.assertTrue(sampler.filter(self.make_record("jobwatcher", logging.INFO)))
+        self.assertTrue(sampler.filter(self.make_record("messagesender", logging.DEBUG)))
+        # children of the logger share its count
+        self.assertTrue(sampler.filter(self.make_record("jobwatcher.child", logging.DEBUG)))
+        self.assertFalse(sampler.filter(self.make_record("jobwatcher.child", logging.DEBUG)))
+
+    def test_zero_rate(self):
+        """
+        a rate of zero should drop all debug records from that logger
+        :return:
+        """
+        from logsetup import DebugSampler
+        sampler = DebugSampler("pika", 0)
+        self.assertFalse(sampler.filter(self.make_record("pika", logging.DEBUG)))
+        self.assertTrue(sampler.filter(self.make_record("pika", logging.WARNING)))
+
+
+class TestConfigureLogging(TestCase):
+    def setUp(self):
+        root = logging.getLogger()
+        self.saved = (root.level, list(root.handlers), logging.getLogger("pika").level)
+
+    def tearDown(self):
+        root = logging.getLogger()
+        for h in list(root.handlers):
+            root.removeHandler(h)
+        for h in self.saved[1]:
+            root.addHandler(h)
+        root.setLevel(self.saved[0])
+        logging.getLogger("pika").setLevel(self.saved[2])
+
+    def test_parse_sample_rates(self):
+        from logsetup import parse_sample_rates
+        self.assertEqual(parse_sample_rates("jobwatcher=0.01, pika=0.5,"), {"jobwatcher": 0.01, "pika": 0.5})
+        self.assertEqual(parse_sample_rates(""), {})
+        with self.assertRaises(ValueError):
+            parse_sample_rates("jobwatcher")
+
+    def test_configure_from_environment(self):
+        """
+        configure_logging should take the level, format, sampling and quiet loggers from the given environment
+        :return:
+        """
+        from logsetup import configure_logging, JsonFormatter, DebugSampler
+        handler = configure_logging({"LOG_LEVEL": "warning", "LOG_FORMAT": "json", "LOG_SAMPLE_RATES": "jobwatcher=0.1"})
+        root = logging.getLogger()
+        self.assertEqual(root.level, logging.WARNING)
+        self.assertEqual(root.handlers, [handler])
+        self.assertIsInstance(handler.formatter, JsonFormatter)
+        self.assertEqual([f.name for f in handler.filters if isinstance(f, DebugSampler)], ["jobwatcher"])
+        self.assertEqual(logging.getLogger("pika").level, logging.WARN)
+
+        handler = configure_logging({})
+        self.assertEqual(root.level, logging.INFO)
+        self.assertNotIsInstance(handler.formatter, JsonFormatter)
@@ -3,7 +3,7 @@ from unittest.mock import MagicMock, patch
 import pika
 import pika.channel
 import pika.exceptions
-from messagesender import MessageSender
+from messagesender import MessageSender, PipelinedMessageSender
 
 
 class TestMessageSender(TestCase):
@@ -125,3 +125,166 @@ class TestMessageSender(TestCase):
                                                       b"""{"key": "value", "otherkey": ["value1", "value2"]}""")
         self.assertEqual(result, True)
 
+    def test_messagesender_channel_wrong_state(self):
+        """
+        MessageSender.notify should re-establish the connection if an earlier attempt to do so left the channel closed
+        :return:
+        """
+        mock_channel = MagicMock(target=pika.channel.Channel)
+        mock_channel.basic_publish = MagicMock(side_effect=[pika.exceptions.ChannelWrongStateError, None])
+        mock_setup_called = MagicMock()
+        params = pika.ConnectionParameters(host="somehost",port=5672, virtual_host="/")
+
+        class SenderToTest(MessageSender):
+            def _setup_channel(self, attempt=1):
+                self._channel = mock_channel
+                mock_setup_called()
+
+        s = SenderToTest(params, "some-exchange", 2)
+
+        result = s.notify("some-key", {"key":"value"})
+        self.assertEqual(mock_channel.basic_publish.call_count, 2)
+        self.assertEqual(mock_setup_called.call_count, 2)
+        self.assertEqual(result, True)
+
+
+
+class TestPipelinedMessageSender(TestCase):
+    class SenderToTest(PipelinedMessageSender):
+        """
+        replaces the ioloop thread with mocks, so that callbacks are invoked directly on the test thread
+        """
+        DELAY_SECONDS_PER_RETRY = 0
+
+        def _start_ioloop(self):
+            self._conn = MagicMock(target=pika.SelectConnection)
+            self._conn.ioloop.add_callback_threadsafe = MagicMock(side_effect=lambda cb: cb())
+            self._conn.ioloop.call_later = MagicMock(side_effect=lambda delay, cb: cb())
+            self.mock_channel = MagicMock(target=pika.channel.Channel)
+            self.mock_channel.is_open = True
+            self._on_channel_ready(self.mock_channel)
+
+    @staticmethod
+    def make_frame(method_class, delivery_tag, multiple=False):
+        frame = MagicMock()
+        frame.method = method_class(delivery_tag=delivery_tag, multiple=multiple)
+        return frame
+
+    def test_notify_does_not_wait(self):
+        """
+        PipelinedMessageSender.notify should publish the message and return before it is confirmed, then call
+        the on_confirm callback when the broker acks it
+        :return:
+        """
+        params = pika.ConnectionParameters(host="somehost",port=5672, virtual_host="/")
+        s = self.SenderToTest(params, "some-exchange", 2)
+        on_confirm = MagicMock()
+
+        result = s.notify("some-key", {"key":"value"}, on_confirm=on_confirm)
+        self.assertTrue(result)
+        self.assertEqual(s.mock_channel.basic_publish.call_count, 1)
+        self.assertEqual(s.mock_channel.basic_publish.call_args[0], ("some-exchange", "some-key", b"""{"key": "value"}"""))
+        self.assertEqual(s.in_flight(), 1)
+        on_confirm.assert_not_called()
+
+        s._on_delivery_confirmation(self.make_frame(pika.spec.Basic.Ack, 1))
+        on_confirm.assert_called_once_with()
+        self.assertEqual(s.in_flight(), 0)
+
+    def test_multiple_ack(self):
+        """
+        a broker ack with the multiple flag set should confirm every message up to and including the delivery tag
+        :return:
+        """
+        params = pika.ConnectionParameters(host="somehost",port=5672, virtual_host="/")
+        s = self.SenderToTest(params, "some-exchange", 2)
+        callbacks = [MagicMock(), MagicMock(), MagicMock()]
+        for cb in callbacks:
+            s.notify("some-key", {"key":"value"}, on_confirm=cb)
+
+        s._on_delivery_confirmation(self.make_frame(pika.spec.Basic.Ack, 2, multiple=True))
+        callbacks[0].assert_called_once_with()
+        callbacks[1].assert_called_once_with()
+        callbacks[2].assert_not_called()
+        self.assertEqual(s.in_flight(), 1)
+
+    def test_nack_retries(self):
+        """
+        a nacked message should be published again and only confirmed when the retry is acked
+        :return:
+        """
+        params = pika.ConnectionParameters(host="somehost",port=5672, virtual_host="/")
+        s = self.SenderToTest(params, "some-exchange", 2)
+        on_confirm = MagicMock()
+        s.notify("some-key", {"key":"value"}, on_confirm=on_confirm)
+
+        s._on_delivery_confirmation(self.make_frame(pika.spec.Basic.Nack, 1))
+        on_confirm.assert_not_called()
+        self.assertEqual(s.mock_channel.basic_publish.call_count, 2)
+
+        s._on_delivery_confirmation(self.make_frame(pika.spec.Basic.Ack, 2))
+        on_confirm.assert_called_once_with()
+
+    def test_returned_message_counted(self):
+        """
+        messages should be published without the mandatory flag, and a message that is returned anyway should only be
+        counted, then confirmed when the broker acks it
+        :return:
+        """
+        from metrics import BROKER_RETURNS
+        params = pika.ConnectionParameters(host="somehost",port=5672, virtual_host="/")
+        s = self.SenderToTest(params, "some-exchange", 2)
+        on_confirm = MagicMock()
+        s.notify("some-key", {"key":"value"}, on_confirm=on_confirm)
+        self.assertNotIn("mandatory", s.mock_channel.basic_publish.call_args[1])
+        sent_properties = s.mock_channel.basic_publish.call_args[1]["properties"]
+
+        returns_before = BROKER_RETURNS._value.get()
+        s._on_message_returned(s.mock_channel, MagicMock(), sent_properties, b"")
+        self.assertEqual(BROKER_RETURNS._value.get(), returns_before + 1)
+        s._on_delivery_confirmation(self.make_frame(pika.spec.Basic.Ack, 1))
+        on_confirm.assert_called_once_with()
+        self.assertEqual(s.mock_channel.basic_publish.call_count, 1)
+
+    def test_retries_exhausted(self):
+        """
+        once a message has been rejected max_retry_attempts times, notify and flush should raise a RuntimeError
+        :return:
+        """
+        params = pika.ConnectionParameters(host="somehost",port=5672, virtual_host="/")
+        s = self.SenderToTest(params, "some-exchange", 2)
+        s.notify("some-key", {"key":"value"})
+        s._on_delivery_confirmation(self.make_frame(pika.spec.Basic.Nack, 1))
+        s._on_delivery_confirmation(self.make_frame(pika.spec.Basic.Nack, 2))
+
+        with self.assertRaises(RuntimeError):
+            s.flush(timeout=1)
+        with self.assertRaises(RuntimeError):
+            s.notify("some-key", {"key":"value"})
+
+    def test_resend_on_new_channel(self):
+        """
+        unconfirmed messages should be sent again when a new channel is opened
+        :return:
+        """
+        params = pika.ConnectionParameters(host="somehost",port=5672, virtual_host="/")
+        s = self.SenderToTest(params, "some-exchange", 2)
+        s.notify("some-key", {"key":"value"})
+
+        new_channel = MagicMock(target=pika.channel.Channel)
+        new_channel.is_open = True
+        s._on_channel_ready(new_channel)
+        self.assertEqual(new_channel.basic_publish.call_count, 1)
+        self.assertEqual(s.in_flight(), 1)
+
+    def test_flush_timeout(self):
+        """
+        flush should return False if messages are still unconfirmed when the timeout expires
+        :return:
+        """
+        params = pika.ConnectionParameters(host="somehost",port=5672, virtual_host="/")
+        s = self.SenderToTest(params, "some-exchange", 2)
+        s.notify("some-key", {"key":"value"})
+        self.assertFalse(s.flush(timeout=0.1))
+        s._on_delivery_confirmation(self.make_frame(pika.spec.Basic.Ack, 1))
+        self.assertTrue(s.flush(timeout=0.1))
@@ -0,0 +1,83 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from prometheus_client import REGISTRY
+import urllib.request
+import urllib.error
+import time
+
+
+class TestWatchHealth(TestCase):
+    def test_staleness(self):
+        """
+        a running watch should make us unhealthy once it has been quiet for longer than max_staleness, and a stopped
+        one should not count
+        :return:
+        """
+        from metrics import WatchHealth
+        h = WatchHealth(max_staleness=0.05)
+        self.assertTrue(h.is_live())
+        self.assertFalse(h.is_ready())
+        h.mark_started()
+        h.mark_active("ns1")
+        self.assertTrue(h.is_ready())
+
+        time.sleep(0.1)
+        self.assertEqual(h.stale_watches(), ["ns1"])
+        self.assertFalse(h.is_live())
+        self.assertFalse(h.is_ready())
+
+        h.mark_stopped("ns1")
+        self.assertTrue(h.is_live())
+
+
+class TestMetricsServer(TestCase):
+    def test_endpoints(self):
+        """
+        the server should serve metrics, and health probes that follow watch_health
+        :return:
+        """
+        from metrics import MetricsServer, WatchHealth
+        health = WatchHealth(max_staleness=60)
+        with patch("metrics.watch_health", health):
+            server = MetricsServer(0, "127.0.0.1")
+            server.start()
+            try:
+                base = "http://127.0.0.1:{0}".format(server.port)
+                with urllib.request.urlopen(base + "/metrics") as resp:
+                    self.assertIn(b"cdsreaper_watch_events_total", resp.read())
+
+                with urllib.request.urlopen(base + "/healthz") as resp:
+                    self.assertEqual(resp.status, 200)
+                with self.assertRaises(urllib.error.HTTPError) as ctx:
+                    urllib.request.urlopen(base + "/readyz")
+                self.assertEqual(ctx.exception.code, 503)
+
+                health.mark_started()
+                with urllib.request.urlopen(base + "/readyz") as resp:
+                    self.assertEqual(resp.status, 200)
+            finally:
+                server.stop()
+
+
+class TestWatcherMetrics(TestCase):
+    def test_process_event(self):
+        """
+        _process_event should count events by type and keep track of the gap between the latest resource version and
+        the journalled one
+        :return:
+        """
+        from jobwatcher import JobWatcher
+        from journal import Journal
+        from leanjob import LeanJob
+        mock_journal = MagicMock(target=Journal)
+        mock_journal.last_written = "100"
+        w = JobWatcher(MagicMock(), MagicMock(), mock_journal, "metrics-ns", label_selector="app=cds")
+        w.check_job = MagicMock(return_value=True)
+
+        before = REGISTRY.get_sample_value("cdsreaper_watch_events_total", {"namespace": "metrics-ns", "type": "MODIFIED"}) or 0
+        job = LeanJob({"metadata": {"name": "cds-job", "uid": "abc", "resourceVersion": "125"}, "status": {}})
+        w._process_event({"type": "MODIFIED", "object": job})
+
+        self.assertEqual(REGISTRY.get_sample_value("cdsreaper_watch_events_total", {"namespace": "metrics-ns", "type": "MODIFIED"}), before + 1)
+        self.assertEqual(REGISTRY.get_sample_value("cdsreaper_latest_resource_version", {"namespace": "metrics-ns"}), 125)
+        self.assertEqual(REGISTRY.get_sample_value("cdsreaper_resource_version_gap", {"namespace": "metrics-ns"}), 25)
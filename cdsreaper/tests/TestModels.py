@@ -0,0 +1,116 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import redis
+import json
+from models import JobState, StatusCache
+
+
+class TestJobState(TestCase):
+    def test_roundtrip(self):
+        """
+        a JobState written to redis should be readable again with the same content
+        :return:
+        """
+        stored = {}
+        mock_client = MagicMock(target=redis.Redis)
+        mock_client.set = MagicMock(side_effect=lambda k, v: stored.update({k: v}))
+        mock_client.get = MagicMock(side_effect=lambda k: stored.get(k))
+
+        JobState("some-uid", "some-name", "running", 1234.5).write(mock_client)
+        result = JobState.read(mock_client, "some-uid")
+        self.assertEqual(result.uid, "some-uid")
+        self.assertEqual(result.name, "some-name")
+        self.assertEqual(result.status, "running")
+        self.assertEqual(result.timestamp, 1234.5)
+
+
+class TestStatusCache(TestCase):
+    def test_lru_eviction(self):
+        """
+        StatusCache should only keep max_entries jobs in memory, evicting the least recently used one
+        :return:
+        """
+        cache = StatusCache(None, max_entries=2)
+        cache.put(JobState("uid-1", "job-1", "running", 1))
+        cache.put(JobState("uid-2", "job-2", "running", 1))
+        cache.get("uid-1")
+        cache.put(JobState("uid-3", "job-3", "running", 1))
+
+        self.assertIsNotNone(cache.get("uid-1"))
+        self.assertIsNone(cache.get("uid-2"))
+        self.assertIsNotNone(cache.get("uid-3"))
+
+    def test_falls_back_to_redis(self):
+        """
+        StatusCache should look up jobs that are not in memory from redis
+        :return:
+        """
+        mock_client = MagicMock(target=redis.Redis)
+        mock_client.get = MagicMock(return_value=json.dumps({"uid":"uid-1","name":"job-1","status":"retry","timestamp":10}))
+        cache = StatusCache(mock_client)
+
+        result = cache.get("uid-1")
+        self.assertEqual(result.status, "retry")
+        cache.get("uid-1")
+        mock_client.get.assert_called_once_with("cds:job:uid-1")
+
+    def test_remember_does_not_persist(self):
+        """
+        remember should only update memory, persist should write to redis
+        :return:
+        """
+        mock_client = MagicMock(target=redis.Redis)
+        cache = StatusCache(mock_client)
+        state = JobState("uid-1", "job-1", "running", 1)
+
+        cache.remember(state)
+        mock_client.set.assert_not_called()
+        cache.persist(state)
+        mock_client.set.assert_called_once_with("cds:job:uid-1", state.to_json())
+
+    def test_forget(self):
+        """
+        forget should remove the job from memory and redis
+        :return:
+        """
+        mock_client = MagicMock(target=redis.Redis)
+        mock_client.get = MagicMock(return_value=None)
+        cache = StatusCache(mock_client)
+        cache.put(JobState("uid-1", "job-1", "running", 1))
+
+        cache.forget("uid-1")
+        mock_client.delete.assert_called_once_with("cds:job:uid-1")
+        self.assertIsNone(cache.get("uid-1"))
+
+    def test_batched(self):
+        """
+        a batched StatusCache should hold changes, still answering from them, until they are flushed along with the
+        checkpoint in a single transaction, and keep them if the flush fails
+        :return:
+        """
+        import fakeredis
+        server = fakeredis.FakeServer()
+        client = fakeredis.FakeRedis(server=server)
+        cache = StatusCache(client, max_entries=1, finished_ttl=60, batched=True)
+        client.set("cds:job:old-uid", JobState("old-uid", "job-0", "running", 1).to_json())
+
+        cache.put(JobState("uid-1", "job-1", "running", 1))
+        cache.put(JobState("uid-2", "job-2", "success", 1))
+        cache.forget("old-uid")
+        self.assertIsNone(client.get("cds:job:uid-1"))
+        self.assertEqual(cache.get("uid-1").status, "running")     # evicted from memory, but not yet written
+        self.assertIsNone(cache.get("old-uid"))
+
+        server.connected = False
+        with self.assertRaises(redis.ConnectionError):
+            cache.flush()
+        self.assertTrue(cache.has_unwritten())
+        server.connected = True
+
+        self.assertEqual(cache.flush(checkpoint=("journal-key", 1234)), 3)
+        self.assertFalse(cache.has_unwritten())
+        self.assertEqual(JobState.read(client, "uid-1").status, "running")
+        self.assertEqual(client.ttl("cds:job:uid-1"), -1)
+        self.assertTrue(0 < client.ttl("cds:job:uid-2") <= 60)
+        self.assertIsNone(client.get("cds:job:old-uid"))
+        self.assertEqual(client.get("journal-key"), b"1234")
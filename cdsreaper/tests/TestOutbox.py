@@ -0,0 +1,185 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import os
+import tempfile
+import threading
+
+
+class TestSpoolOutbox(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.spool_path = os.path.join(self.tempdir.name, "outbox")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_notify_and_drain(self):
+        """
+        notify should confirm a message once it is spooled, and the drainer should send messages in order
+        :return:
+        """
+        from outbox import SpoolOutbox
+        from messagesender import MessageSender
+        mock_sender = MagicMock(target=MessageSender)
+        mock_sender.notify = MagicMock(return_value=True)
+        on_confirm = MagicMock()
+
+        o = SpoolOutbox(self.spool_path, mock_sender)
+        try:
+            for i in range(3):
+                self.assertTrue(o.notify("cds.job.running", {"job-id": i}, on_confirm=on_confirm))
+            self.assertEqual(on_confirm.call_count, 3)
+            self.assertTrue(o.flush(2))
+        finally:
+            o.close(2)
+
+        self.assertEqual([c[0] for c in mock_sender.notify.call_args_list],
+                         [("cds.job.running", {"job-id": 0}), ("cds.job.running", {"job-id": 1}), ("cds.job.running", {"job-id": 2})])
+        self.assertEqual(o.pending(), 0)
+
+    def test_broker_down(self):
+        """
+        while the sender is failing, notify should carry on spooling and the drainer should keep trying the same message
+        :return:
+        """
+        from outbox import SpoolOutbox
+        from messagesender import MessageSender
+        broker_up = threading.Event()
+        sent = []
+
+        def fake_notify(routing_key, body):
+            if not broker_up.is_set():
+                raise RuntimeError("Could not deliver message after 10 retries")
+            sent.append(body["job-id"])
+            return True
+
+        mock_sender = MagicMock(target=MessageSender)
+        mock_sender.notify = MagicMock(side_effect=fake_notify)
+        SpoolOutbox.MAX_BACKOFF_SECONDS = 0.05
+        o = SpoolOutbox(self.spool_path, mock_sender)
+        try:
+            for i in range(5):
+                o.notify("cds.job.running", {"job-id": i})
+            self.assertFalse(o.flush(0.2))
+            self.assertEqual(o.pending(), 5)
+            broker_up.set()
+            self.assertTrue(o.flush(5))
+        finally:
+            o.close(2)
+            SpoolOutbox.MAX_BACKOFF_SECONDS = 60
+        self.assertEqual(sent, [0, 1, 2, 3, 4])
+
+    def test_resume_after_restart(self):
+        """
+        messages that were spooled but not sent should be sent by the next outbox on the same spool, and a partly
+        written message at the end should be dropped
+        :return:
+        """
+        from outbox import SpoolOutbox
+        from messagesender import MessageSender
+        failing_sender = MagicMock(target=MessageSender)
+        failing_sender.notify = MagicMock(side_effect=RuntimeError("broker down"))
+        o = SpoolOutbox(self.spool_path, failing_sender)
+        o.notify("cds.job.running", {"job-id": 0})
+        o.notify("cds.job.success", {"job-id": 0})
+        o.close(0.1)
+        with open(self.spool_path, "ab") as f:
+            f.write(b'{"routing_key": "cds.job.fai')
+
+        mock_sender = MagicMock(target=MessageSender)
+        mock_sender.notify = MagicMock(return_value=True)
+        o = SpoolOutbox(self.spool_path, mock_sender)
+        try:
+            self.assertTrue(o.flush(2))
+        finally:
+            o.close(2)
+        self.assertEqual([c[0] for c in mock_sender.notify.call_args_list],
+                         [("cds.job.running", {"job-id": 0}), ("cds.job.success", {"job-id": 0})])
+
+        # and nothing is sent again after that
+        again_sender = MagicMock(target=MessageSender)
+        o = SpoolOutbox(self.spool_path, again_sender)
+        o.close(1)
+        again_sender.notify.assert_not_called()
+
+    def test_compact(self):
+        """
+        the spool should be emptied once it has been sent, if it has grown past compact_bytes
+        :return:
+        """
+        from outbox import SpoolOutbox
+        from messagesender import MessageSender
+        mock_sender = MagicMock(target=MessageSender)
+        mock_sender.notify = MagicMock(return_value=True)
+        o = SpoolOutbox(self.spool_path, mock_sender, compact_bytes=10)
+        try:
+            o.notify("cds.job.running", {"job-id": 0})
+            self.assertTrue(o.flush(2))
+            o.notify("cds.job.success", {"job-id": 0})
+            self.assertTrue(o.flush(2))
+        finally:
+            o.close(2)
+        self.assertEqual(os.path.getsize(self.spool_path), 0)
+        self.assertEqual(mock_sender.notify.call_count, 2)
+
+    def test_compact_with_unsent(self):
+        """
+        once enough of the spool has been sent, it should be compacted down to the unsent messages even if there are
+        some, and nothing should be skipped
+        :return:
+        """
+        from outbox import SpoolOutbox
+        from messagesender import MessageSender
+        line_counts = []
+
+        def count_lines(routing_key, body):
+            with open(self.spool_path, "rb") as f:
+                line_counts.append(len(f.readlines()))
+            return True
+
+        mock_sender = MagicMock(target=MessageSender)
+        mock_sender.notify = MagicMock(side_effect=count_lines)
+        o = SpoolOutbox(self.spool_path, mock_sender, compact_bytes=10)
+        try:
+            with o._lock:
+                for i in range(4):
+                    o.notify("cds.job.running", {"job-id": i})
+            self.assertTrue(o.flush(2))
+        finally:
+            o.close(2)
+
+        self.assertEqual([c[0][1]["job-id"] for c in mock_sender.notify.call_args_list], [0, 1, 2, 3])
+        # after the first two are sent, the spool is cut down to the last two
+        self.assertEqual(line_counts, [4, 4, 2, 1])
+        self.assertEqual(os.path.getsize(self.spool_path), 0)
+
+    def test_compact_crash(self):
+        """
+        if compaction fails after the offset has been reset, the old spool should be sent again from the start rather
+        than any message being skipped
+        :return:
+        """
+        from outbox import SpoolOutbox
+        from messagesender import MessageSender
+        from unittest.mock import patch
+        real_replace = os.replace
+
+        def failing_replace(src, dst):
+            if src.endswith(".compact"):
+                raise OSError("disk went away")
+            return real_replace(src, dst)
+
+        mock_sender = MagicMock(target=MessageSender)
+        mock_sender.notify = MagicMock(return_value=True)
+        with patch("os.replace", side_effect=failing_replace):
+            o = SpoolOutbox(self.spool_path, mock_sender, compact_bytes=10)
+            try:
+                o.notify("cds.job.running", {"job-id": 0})
+                self.assertTrue(o.flush(2))
+            finally:
+                o.close(2)
+
+        with open(self.spool_path + ".offset", "r") as f:
+            self.assertEqual(f.read(), "0")
+        with open(self.spool_path, "rb") as f:
+            self.assertEqual(len(f.readlines()), 1)
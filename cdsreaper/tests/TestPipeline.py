@@ -0,0 +1,114 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import threading
+
+
+class TestEventPipeline(TestCase):
+    def test_notify(self):
+        """
+        notify should publish messages in order via the sender, and call on_confirm once each has been sent
+        :return:
+        """
+        from pipeline import EventPipeline
+        from messagesender import MessageSender
+        from journal import Journal
+        mock_sender = MagicMock(target=MessageSender)
+        confirmed = []
+
+        p = EventPipeline(mock_sender, MagicMock(target=Journal), queue_size=10)
+        p.start()
+        try:
+            for i in range(5):
+                self.assertTrue(p.notify("cds.job.running", {"job-id": i}, on_confirm=lambda i=i: confirmed.append(i)))
+            self.assertTrue(p.drain(2))
+        finally:
+            p.close(2)
+
+        self.assertEqual([c[0][1]["job-id"] for c in mock_sender.notify.call_args_list], [0, 1, 2, 3, 4])
+        self.assertEqual(confirmed, [0, 1, 2, 3, 4])
+
+    def test_journal_coalesces(self):
+        """
+        journal writes that queue up while the journal stage is busy should be written once, with the latest value
+        :return:
+        """
+        from pipeline import EventPipeline
+        from messagesender import MessageSender
+        from journal import Journal
+        mock_journal = MagicMock(target=Journal)
+        release = threading.Event()
+        mock_journal.record_processed = MagicMock(side_effect=lambda id: release.wait(2))
+
+        p = EventPipeline(MagicMock(target=MessageSender), mock_journal, queue_size=10)
+        p.start()
+        try:
+            p.journal.record_processed(1)
+            for i in range(2, 6):
+                p.journal.record_processed(i)
+            release.set()
+            self.assertTrue(p.drain(2))
+        finally:
+            p.close(2)
+
+        written = [c[0][0] for c in mock_journal.record_processed.call_args_list]
+        self.assertEqual(written[-1], 5)
+        self.assertLess(len(written), 5)
+
+    def test_backpressure(self):
+        """
+        notify should wait while the publish queue is full, and depths() and the queue depth gauge should show how full
+        it is
+        :return:
+        """
+        from prometheus_client import REGISTRY
+        from pipeline import EventPipeline
+        from messagesender import MessageSender
+        from journal import Journal
+        mock_sender = MagicMock(target=MessageSender)
+        release = threading.Event()
+        mock_sender.notify = MagicMock(side_effect=lambda rk, body: release.wait(2))
+
+        p = EventPipeline(mock_sender, MagicMock(target=Journal), queue_size=2, namespace="depth-ns")
+        p.start()
+        try:
+            p.notify("cds.job.running", {"job-id": 0})     # taken by the stage and held up in the sender
+            p.notify("cds.job.running", {"job-id": 1})
+            p.notify("cds.job.running", {"job-id": 2})
+            blocked = threading.Thread(target=p.notify, args=("cds.job.running", {"job-id": 3}))
+            blocked.start()
+            blocked.join(0.2)
+            self.assertTrue(blocked.is_alive())
+            self.assertEqual(p.depths()["publish"], 2)
+            self.assertEqual(REGISTRY.get_sample_value("cdsreaper_pipeline_queue_depth", {"namespace": "depth-ns", "stage": "publish"}), 2)
+
+            release.set()
+            blocked.join(2)
+            self.assertFalse(blocked.is_alive())
+            self.assertTrue(p.drain(2))
+            self.assertEqual(p.depths(), {"publish": 0, "journal": 0})
+            self.assertEqual(REGISTRY.get_sample_value("cdsreaper_pipeline_queue_depth", {"namespace": "depth-ns", "stage": "publish"}), 0)
+        finally:
+            p.close(2)
+
+    def test_publish_failure(self):
+        """
+        once the sender fails, later messages should not be confirmed and notify should raise
+        :return:
+        """
+        from pipeline import EventPipeline
+        from messagesender import MessageSender
+        from journal import Journal
+        mock_sender = MagicMock(target=MessageSender)
+        mock_sender.notify = MagicMock(side_effect=RuntimeError("Could not send message after 10 attempts"))
+        on_confirm = MagicMock()
+
+        p = EventPipeline(mock_sender, MagicMock(target=Journal), queue_size=10)
+        p.start()
+        try:
+            p.notify("cds.job.running", {"job-id": 0}, on_confirm=on_confirm)
+            self.assertFalse(p.drain(2))
+            with self.assertRaises(RuntimeError):
+                p.notify("cds.job.running", {"job-id": 1}, on_confirm=on_confirm)
+        finally:
+            p.close(2)
+        on_confirm.assert_not_called()
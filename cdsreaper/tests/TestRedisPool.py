@@ -0,0 +1,22 @@
+from unittest import TestCase
+
+
+class TestRedisPool(TestCase):
+    def tearDown(self):
+        import redispool
+        redispool.close_all()
+
+    def test_shared_pool(self):
+        """
+        clients for the same server should share one connection pool, sized by the first call
+        :return:
+        """
+        import redispool
+        first = redispool.get_client("somehost", 6379, 1, "somepassword", max_connections=5)
+        second = redispool.get_client("somehost", 6379, 1, "somepassword")
+        other = redispool.get_client("somehost", 6379, 2, "somepassword")
+
+        self.assertIs(first.connection_pool, second.connection_pool)
+        self.assertIsNot(first.connection_pool, other.connection_pool)
+        self.assertEqual(first.connection_pool.max_connections, 5)
+        self.assertEqual(other.connection_pool.max_connections, redispool.DEFAULT_MAX_CONNECTIONS)
@@ -0,0 +1,72 @@
+from unittest import TestCase
+import fakeredis
+
+
+class TestJobRegistry(TestCase):
+    def make_state(self, index, status, timestamp, bundle):
+        from models import JobState
+        return JobState("uid-{0}".format(index), "cds-job-{0}".format(index), status, timestamp,
+                        {"deliverable-bundle-id": bundle, "deliverable-asset-id": str(index), "online-id": "None"})
+
+    def test_find(self):
+        """
+        jobs written through a StatusCache should be findable by status, time and label, most recent first, and only
+        under their latest status
+        :return:
+        """
+        from models import StatusCache
+        from registry import JobRegistry
+        client = fakeredis.FakeRedis()
+        registry = JobRegistry(client)
+        cache = StatusCache(client, batched=True, indexers=[registry])
+        cache.put(self.make_state(1, "running", 1000, "bundle-a"))
+        cache.put(self.make_state(2, "failed", 2000, "bundle-a"))
+        cache.put(self.make_state(3, "failed", 3000, "bundle-b"))
+        cache.put(self.make_state(4, "failed", 4000, "bundle-a"))
+        cache.flush()
+        cache.put(self.make_state(1, "failed", 5000, "bundle-a"))
+        cache.flush()
+
+        self.assertEqual([j.uid for j in registry.find(status="failed")], ["uid-1", "uid-4", "uid-3", "uid-2"])
+        self.assertEqual(registry.find(status="running"), [])
+        self.assertEqual([j.uid for j in registry.find(status="failed", since=2500, labels={"deliverable-bundle-id": "bundle-a"})],
+                         ["uid-1", "uid-4"])
+        self.assertEqual([j.uid for j in registry.find(since=2500, until=4500, limit=1)], ["uid-4"])
+        result = registry.find(labels={"deliverable-asset-id": "3"})
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].name, "cds-job-3")
+        self.assertEqual(result[0].labels["deliverable-bundle-id"], "bundle-b")
+
+        # the responder's placeholder for a missing value is not indexed
+        self.assertEqual(client.exists(JobRegistry.label_key("online-id", "None")), 0)
+        with self.assertRaises(ValueError):
+            registry.find(labels={"nearline-id": "1234"})
+
+    def test_prune(self):
+        """
+        prune should remove every trace of jobs older than the retention period and leave the rest
+        :return:
+        """
+        from models import JobState
+        from registry import JobRegistry
+        client = fakeredis.FakeRedis()
+        registry = JobRegistry(client, retention_seconds=100)
+        JobState.write_many(client, [self.make_state(1, "success", 1000, "bundle-a"),
+                                     self.make_state(2, "success", 1950, "bundle-a")], indexers=[registry])
+
+        self.assertEqual(registry.prune(now=2000), 1)
+        self.assertEqual([j.uid for j in registry.find(labels={"deliverable-bundle-id": "bundle-a"})], ["uid-2"])
+        self.assertEqual(client.exists(JobRegistry.job_key("uid-1")), 0)
+        self.assertEqual(client.exists(JobRegistry.label_key("deliverable-asset-id", "1")), 0)
+        self.assertIsNone(client.zscore(JobRegistry.status_key("success"), "uid-1"))
+
+
+class TestParsing(TestCase):
+    def test_parse_duration(self):
+        from registry import parse_duration
+        self.assertEqual(parse_duration("90"), 90)
+        self.assertEqual(parse_duration("15m"), 900)
+        self.assertEqual(parse_duration("1h"), 3600)
+        self.assertEqual(parse_duration("2d"), 172800)
+        with self.assertRaises(ValueError):
+            parse_duration("an hour")
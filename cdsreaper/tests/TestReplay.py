@@ -0,0 +1,45 @@
+from unittest import TestCase
+import json
+import os
+import tempfile
+
+
+class TestReplay(TestCase):
+    def test_synthetic_replay(self):
+        """
+        replaying a synthetic stream should send one message per status change and journal the last event, with either
+        decoder
+        :return:
+        """
+        from replay import synthesize, replay
+        lines = synthesize(20, concurrency=5, seed=1)
+        last_version = int(json.loads(lines[-1])["object"]["metadata"]["resourceVersion"])
+
+        lean = replay(lines, lean_watch=True)
+        full = replay(lines, lean_watch=False)
+
+        self.assertEqual(lean.events, len(lines))
+        self.assertEqual(lean.journalled, last_version)
+        self.assertEqual(lean.messages, full.messages)
+        routing_keys = [m[0] for m in lean.messages]
+        self.assertEqual(routing_keys.count("cds.job.starting"), 20)
+        self.assertEqual(routing_keys.count("cds.job.running"), 20)
+        self.assertEqual(routing_keys.count("cds.job.success") + routing_keys.count("cds.job.failed"), 20)
+        self.assertGreater(lean.events_per_second, 0)
+        self.assertGreaterEqual(lean.latency_percentile(99), lean.latency_percentile(50))
+
+    def test_recording_round_trip(self):
+        """
+        a recording written to disk should load back as the same lines, and allocations should be measured if asked
+        :return:
+        """
+        from replay import synthesize, write_recording, load_recording, replay
+        lines = synthesize(5, seed=2)
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "recording.jsonl.gz")
+            write_recording(lines, path)
+            self.assertEqual(load_recording(path), lines)
+
+        result = replay(lines, trace_allocations=True)
+        self.assertEqual(len(result.allocations), len(lines))
+        self.assertGreater(result.mean_allocation, 0)
@@ -0,0 +1,71 @@
+from unittest import TestCase
+import fakeredis
+
+
+class TestTransitions(TestCase):
+    def test_job_transitions(self):
+        """
+        job_transitions should pick up the creation time and upload annotation, and keep the first time of each status
+        :return:
+        """
+        from leanjob import LeanJob
+        from models import JobState
+        from timeline import job_transitions
+        job = LeanJob({"metadata": {"name": "cds-job", "uid": "abc", "creationTimestamp": "2021-01-01T00:00:00Z",
+                                    "annotations": {"cdsresponder/upload-received": "1609459190.5"}},
+                       "status": {}})
+        first = job_transitions(job, None, "starting", 1609459205)
+        self.assertEqual(first, {"created": 1609459200, "received": 1609459190.5, "starting": 1609459205})
+
+        previous = JobState("abc", "cds-job", "starting", 1609459205, transitions=first)
+        second = job_transitions(job, previous, "running", 1609459210)
+        self.assertEqual(second["starting"], 1609459205)
+        self.assertEqual(second["running"], 1609459210)
+        self.assertNotIn("running", first)
+
+    def test_phase_durations(self):
+        from timeline import phase_durations
+        self.assertEqual(phase_durations({"received": 90, "created": 100, "starting": 105, "running": 110, "failed": 400}),
+                         {"dispatch": 10, "startup": 10, "run": 290, "total": 310})
+        # without the upload annotation, the total is taken from when the job was created
+        self.assertEqual(phase_durations({"created": 100, "success": 150}), {"total": 50})
+
+    def test_histogram_percentile(self):
+        from timeline import histogram_percentile, bucket_index, BUCKET_BOUNDS
+        counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.assertIsNone(histogram_percentile(counts, 50))
+        counts[bucket_index(45)] = 10       # the 30-60s bucket
+        self.assertEqual(histogram_percentile(counts, 50), 45)
+        counts[bucket_index(100000)] = 1
+        self.assertEqual(histogram_percentile(counts, 99), 86400)
+
+
+class TestRouteTimeline(TestCase):
+    def test_stats(self):
+        """
+        finished jobs written through a StatusCache should be added to their route's histograms, and stats should add
+        those up over a time range
+        :return:
+        """
+        from models import JobState, StatusCache
+        from timeline import RouteTimeline
+        client = fakeredis.FakeRedis()
+        timeline = RouteTimeline(client)
+        cache = StatusCache(client, batched=True, indexers=[timeline])
+        for i, run_time in enumerate([30, 40, 50, 600]):
+            cache.put(JobState("uid-{0}".format(i), "cds-job", "success", 7200 + run_time, {"cds-route": "route-a"},
+                               {"created": 7190, "running": 7200, "success": 7200 + run_time}))
+        cache.put(JobState("uid-running", "cds-job", "running", 7200, {"cds-route": "route-b"}, {"running": 7200}))
+        cache.put(JobState("uid-other", "cds-job", "failed", 100, {"cds-route": "route-c"}, {"created": 50, "failed": 100}))
+        cache.flush()
+
+        self.assertEqual(timeline.routes(), ["route-a", "route-c"])
+        stats = timeline.stats("route-a", "run", since=3600, until=10800)
+        self.assertEqual(stats["count"], 4)
+        self.assertEqual(stats["mean"], 180)
+        self.assertTrue(30 <= stats["p50"] <= 60)
+        self.assertTrue(300 < stats["p99"] <= 600)
+        self.assertEqual(timeline.stats("route-a", "startup", since=3600, until=10800)["count"], 4)
+        self.assertEqual(timeline.stats("route-a", "dispatch", since=3600, until=10800)["count"], 0)
+        self.assertEqual(timeline.stats("route-c", "total", since=3600, until=10800)["count"], 0)
+        self.assertEqual(timeline.stats("route-c", "total", since=0, until=3599)["count"], 1)
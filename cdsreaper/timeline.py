@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+keeps duration histograms for each CDS route, built from the lifecycle of every job that finishes.
+
+    python timeline.py percentiles --since 24h [--route some-route.xml]
+
+the redis connection is configured with the same REDIS_HOST, REDIS_PORT, REDIS_DB_NUM and REDIS_PASS variables as
+cdsreaper.
+"""
+import argparse
+import datetime
+import logging
+import os
+import sys
+import time
+
+import redis
+
+import redispool
+from models import JobState
+
+logger = logging.getLogger(__name__)
+
+### Each JobState carries a `transitions` dict of the times at which the job first reached each stage of its life:
+###   received  - cdsresponder got the upload request (from the job's cdsresponder/upload-received annotation)
+###   created   - the job was created in the cluster (its creationTimestamp)
+###   starting, running, retry, success, failed - cdsreaper saw the job in that status
+### When a job finishes, the time it spent in each phase is added to a histogram for its route (the cds-route label)
+### and for the hour in which it finished. The keys are:
+###   cds:timeline:routes                   - set of every route seen
+###   cds:timeline:<route>:<hour start>     - hash of "<phase>:<bucket index>" -> count, plus "<phase>:sum" -> total seconds
+### Percentiles over any range of hours are worked out by adding up the hourly histograms.
+
+UPLOAD_RECEIVED_ANNOTATION = "cdsresponder/upload-received"
+ROUTE_LABEL = "cds-route"
+UNKNOWN_ROUTE = "unknown"
+
+# upper bounds of the histogram buckets, in seconds. anything longer goes in a final, unbounded, bucket
+BUCKET_BOUNDS = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200, 10800, 14400,
+                 21600, 43200, 86400)
+
+# phase name -> (stage it starts at, stage it ends at). "finished" is whichever of success or failed the job reached,
+# and a tuple of stages means the first of them that is known
+PHASES = {
+    "dispatch": ("received", "created"),
+    "startup": ("created", "running"),
+    "run": ("running", "finished"),
+    "total": (("received", "created"), "finished"),
+}
+
+
+def unix_time(value):
+    """
+    converts a kubernetes timestamp, either a datetime from the kubernetes models or an ISO-8601 string from the lean
+    decoder, to a unix time. returns None if there isn't one
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def job_transitions(j, previous:JobState, status:str, now:float)->dict:
+    """
+    works out the lifecycle transitions of a job that has just moved to a new status
+    :param j: V1Job or LeanJob
+    :param previous: the job's previous JobState, or None
+    :param status: the status that the job has just reached
+    :param now: the time at which it was seen in that status
+    :return: dict of stage -> unix time, for JobState.transitions
+    """
+    transitions = dict(previous.transitions) if previous is not None and previous.transitions else {}
+    if "created" not in transitions:
+        created = unix_time(j.metadata.creation_timestamp)
+        if created is not None:
+            transitions["created"] = created
+    if "received" not in transitions and j.metadata.annotations:
+        try:
+            transitions["received"] = float(j.metadata.annotations[UPLOAD_RECEIVED_ANNOTATION])
+        except (KeyError, TypeError, ValueError):
+            pass
+    if status is not None and status not in transitions:
+        transitions[status] = now
+    return transitions
+
+
+def phase_durations(transitions:dict)->dict:
+    """
+    works out how long a finished job spent in each of PHASES
+    :param transitions: JobState.transitions
+    :return: dict of phase name -> seconds, for the phases whose start and end are both known
+    """
+    stages = dict(transitions)
+    finished = [stages[s] for s in JobState.FINISHED_STATUSES if s in stages]
+    if len(finished)>0:
+        stages["finished"] = min(finished)
+
+    durations = {}
+    for phase, (start, end) in PHASES.items():
+        starts = start if isinstance(start, tuple) else (start,)
+        started_at = next((stages[s] for s in starts if s in stages), None)
+        if started_at is not None and end in stages:
+            durations[phase] = max(stages[end] - started_at, 0)
+    return durations
+
+
+def bucket_index(seconds:float)->int:
+    for i, bound in enumerate(BUCKET_BOUNDS):
+        if seconds <= bound:
+            return i
+    return len(BUCKET_BOUNDS)
+
+
+def histogram_percentile(counts:list, percentile:float):
+    """
+    estimates a percentile from a histogram, by interpolating within the bucket that it falls into
+    :param counts: list of counts for each bucket of BUCKET_BOUNDS, plus the unbounded one
+    :param percentile: 0-100
+    :return: estimate in seconds, or None if the histogram is empty
+    """
+    total = sum(counts)
+    if total==0:
+        return None
+    target = total * percentile / 100.0
+    seen = 0
+    for i, count in enumerate(counts):
+        if count > 0 and seen + count >= target:
+            lower = BUCKET_BOUNDS[i-1] if i > 0 else 0
+            if i >= len(BUCKET_BOUNDS):
+                return float(lower)
+            return lower + (BUCKET_BOUNDS[i] - lower) * (target - seen) / count
+        seen += count
+    return float(BUCKET_BOUNDS[-1])
+
+
+class RouteTimeline(object):
+    KEY_PREFIX = "cds:timeline"
+
+    def __init__(self, client:redis.Redis, retention_seconds:int=30*24*3600, bucket_seconds:int=3600):
+        """
+        :param client: redis client
+        :param retention_seconds: how long hourly histograms are kept for
+        :param bucket_seconds: how much time each histogram covers
+        """
+        self._client = client
+        self.retention_seconds = retention_seconds
+        self.bucket_seconds = bucket_seconds
+
+    @staticmethod
+    def routes_key()->str:
+        return "{0}:routes".format(RouteTimeline.KEY_PREFIX)
+
+    @staticmethod
+    def histogram_key(route:str, bucket_start:int)->str:
+        return "{0}:{1}:{2}".format(RouteTimeline.KEY_PREFIX, route, bucket_start)
+
+    def _bucket_start(self, timestamp:float)->int:
+        return int(timestamp // self.bucket_seconds) * self.bucket_seconds
+
+    def index(self, pipe:redis.client.Pipeline, state:JobState):
+        """
+        adds the commands to record a finished job's phase durations to a pipeline, e.g. the one that
+        JobState.write_many uses. does nothing for jobs that have not finished
+        :param pipe: redis pipeline
+        :param state: JobState
+        :return:
+        """
+        if not state.is_finished() or not state.transitions:
+            return
+        route = (state.labels or {}).get(ROUTE_LABEL) or UNKNOWN_ROUTE
+        bucket_start = self._bucket_start(state.transitions.get(state.status, state.timestamp))
+        key = RouteTimeline.histogram_key(route, bucket_start)
+        pipe.sadd(RouteTimeline.routes_key(), route)
+        for phase, seconds in phase_durations(state.transitions).items():
+            pipe.hincrby(key, "{0}:{1}".format(phase, bucket_index(seconds)), 1)
+            pipe.hincrbyfloat(key, "{0}:sum".format(phase), seconds)
+        pipe.expire(key, self.retention_seconds)
+
+    def routes(self)->list:
+        return sorted(r.decode("UTF-8") if isinstance(r, bytes) else r for r in self._client.smembers(RouteTimeline.routes_key()))
+
+    def stats(self, route:str, phase:str, since:float, until:float=None, percentiles=(50, 90, 99))->dict:
+        """
+        adds up the histograms for a route and phase over a time range
+        :param route: route name
+        :param phase: one of PHASES
+        :param since: unix time to start from
+        :param until: unix time to end at, defaults to now
+        :param percentiles: percentiles to estimate
+        :return: dict with "count", "mean" and "p<n>" for each percentile. the values are None if there were no jobs
+        """
+        until = until if until is not None else time.time()
+        pipe = self._client.pipeline(transaction=False)
+        bucket_start = self._bucket_start(since)
+        fields = ["{0}:{1}".format(phase, i) for i in range(len(BUCKET_BOUNDS) + 1)] + ["{0}:sum".format(phase)]
+        while bucket_start <= until:
+            pipe.hmget(RouteTimeline.histogram_key(route, bucket_start), fields)
+            bucket_start += self.bucket_seconds
+
+        counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        total_seconds = 0.0
+        for values in pipe.execute():
+            for i, value in enumerate(values[0:-1]):
+                if value is not None:
+                    counts[i] += int(value)
+            if values[-1] is not None:
+                total_seconds += float(values[-1])
+
+        total = sum(counts)
+        result = {"count": total, "mean": total_seconds / total if total > 0 else None}
+        for p in percentiles:
+            result["p{0}".format(p)] = histogram_percentile(counts, p)
+        return result
+
+
+def format_seconds(value)->str:
+    if value is None:
+        return "-"
+    if value < 120:
+        return "{0:.1f}s".format(value)
+    if value < 7200:
+        return "{0:.1f}m".format(value / 60)
+    return "{0:.1f}h".format(value / 3600)
+
+
+if __name__=="__main__":
+    from registry import parse_duration
+    parser = argparse.ArgumentParser(description="Report how long each CDS route takes")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    percentiles_parser = subparsers.add_parser("percentiles", help="duration percentiles for each route and phase")
+    percentiles_parser.add_argument("--since", type=parse_duration, default=24*3600, help="how far back to look, e.g. 24h or 7d")
+    percentiles_parser.add_argument("--route", action="append", help="route to report on, defaults to all of them")
+    percentiles_parser.add_argument("--phase", action="append", choices=list(PHASES.keys()))
+    args = parser.parse_args()
+    logging.basicConfig(format="{asctime} {name}|{funcName} [{levelname}] {message}", level=logging.WARNING, style='{')
+
+    client = redispool.get_client(os.getenv("REDIS_HOST"),
+                                  int(os.getenv("REDIS_PORT", 6379)),
+                                  int(os.getenv("REDIS_DB_NUM", 0)),
+                                  os.getenv("REDIS_PASS"))
+    timeline = RouteTimeline(client)
+    since = time.time() - args.since
+    routes = args.route if args.route else timeline.routes()
+    if len(routes)==0:
+        print("No jobs have finished yet", file=sys.stderr)
+        sys.exit(0)
+
+    print("{0:<40} {1:<9} {2:>7} {3:>8} {4:>8} {5:>8} {6:>8}".format("route", "phase", "jobs", "mean", "p50", "p90", "p99"))
+    for route in routes:
+        for phase in args.phase if args.phase else PHASES.keys():
+            s = timeline.stats(route, phase, since)
+            if s["count"]==0:
+                continue
+            print("{0:<40} {1:<9} {2:>7} {3:>8} {4:>8} {5:>8} {6:>8}".format(route, phase, s["count"], format_seconds(s["mean"]),
+                                                                           format_seconds(s["p50"]), format_seconds(s["p90"]),
+                                                                           format_seconds(s["p99"])))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+measures how cdsresponder's consumers cope with a burst of messages, with and without a prefetch limit.
+
+    python burstbench.py [--messages 2000] [--replicas 2] [--slow-replica-factor 3] [--max-peak-mb 20]
+
+a fake broker delivers a burst of upload-request-sized messages to several replicas, each a WorkerDispatcher with a
+handler that validates the message and then sleeps for `--latency` seconds (multiplied by `--slow-replica-factor` in the
+last replica, to stand in for one on a busy node).  The broker respects each replica's prefetch count in the same way as
+rabbitmq does, and hands out messages round-robin to the replicas with room for them.  It reports the wall-clock throughput,
+the peak memory held by the replicas and the share of the burst that each one took, for:
+    unlimited - no prefetch limit, as cdsresponder was before
+    fixed     - the handler's prefetch count
+    adaptive  - the same, adjusted by a PrefetchController with `--target-latency`
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from logsetup import configure_logging
+from rabbitmq.dispatcher import WorkerDispatcher
+from rabbitmq.flowcontrol import PrefetchController
+from rabbitmq.messageprocessor import MessageProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class SleepingProcessor(MessageProcessor):
+    schema = {
+        "type": "object",
+        "properties": {
+            "inmeta": {"type": "string"},
+            "routename": {"type": "string"}
+        },
+        "required": ["inmeta", "routename"]
+    }
+
+    def __init__(self, latency:float):
+        self.latency = latency
+
+    def valid_message_receive(self, channel, exchange_name, routing_key, delivery_tag, body):
+        time.sleep(self.latency)
+
+
+class FakeConsumer(object):
+    """
+    one replica's channel, as seen by the broker and by the replica's WorkerDispatcher
+    """
+    def __init__(self, broker, number:int, dispatcher:WorkerDispatcher):
+        self.broker = broker
+        self.channel_number = number
+        self.dispatcher = dispatcher
+        self.connection = SimpleNamespace(ioloop=broker)
+        self.prefetch_count = dispatcher.prefetch_count
+        self.unacked = 0
+        self.most_unacked = 0
+        self.delivered = 0
+
+    def has_room(self)->bool:
+        return self.prefetch_count==0 or self.unacked < self.prefetch_count
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.unacked -= 1
+        self.broker.acked += 1
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.unacked -= 1
+        if requeue:
+            self.broker.pending += 1
+        else:
+            self.broker.acked += 1
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        pass
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False):
+        self.prefetch_count = prefetch_count
+
+
+class FakeBroker(object):
+    """
+    a single queue holding a burst of messages, and the ioloop that all of the replicas share
+    """
+    def __init__(self, messages:int, body_size:int):
+        self.pending = messages
+        self.total = messages
+        self.acked = 0
+        self.body_size = body_size
+        self.consumers = []
+        self._callbacks = queue.Queue()
+        self._next_tag = 1
+
+    def add_callback_threadsafe(self, callback):
+        self._callbacks.put(callback)
+
+    def make_body(self)->bytes:
+        # bodies are made as they are delivered, so that the only ones in memory are those that a replica is holding
+        return json.dumps({"inmeta": "x" * self.body_size, "routename": "bench.xml", "deliverable_asset": self._next_tag}).encode("UTF-8")
+
+    def deliver(self):
+        delivered = True
+        while delivered and self.pending > 0:
+            delivered = False
+            for consumer in self.consumers:
+                if self.pending==0:
+                    break
+                if consumer.has_room():
+                    method = SimpleNamespace(delivery_tag=self._next_tag, routing_key="deliverables.syndication.bench.upload",
+                                             exchange="pluto-deliverables", consumer_tag="bench")
+                    self._next_tag += 1
+                    self.pending -= 1
+                    consumer.unacked += 1
+                    consumer.most_unacked = max(consumer.most_unacked, consumer.unacked)
+                    consumer.delivered += 1
+                    consumer.dispatcher.on_message(consumer, method, None, self.make_body())
+                    delivered = True
+
+    def run(self):
+        while self.acked < self.total:
+            self.deliver()
+            try:
+                self._callbacks.get(timeout=1)()
+                while True:
+                    self._callbacks.get_nowait()()
+            except queue.Empty:
+                pass
+
+
+def run_burst(mode:str, args)->dict:
+    broker = FakeBroker(args.messages, args.body_kb*1024)
+    for i in range(args.replicas):
+        latency = args.latency * (args.slow_replica_factor if i==args.replicas-1 and args.replicas>1 else 1)
+        if mode=="unlimited":
+            dispatcher = WorkerDispatcher(SleepingProcessor(latency), args.workers, 0)
+        elif mode=="fixed":
+            dispatcher = WorkerDispatcher(SleepingProcessor(latency), args.workers, args.prefetch)
+        else:
+            flow_control = PrefetchController(args.prefetch, args.target_latency, minimum=args.workers)
+            dispatcher = WorkerDispatcher(SleepingProcessor(latency), args.workers, flow_control=flow_control)
+        broker.consumers.append(FakeConsumer(broker, i+1, dispatcher))
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    broker.run()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    for consumer in broker.consumers:
+        consumer.dispatcher.shutdown(wait=True)
+
+    return {
+        "mode": mode,
+        "messages_per_sec": args.messages / elapsed,
+        "peak_mb": peak / (1024*1024),
+        "shares": [c.delivered / args.messages for c in broker.consumers],
+        "most_unacked": [c.most_unacked for c in broker.consumers],
+        "final_prefetch": [c.prefetch_count for c in broker.consumers],
+    }
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Benchmark cdsresponder's consumers under a burst of messages")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--replicas", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=4, help="worker threads in each replica")
+    parser.add_argument("--prefetch", type=int, default=16, help="prefetch count for the fixed and adaptive runs")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds that handling each message takes")
+    parser.add_argument("--slow-replica-factor", type=float, default=3, help="how much slower the last replica handles messages")
+    parser.add_argument("--target-latency", type=float, default=0.012, help="target latency for the adaptive run")
+    parser.add_argument("--body-kb", type=int, default=16, help="size of each message's inmeta")
+    parser.add_argument("--mode", action="append", choices=["unlimited", "fixed", "adaptive"], help="defaults to all three")
+    parser.add_argument("--max-peak-mb", type=float, default=None, help="fail if a limited run's peak memory is higher than this")
+    parser.add_argument("--min-messages-per-sec", type=float, default=None, help="fail if a limited run's throughput is lower than this")
+    args = parser.parse_args()
+    configure_logging(dict(os.environ, LOG_LEVEL=args.log_level))
+
+    print("{0:<10} {1:>10} {2:>9} {3:>24} {4:>16} {5:>16}".format("mode", "msgs/sec", "peak MB", "share of burst", "most unacked", "final prefetch"))
+    failures = []
+    for mode in args.mode if args.mode else ["unlimited", "fixed", "adaptive"]:
+        result = run_burst(mode, args)
+        print("{0:<10} {1:>10.0f} {2:>9.1f} {3:>24} {4:>16} {5:>16}".format(
+            mode, result["messages_per_sec"], result["peak_mb"],
+            " ".join("{0:.0%}".format(s) for s in result["shares"]),
+            " ".join(str(u) for u in result["most_unacked"]),
+            " ".join(str(p) for p in result["final_prefetch"])))
+        if mode=="unlimited":
+            continue
+        if args.max_peak_mb is not None and result["peak_mb"] > args.max_peak_mb:
+            failures.append("{0} peak memory {1:.1f}MB is above {2}MB".format(mode, result["peak_mb"], args.max_peak_mb))
+        if args.min_messages_per_sec is not None and result["messages_per_sec"] < args.min_messages_per_sec:
+            failures.append("{0} throughput {1:.0f} messages/sec is below {2}".format(mode, result["messages_per_sec"], args.min_messages_per_sec))
+
+    for f in failures:
+        print("FAILED: {0}".format(f))
+    sys.exit(1 if len(failures)>0 else 0)
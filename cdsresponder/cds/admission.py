@@ -0,0 +1,176 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+### AdmissionController limits the number of CDS jobs that run at once, in total and for each route, so that a burst of
+### upload requests is worked through at a steady rate rather than creating hundreds of jobs at the same time.
+### The running jobs are counted from a JobInformer.  A job that has just been launched may not have reached the
+### informer yet, so each launch holds a reservation until the informer has seen the job (or `reservation_timeout` has
+### passed, in case it never does).
+### A handler that can't be admitted waits, with its message unacked, until a job finishes.  Since the broker sends no
+### more messages than the prefetch count, the rest of a burst stays on the queue in the meantime.
+### When capacity frees up, the waiting handlers are let through highest priority first, then in the order they arrived.
+
+
+def parse_route_limits(spec:str)->dict:
+    """
+    parses route limits like "route-one.xml=2,route-two.xml=5"
+    :param spec: string to parse, or None
+    :return: dict of route -> maximum number of jobs
+    """
+    limits = {}
+    for part in (spec or "").split(","):
+        if part.strip()=="":
+            continue
+        route, sep, value = part.rpartition("=")
+        if sep=="" or route.strip()=="":
+            raise ValueError("Invalid route limit '{0}', expected route=number".format(part))
+        limits[route.strip()] = int(value)
+    return limits
+
+
+class Reservation(object):
+    def __init__(self, route:str):
+        self.route = route
+        self.created = time.monotonic()
+        self.uid = None
+
+
+class Waiter(object):
+    def __init__(self, route:str, priority:int, sequence:int):
+        self.route = route
+        self.priority = priority
+        self.sequence = sequence
+
+    def goes_before(self, other)->bool:
+        return (self.priority, -self.sequence) > (other.priority, -other.sequence)
+
+
+class AdmissionController(object):
+    def __init__(self, informer, max_jobs:int=0, max_jobs_per_route:int=0, route_limits:dict=None,
+                 reservation_timeout:float=120):
+        """
+        :param informer: JobInformer for the CDS jobs
+        :param max_jobs: maximum number of jobs at once, 0 for no limit
+        :param max_jobs_per_route: maximum number of jobs at once for any one route, 0 for no limit
+        :param route_limits: dict of route -> maximum number of jobs, overriding max_jobs_per_route
+        :param reservation_timeout: number of seconds after which a launch that the informer has not seen stops counting
+        """
+        self.informer = informer
+        self.max_jobs = max_jobs
+        self.max_jobs_per_route = max_jobs_per_route
+        self.route_limits = route_limits if route_limits is not None else {}
+        self.reservation_timeout = reservation_timeout
+        self._reservations = []
+        self._waiters = []
+        self._sequence = 0
+        self._closed = False
+        self._changed = threading.Condition()
+        informer.on_change.append(self.notify)
+
+    def notify(self):
+        """
+        wakes up any handlers that are waiting, e.g. when a job has finished
+        """
+        with self._changed:
+            self._changed.notify_all()
+
+    def close(self):
+        """
+        makes every handler that is waiting for capacity, and any that would wait from now on, give up straight away,
+        e.g. because the responder is shutting down
+        """
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+    def route_limit(self, route:str)->int:
+        return self.route_limits.get(route, self.max_jobs_per_route)
+
+    def _counts(self):
+        """
+        counts the jobs that are running or about to, dropping reservations that are no longer needed.
+        must be called with the condition held
+        :return: tuple of (total, dict of route -> count)
+        """
+        now = time.monotonic()
+        self._reservations = [r for r in self._reservations
+                              if not (r.uid is not None and self.informer.has_seen(r.uid))
+                              and now - r.created < self.reservation_timeout]
+        by_route = {}
+        routes = list(self.informer.active_jobs().values()) + [r.route for r in self._reservations]
+        for route in routes:
+            by_route[route] = by_route.get(route, 0) + 1
+        return len(routes), by_route
+
+    def _has_capacity(self, route:str, counts:tuple)->bool:
+        total, by_route = counts
+        if self.max_jobs > 0 and total >= self.max_jobs:
+            return False
+        limit = self.route_limit(route)
+        return limit <= 0 or by_route.get(route, 0) < limit
+
+    def _can_admit(self, waiter:Waiter)->bool:
+        """
+        a waiter can be admitted if there is capacity for its route, and none for any waiter that goes before it
+        """
+        counts = self._counts()
+        if not self._has_capacity(waiter.route, counts):
+            return False
+        return not any(other.goes_before(waiter) and self._has_capacity(other.route, counts) for other in self._waiters)
+
+    def acquire(self, route:str, timeout:float=None, priority:int=0):
+        """
+        waits until a job for the given route can be launched
+        :param route: route of the job, as it appears in the job's route label
+        :param timeout: maximum number of seconds to wait, None to wait for ever
+        :param priority: requests with a higher priority are admitted first
+        :return: a Reservation to pass to confirm() or release(), or None if there was no capacity before the timeout or
+        the controller has been closed
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._changed:
+            if not self.informer.synced.is_set():
+                logger.info("Waiting for the job informer to list the running jobs before admitting a job")
+            self._sequence += 1
+            waiter = Waiter(route, priority, self._sequence)
+            self._waiters.append(waiter)
+            try:
+                while not (self.informer.synced.is_set() and self._can_admit(waiter)):
+                    remaining = deadline - time.monotonic() if deadline is not None else None
+                    if self._closed or (remaining is not None and remaining <= 0):
+                        return None
+                    # wake up now and again anyway, so that timed-out reservations are dropped
+                    self._changed.wait(min(remaining, 30) if remaining is not None else 30)
+                reservation = Reservation(route)
+                self._reservations.append(reservation)
+                return reservation
+            finally:
+                self._waiters.remove(waiter)
+                # whether this one was admitted or gave up, the others may need to look again
+                self._changed.notify_all()
+
+    def confirm(self, reservation:Reservation, uid:str):
+        """
+        records the uid of the job that was launched, so that its reservation can be dropped once the informer has seen it
+        """
+        with self._changed:
+            reservation.uid = uid
+
+    def release(self, reservation:Reservation):
+        """
+        gives up a reservation, e.g. because the job could not be launched
+        """
+        with self._changed:
+            if reservation in self._reservations:
+                self._reservations.remove(reservation)
+            self._changed.notify_all()
+
+    def running(self)->tuple:
+        """
+        :return: tuple of (total jobs running or about to, dict of route -> count)
+        """
+        with self._changed:
+            return self._counts()
@@ -1,10 +1,12 @@
 from kubernetes import client, config
 import kubernetes.client.models
+import copy
 import logging
-from hikaru import load_full_yaml, Job, get_clean_dict
 import pathlib
 import os
 import re
+import threading
+import yaml
 from k8s.k8utils import get_current_namespace
 
 logger = logging.getLogger(__name__)
@@ -15,6 +17,18 @@ class NotInCluster(Exception):
 
 
 class CDSLauncher(object):
+    # every job we create carries this label, so that cdsreaper can watch only our jobs with a label selector
+    MANAGED_BY_LABEL = "app.kubernetes.io/managed-by"
+    MANAGED_BY_VALUE = "cdsresponder"
+
+    # the job template is parsed once into a plain dict and kept here, then re-read only when the file's mtime or size
+    # changes (e.g. when a mounted ConfigMap is updated).  Each job doc is a deep copy of it with its own name, command,
+    # labels and annotations patched in.
+    _template_lock = threading.Lock()
+    _template_path = None
+    _template_stat = None
+    _template = None
+
     def __init__(self, namespace:str):
         try:
             config.load_incluster_config()
@@ -34,42 +48,86 @@ class CDSLauncher(object):
         logger.info("Startup - we are in namespace {0}".format(self.namespace))
 
     def find_job_template(self):
-        filepath = os.path.join(os.getenv("TEMPLATES_PATH"), "cdsjob.yaml")
-        if os.path.exists(filepath):
-            return filepath
-        filepath = os.path.join(pathlib.Path(__name__).parent.absolute(), "templates","cdsjob.yaml")
-        if os.path.exists(filepath):
-            return filepath
-        filepath = "/etc/cdsresponder/templates/cdsjob.yaml"
-        if os.path.exists(filepath):
-            return filepath
+        candidates = [
+            os.path.join(os.getenv("TEMPLATES_PATH"), "cdsjob.yaml") if os.getenv("TEMPLATES_PATH") else None,
+            os.path.join(pathlib.Path(__file__).parent.parent.absolute(), "templates", "cdsjob.yaml"),
+            "/etc/cdsresponder/templates/cdsjob.yaml",
+        ]
+        for filepath in candidates:
+            if filepath is not None and os.path.exists(filepath):
+                return filepath
         raise RuntimeError("No path to cdsjob could be found")
 
-    def load_job_template(self):
-        filepath = self.find_job_template()
-        logger.debug("Loading job template from {0}".format(filepath))
-        loaded = load_full_yaml(filepath)
+    @staticmethod
+    def parse_job_template(filepath:str)->dict:
+        """
+        reads the first Job from a yaml file
+        :param filepath: path to the yaml file
+        :return: the Job as a dict
+        """
+        logger.info("Loading job template from {0}".format(filepath))
+        with open(filepath, "r") as f:
+            loaded = [doc for doc in yaml.safe_load_all(f) if doc is not None]
         if len(loaded)==0:
             raise ValueError("Nothing was defined in cdsjob.yaml")
-        jobs = [x for x in loaded if isinstance(x, Job)]
+        jobs = [x for x in loaded if isinstance(x, dict) and x.get("kind")=="Job"]
         if len(jobs)==0:
             raise ValueError("Of {0} objects defined in cdsjob.yaml, none of them was a Job".format(len(loaded)))
+        try:
+            if not isinstance(jobs[0]["spec"]["template"]["spec"]["containers"][0], dict):
+                raise TypeError("container is not an object")
+        except (KeyError, IndexError, TypeError) as e:
+            raise ValueError("The Job in cdsjob.yaml has no container to run: {0}".format(str(e)))
         return jobs[0]
 
-    def build_job_doc(self, job_name:str, cmd:list, labels:dict):
-        content_template = self.load_job_template()
-        if not isinstance(content_template, Job):
-            raise TypeError("cdsjob template must be for a Job, we got a {0}!".format(content_template.__class__.__name__))
+    def load_job_template(self)->dict:
+        """
+        returns the parsed job template, reading it again only if the file has changed since it was last read.
+        don't modify the result, take a copy
+        :return: the Job as a dict
+        """
+        with CDSLauncher._template_lock:
+            filepath = CDSLauncher._template_path
+            try:
+                if filepath is None:
+                    raise FileNotFoundError()
+                st = os.stat(filepath)
+            except FileNotFoundError:
+                filepath = self.find_job_template()
+                st = os.stat(filepath)
+
+            stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+            if filepath!=CDSLauncher._template_path or stat_key!=CDSLauncher._template_stat:
+                CDSLauncher._template = CDSLauncher.parse_job_template(filepath)
+                CDSLauncher._template_path = filepath
+                CDSLauncher._template_stat = stat_key
+            return CDSLauncher._template
+
+    def build_job_doc(self, job_name:str, cmd:list, labels:dict, annotations:dict=None, priority_class_name:str=None)->dict:
+        content = copy.deepcopy(self.load_job_template())
+        metadata = content.get("metadata")
+        if metadata is None:
+            metadata = {}
+            content["metadata"] = metadata
 
-        content_template.metadata.name = self.sanitise_job_name(job_name)
-        content_template.spec.template.spec.containers[0].command = cmd
-        existing_labels = content_template.metadata.labels
+        metadata["name"] = self.sanitise_job_name(job_name)
+        content["spec"]["template"]["spec"]["containers"][0]["command"] = cmd
+        if priority_class_name:
+            content["spec"]["template"]["spec"]["priorityClassName"] = priority_class_name
+        existing_labels = metadata.get("labels")
         if existing_labels is None:
             existing_labels = {}
         existing_labels.update(labels)
-        content_template.metadata.labels = existing_labels
+        existing_labels[CDSLauncher.MANAGED_BY_LABEL] = CDSLauncher.MANAGED_BY_VALUE
+        metadata["labels"] = existing_labels
+        if annotations:
+            existing_annotations = metadata.get("annotations")
+            if existing_annotations is None:
+                existing_annotations = {}
+            existing_annotations.update(annotations)
+            metadata["annotations"] = existing_annotations
 
-        return get_clean_dict(content_template)
+        return content
 
     @staticmethod
     def sanitise_job_name(job_name:str) -> str:
@@ -88,7 +146,8 @@ class CDSLauncher(object):
         fourth_sub = re.sub(r'^[^a-z0-9]+', "", third_sub)
         return fourth_sub
 
-    def launch_cds_job(self, inmeta_path: str, job_name: str, route_name: str, labels:dict) -> kubernetes.client.models.V1Job:
+    def launch_cds_job(self, inmeta_path: str, job_name: str, route_name: str, labels:dict, annotations:dict=None,
+                       priority_class_name:str=None) -> kubernetes.client.models.V1Job:
         command_parts = [
             "/usr/local/bin/cds_run.pl",
             "--input-inmeta",
@@ -96,8 +155,8 @@ class CDSLauncher(object):
             "--route",
             route_name
         ]
-        jobdoc = self.build_job_doc(job_name, command_parts, labels)
-        logger.debug("Built job doc for submission: {0}".format(jobdoc))
+        jobdoc = self.build_job_doc(job_name, command_parts, labels, annotations, priority_class_name)
+        logger.debug("Built job doc for submission: %s", jobdoc)
         return self.batch.create_namespaced_job(
             body=jobdoc,
             namespace=self.namespace
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+### LaunchDeduplicator stops the same upload request from starting a second CDS job, e.g. when the responder stopped
+### between launching the job and acking the message, or the request was published twice.
+### Each request has an idempotency key, a hash of its deliverable asset, bundle, route and inmeta, and every job is
+### labelled with the key of the request that started it.  Before a job is launched the key is looked up, first in a
+### cache of the jobs that this replica has launched or found in the last `window` seconds, then by listing the jobs
+### with that label, which also finds jobs launched before a restart or by another replica.
+### A job that failed doesn't count, so a request can be sent again to retry it.  Finished jobs are normally deleted by
+### K8MessageProcessor, which calls forget_job() when one fails so that it is dropped from the cache too.
+
+
+def idempotency_key(body:dict)->str:
+    """
+    :param body: upload request
+    :return: sha1 hex digest identifying the request, short enough to use as a label value
+    """
+    content = json.dumps([body.get("deliverable_asset"), body.get("deliverable_bundle"), body.get("routename"),
+                          body.get("inmeta")])
+    return hashlib.sha1(content.encode("UTF-8")).hexdigest()
+
+
+def job_has_failed(job)->bool:
+    if job.status is None or job.status.conditions is None:
+        return False
+    return any(c.type=="Failed" and c.status=="True" for c in job.status.conditions)
+
+
+class LaunchedJob(object):
+    """
+    the job that an idempotency key refers to
+    """
+    def __init__(self, uid:str, name:str, namespace:str, created:float=None):
+        self.uid = uid
+        self.name = name
+        self.namespace = namespace
+        self.created = created if created is not None else time.time()
+
+    @staticmethod
+    def from_job(job):
+        """
+        :param job: V1Job
+        :return: LaunchedJob
+        """
+        created = job.metadata.creation_timestamp
+        return LaunchedJob(job.metadata.uid, job.metadata.name, job.metadata.namespace,
+                           created.timestamp() if created is not None else None)
+
+    def __repr__(self):
+        return "LaunchedJob(uid={0}, name={1}, namespace={2})".format(self.uid, self.name, self.namespace)
+
+
+class LaunchDeduplicator(object):
+    KEY_LABEL = "cds-idempotency-key"
+
+    def __init__(self, batch, namespace:str, window:float=3600, lookup_timeout:float=600):
+        """
+        :param batch: BatchV1Api used to look up jobs by their label
+        :param namespace: namespace that the jobs run in
+        :param window: number of seconds for which a request counts as a duplicate of an earlier one
+        :param lookup_timeout: maximum number of seconds to wait for another thread that is launching the same request
+        """
+        self.batch = batch
+        self.namespace = namespace
+        self.window = window
+        self.lookup_timeout = lookup_timeout
+        self._cache = {}        # key -> (expiry time, LaunchedJob)
+        self._pending = set()   # keys that a thread is launching a job for
+        self._changed = threading.Condition()
+
+    def _cached(self, key:str):
+        """
+        must be called with the condition held
+        :return: the cached LaunchedJob for the key, or None
+        """
+        now = time.monotonic()
+        expired = [k for k, (expiry, _) in self._cache.items() if expiry <= now]
+        for k in expired:
+            del self._cache[k]
+        entry = self._cache.get(key)
+        return entry[1] if entry is not None else None
+
+    def _remember(self, key:str, job:LaunchedJob):
+        remaining = self.window - max(time.time() - job.created, 0)
+        if remaining > 0:
+            self._cache[key] = (time.monotonic() + remaining, job)
+
+    def find_existing(self, key:str):
+        """
+        looks for a job in the cluster with the given key that was created within the window and has not failed
+        :param key: idempotency key
+        :return: LaunchedJob, or None
+        """
+        job_list = self.batch.list_namespaced_job(self.namespace, label_selector="{0}={1}".format(self.KEY_LABEL, key))
+        cutoff = time.time() - self.window
+        found = [LaunchedJob.from_job(job) for job in job_list.items if not job_has_failed(job)]
+        found = [job for job in found if job.created >= cutoff]
+        if len(found)==0:
+            return None
+        return max(found, key=lambda job: job.created)
+
+    def claim(self, key:str):
+        """
+        checks whether a job has already been launched for the key.  If not, the caller must launch it and then call
+        record() or, if it could not, abandon()
+        :param key: idempotency key
+        :return: the LaunchedJob that already exists, or None if the caller should launch one
+        """
+        deadline = time.monotonic() + self.lookup_timeout
+        with self._changed:
+            # another thread has the same request, wait to see whether it launches the job
+            while key in self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("Timed out waiting for another launch of {0}".format(key))
+                self._changed.wait(remaining)
+            existing = self._cached(key)
+            if existing is not None:
+                return existing
+            self._pending.add(key)
+
+        try:
+            existing = self.find_existing(key)
+        except Exception as e:
+            # this only stops duplicates, so carry on and launch if the cluster can't be asked
+            logger.warning("Could not look up jobs for idempotency key {0}: {1}".format(key, str(e)))
+            existing = None
+        if existing is not None:
+            self.record(key, existing)
+        return existing
+
+    def record(self, key:str, job:LaunchedJob):
+        """
+        remembers the job launched for the key
+        """
+        with self._changed:
+            self._pending.discard(key)
+            self._remember(key, job)
+            self._changed.notify_all()
+
+    def abandon(self, key:str):
+        """
+        gives up a claim without launching a job
+        """
+        with self._changed:
+            self._pending.discard(key)
+            self._changed.notify_all()
+
+    def forget_job(self, uid:str):
+        """
+        drops a job from the cache, e.g. because it failed, so that the request can be tried again
+        """
+        with self._changed:
+            for key in [k for k, (_, job) in self._cache.items() if job.uid==uid]:
+                del self._cache[key]
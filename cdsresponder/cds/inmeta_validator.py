@@ -0,0 +1,144 @@
+import lxml.etree as xml
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+### InmetaValidator checks inmeta documents against inmeta.xsd.  The schema is attached to the parser, so that the
+### document is validated as it is parsed rather than being parsed into a tree and then walked again.  lxml parsers and
+### schemas can't be shared between threads, so each thread gets a parser of its own, and the errors for each document
+### are returned with its result rather than being read back from the shared schema's error_log.
+### Documents of `process_threshold` bytes or more are validated in a pool of processes instead, since validation holds
+### the GIL and a large document would otherwise hold up every other thread, including the one talking to rabbitmq.
+### If a process in the pool dies, e.g. because it was killed for using too much memory, the whole pool is broken, so it
+### is thrown away and a new one started.
+
+
+class InmetaValidationResult(object):
+    """
+    the outcome of validating one inmeta document.  It is truthy if the document was valid
+    """
+    def __init__(self, valid:bool, errors:list=None):
+        self.valid = valid
+        self.errors = errors if errors is not None else []
+
+    def __bool__(self):
+        return self.valid
+
+    def __repr__(self):
+        return "InmetaValidationResult(valid={0}, errors={1})".format(self.valid, self.errors)
+
+    @property
+    def error_message(self)->str:
+        return "\n".join(self.errors)
+
+
+class SchemaParser(object):
+    """
+    a parser with the inmeta schema attached.  Not thread-safe, so there is one for each thread or process
+    """
+    def __init__(self, xsd_path:str):
+        self.schema = xml.XMLSchema(file=xsd_path)
+        self.parser = xml.XMLParser(schema=self.schema, resolve_entities=False, no_network=True)
+
+    def parse_and_validate(self, content)->InmetaValidationResult:
+        """
+        parses and validates a document in one pass
+        :param content: document, as a string or bytes
+        :return: InmetaValidationResult
+        """
+        if isinstance(content, str):
+            # lxml won't parse a string that has an encoding declaration
+            content = content.encode("UTF-8")
+        try:
+            xml.fromstring(content, self.parser)
+            return InmetaValidationResult(True)
+        except xml.XMLSyntaxError as e:
+            # the parser's error log only has this document's errors, unlike the exception's, which can carry on
+            # from earlier ones
+            errors = ["line {0}: {1}".format(entry.line, entry.message) if entry.line > 0 else entry.message
+                      for entry in self.parser.error_log]
+            return InmetaValidationResult(False, errors if len(errors)>0 else [str(e)])
+
+
+# each process in the pool keeps one parser, made by _init_process
+_process_parser = None
+
+
+def _init_process(xsd_path:str):
+    global _process_parser
+    _process_parser = SchemaParser(xsd_path)
+
+
+def _validate_in_process(content)->InmetaValidationResult:
+    return _process_parser.parse_and_validate(content)
+
+
+class InmetaValidator(object):
+    def __init__(self, xsd_path:str, process_threshold:int=0, max_processes:int=2):
+        """
+        :param xsd_path: path to the inmeta schema
+        :param process_threshold: documents of this many bytes or more are validated in a separate process. 0 to
+        validate everything on the calling thread
+        :param max_processes: number of processes in the pool
+        """
+        self.xsd_path = xsd_path
+        self.process_threshold = process_threshold
+        self.max_processes = max_processes
+        self._local = threading.local()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._parser()      # fail straight away if the schema can't be loaded
+
+    def _parser(self)->SchemaParser:
+        parser = getattr(self._local, "parser", None)
+        if parser is None:
+            parser = SchemaParser(self.xsd_path)
+            self._local.parser = parser
+        return parser
+
+    def _get_pool(self)->ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                # the responder has several threads running, so start clean processes rather than forking
+                self._pool = ProcessPoolExecutor(max_workers=self.max_processes,
+                                                 mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=_init_process,
+                                                 initargs=(self.xsd_path,))
+            return self._pool
+
+    def _drop_pool(self, pool:ProcessPoolExecutor):
+        """
+        throws away a pool that is broken, unless another thread has already replaced it
+        """
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def validate(self, content)->InmetaValidationResult:
+        """
+        validates an inmeta document. Large documents are sent to the process pool, and this waits for the result.
+        If the pool is broken it is replaced, and the document is tried once more in the new one
+        :param content: document, as a string or bytes
+        :return: InmetaValidationResult
+        """
+        if self.process_threshold > 0 and len(content) >= self.process_threshold:
+            logger.debug("Validating %s byte inmeta document in a separate process", len(content))
+            pool = self._get_pool()
+            try:
+                return pool.submit(_validate_in_process, content).result()
+            except BrokenProcessPool as e:
+                logger.warning("Inmeta validation process pool is broken, starting a new one: {0}".format(str(e)))
+                self._drop_pool(pool)
+                return self._get_pool().submit(_validate_in_process, content).result()
+        return self._parser().parse_and_validate(content)
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
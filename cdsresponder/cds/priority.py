@@ -0,0 +1,76 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+### Each upload request is given a priority level, from its own `priority` field if it has one, otherwise from its route
+### (ROUTE_PRIORITIES) or the default (DEFAULT_PRIORITY).  The level decides:
+###   - the order in which requests waiting for admission are let through, see AdmissionController
+###   - the PriorityClass that the job's pod is given (PRIORITY_CLASS_LOW, PRIORITY_CLASS_NORMAL, PRIORITY_CLASS_HIGH), so
+###     that the scheduler places urgent pods first and can pre-empt bulk ones for them
+### The order in which rabbitmq delivers the requests depends on the `priority` property that the publisher gives each
+### message, once the queue is declared with x-max-priority (see UPLOAD_REQUEST_MAX_PRIORITY).  LEVEL_PRIORITIES gives
+### the property values that correspond to each level.
+
+PRIORITY_LEVELS = ("low", "normal", "high")
+LEVEL_PRIORITIES = {"low": 1, "normal": 5, "high": 9}
+
+
+def parse_route_priorities(spec:str)->dict:
+    """
+    parses route priorities like "news-clip.xml=high,backfill.xml=low"
+    :param spec: string to parse, or None
+    :return: dict of route -> priority level
+    """
+    levels = {}
+    for part in (spec or "").split(","):
+        if part.strip()=="":
+            continue
+        route, sep, level = part.rpartition("=")
+        level = level.strip().lower()
+        if sep=="" or route.strip()=="" or level not in PRIORITY_LEVELS:
+            raise ValueError("Invalid route priority '{0}', expected route=low, route=normal or route=high".format(part))
+        levels[route.strip()] = level
+    return levels
+
+
+class PriorityPolicy(object):
+    def __init__(self, route_levels:dict=None, priority_classes:dict=None, default_level:str="normal"):
+        """
+        :param route_levels: dict of route name -> priority level
+        :param priority_classes: dict of priority level -> name of a kubernetes PriorityClass
+        :param default_level: level for requests that don't have one and whose route isn't in route_levels
+        """
+        if default_level not in PRIORITY_LEVELS:
+            raise ValueError("Invalid default priority '{0}', expected one of {1}".format(default_level, ", ".join(PRIORITY_LEVELS)))
+        self.route_levels = route_levels if route_levels is not None else {}
+        self.priority_classes = priority_classes if priority_classes is not None else {}
+        self.default_level = default_level
+
+    @staticmethod
+    def from_environment(environ=None):
+        environ = environ if environ is not None else os.environ
+        return PriorityPolicy(parse_route_priorities(environ.get("ROUTE_PRIORITIES")),
+                              {level: environ["PRIORITY_CLASS_{0}".format(level.upper())] for level in PRIORITY_LEVELS
+                               if environ.get("PRIORITY_CLASS_{0}".format(level.upper()))},
+                              environ.get("DEFAULT_PRIORITY", "normal").lower())
+
+    def level_for(self, body:dict)->str:
+        """
+        :param body: upload request
+        :return: the request's priority level
+        """
+        requested = body.get("priority")
+        if requested is not None:
+            return requested
+        return self.route_levels.get(body.get("routename"), self.default_level)
+
+    @staticmethod
+    def queue_priority(level:str)->int:
+        return LEVEL_PRIORITIES[level]
+
+    def priority_class(self, level:str):
+        """
+        :return: name of the PriorityClass for jobs at this level, or None to leave it to the cluster's default
+        """
+        return self.priority_classes.get(level)
@@ -8,28 +8,36 @@ import re
 from functools import partial
 import sys
 import signal
+import threading
+import time
+from logsetup import configure_logging
+from rabbitmq.dispatcher import WorkerDispatcher
 
-logging.basicConfig(format="{asctime} {name}|{funcName} [{levelname}] {message}",level=logging.DEBUG,style='{')
-pikaLogger = logging.getLogger("pika")
-pikaLogger.level=logging.WARN
+configure_logging()
 logger = logging.getLogger(__name__)
 
 
 class Command(object):
+    def __init__(self):
+        self.dispatchers = []
+        self.exit_code = 0
+
     @staticmethod
     def declare_rabbitmq_setup(channel:pika.channel.Channel):
         channel.exchange_declare(exchange="cdsresponder-dlx", exchange_type="direct", durable=True)
         channel.exchange_declare(exchange="cdsresponder", exchange_type="topic", durable=True)
 
     @staticmethod
-    def connect_channel(exchange_name, handler, channel):
+    def connect_channel(exchange_name, dispatcher:WorkerDispatcher, channel, max_priority:int=0):
         """
         async callback that is used to connect a channel once it has been declared
         :param channel: channel to set up
         :param exchange_name: str name of the exchange to connect to
-        :param handler: a MessageProcessor class (NOT instance)
+        :param dispatcher: a WorkerDispatcher wrapping the MessageProcessor instance that handles the messages
+        :param max_priority: if more than 0, the queue is declared as a priority queue with this many levels
         :return:
         """
+        handler = dispatcher.handler
         logger.info("Establishing connection to exchange {0} from {1}...".format(exchange_name, handler.__class__.__name__))
         sanitised_routingkey = re.sub(r'[^\w\d]', '', handler.routing_key)
 
@@ -38,15 +46,21 @@ class Command(object):
         channel.queue_declare("cdsresponder-dlq", durable=True)
         channel.queue_bind("cdsresponder-dlq","cdsresponder-dlx")
 
-        channel.queue_declare(queuename, arguments={
+        queue_args = {
             'x-dead-letter-exchange': "cdsresponder-dlx"
-        })
+        }
+        if max_priority > 0:
+            # rabbitmq won't redeclare an existing queue with different arguments, so this is opt-in
+            queue_args['x-max-priority'] = max_priority
+        channel.queue_declare(queuename, arguments=queue_args)
         channel.queue_bind(queuename, exchange_name, routing_key=handler.routing_key)
+        # pika sends these in order, so the limit is in place before the first message is delivered
+        channel.basic_qos(prefetch_count=dispatcher.prefetch_count, global_qos=True)
         channel.basic_consume(queuename,
-                              handler.raw_message_receive,
+                              dispatcher.on_message,
                               auto_ack=False,
                               exclusive=False,
-                              callback=lambda consumer: logger.info("Consumer started for {0} from {1}".format(queuename, exchange_name)),
+                              callback=lambda consumer: logger.info("Consumer started for {0} from {1} with prefetch count {2}".format(queuename, exchange_name, dispatcher.prefetch_count)),
                               )
 
     def channel_opened(self, connection):
@@ -59,11 +73,14 @@ class Command(object):
         from rabbitmq.mappings import EXCHANGE_MAPPINGS
         logger.info("Connection opened")
         for i in range(0, len(EXCHANGE_MAPPINGS)):
+            dispatcher = WorkerDispatcher.from_mapping(EXCHANGE_MAPPINGS[i])
+            self.dispatchers.append(dispatcher)
             # partial adjusts the argument list, adding the args here onto the _start_ of the list
-            # so the args are (exchange, handler, channel) not (channel, exchange, handler)
+            # so the args are (exchange, dispatcher, channel) not (channel, exchange, dispatcher)
             chl = connection.channel(on_open_callback=partial(Command.connect_channel,
                                                               EXCHANGE_MAPPINGS[i]["exchange"],
-                                                              EXCHANGE_MAPPINGS[i]["handler"]),
+                                                              dispatcher,
+                                                              max_priority=EXCHANGE_MAPPINGS[i].get("max_priority", 0)),
                                      )
             chl.add_on_close_callback(self.channel_closed)
             chl.add_on_cancel_callback(self.channel_closed)
@@ -102,14 +119,27 @@ class Command(object):
 
         self.runloop = connection.ioloop
 
+        # this should be less than the pod's termination grace period, which is 30s by default
+        shutdown_wait = float(os.getenv("SHUTDOWN_WAIT_SECONDS", 20))
+
+        def drain_and_stop():
+            # requeue the messages that have not started, and give the ones that are being processed a while to finish
+            # so that they can still be acked, before stopping
+            deadline = time.monotonic() + shutdown_wait
+            for dispatcher in self.dispatchers:
+                dispatcher.shutdown(wait=True, timeout=max(deadline - time.monotonic(), 0), requeue_waiting=True)
+            connection.ioloop.add_callback_threadsafe(connection.ioloop.stop)
+
         def on_quit(signum, frame):
-            logger.info("Caught signal {0}, exiting...".format(signum))
-            connection.ioloop.stop()
+            logger.info("Caught signal {0}, waiting for messages in progress then exiting...".format(signum))
+            threading.Thread(target=drain_and_stop, name="DispatcherShutdown", daemon=True).start()
 
         signal.signal(signal.SIGINT, on_quit)
         signal.signal(signal.SIGTERM, on_quit)
 
         connection.ioloop.start()
+        for dispatcher in self.dispatchers:
+            dispatcher.shutdown(wait=False)
         logger.info("terminated")
         sys.exit(self.exit_code)
 
@@ -0,0 +1,177 @@
+import logging
+import threading
+
+import kubernetes.client.exceptions
+from kubernetes import client, watch
+
+logger = logging.getLogger(__name__)
+
+### JobInformer keeps a local copy of the CDS jobs in the namespace that have not yet finished, so that the number
+### running can be checked without a call to the API server.  It lists the jobs once, a page at a time, then follows a
+### watch from the list's resource version, starting again with a fresh list if the watch falls too far behind (410 Gone) or fails.
+### Every change is passed to the `on_change` callbacks, on the informer's own thread.
+### kubernetes.watch.Watch ends the stream quietly on a 410 rather than raising it when `timeout_seconds` is given, which
+### would leave us watching the same expired resource version for ever, so StrictWatch raises every ERROR event instead.
+
+
+def job_is_finished(job)->bool:
+    """
+    :param job: V1Job
+    :return: True if the job has completed or failed
+    """
+    if job.status is None or job.status.conditions is None:
+        return False
+    return any(c.type in ("Complete", "Failed") and c.status=="True" for c in job.status.conditions)
+
+
+class StrictWatch(watch.Watch):
+    """
+    kubernetes.watch.Watch, except that an ERROR event from the server is always raised as an ApiException
+    """
+    def unmarshal_event(self, data, return_type):
+        event = super().unmarshal_event(data, return_type)
+        if event["type"]=="ERROR":
+            obj = event["raw_object"]
+            raise kubernetes.client.exceptions.ApiException(status=obj.get("code"),
+                                                            reason="{0}: {1}".format(obj.get("reason"), obj.get("message")))
+        return event
+
+
+class JobInformer(object):
+    def __init__(self, namespace:str, label_selector:str, route_label:str, batch:client.BatchV1Api=None,
+                 watch_timeout:int=300, retry_delay:float=5, page_size:int=500):
+        """
+        :param namespace: namespace to watch
+        :param label_selector: selects the jobs to track
+        :param route_label: label that holds each job's route
+        :param batch: BatchV1Api, defaults to a new one
+        :param watch_timeout: number of seconds after which the server ends each watch request
+        :param retry_delay: number of seconds to wait after an error before listing again
+        :param page_size: maximum number of jobs to fetch in each request when listing them
+        """
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.route_label = route_label
+        self.watch_timeout = watch_timeout
+        self.retry_delay = retry_delay
+        self.page_size = page_size
+        self.on_change = []
+        self.synced = threading.Event()
+        self._batch = batch if batch is not None else client.BatchV1Api()
+        self._lock = threading.Lock()
+        self._active = {}       # uid -> route of every job that has not finished
+        self._seen = set()      # uid of every job, finished or not, from the latest list and the watch since
+        self._stop = threading.Event()
+        self._thread = None
+
+    def active_jobs(self)->dict:
+        """
+        :return: dict of uid -> route for every job that has not finished
+        """
+        with self._lock:
+            return dict(self._active)
+
+    def has_seen(self, uid:str)->bool:
+        with self._lock:
+            return uid in self._seen
+
+    def _route_of(self, job)->str:
+        labels = job.metadata.labels or {}
+        return labels.get(self.route_label, "")
+
+    def _notify(self):
+        for callback in self.on_change:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("Job informer callback failed: {0}".format(str(e)), exc_info=e)
+
+    def _apply(self, event_type:str, job):
+        uid = job.metadata.uid
+        with self._lock:
+            if event_type=="DELETED" or job_is_finished(job):
+                self._active.pop(uid, None)
+            else:
+                self._active[uid] = self._route_of(job)
+            if event_type=="DELETED":
+                self._seen.discard(uid)
+            else:
+                self._seen.add(uid)
+
+    def relist(self)->str:
+        """
+        replaces the local copy with a fresh list of the jobs.  The jobs are fetched a page at a time, and the local copy
+        is only replaced once every page has been read
+        :return: resource version to watch from
+        """
+        active = {}
+        seen = set()
+        list_version = None
+        continue_token = None
+        while True:
+            args = {"label_selector": self.label_selector, "limit": self.page_size}
+            if continue_token is not None:
+                args["_continue"] = continue_token
+            try:
+                job_list = self._batch.list_namespaced_job(self.namespace, **args)
+            except kubernetes.client.exceptions.ApiException as e:
+                if e.status==410 and continue_token is not None:
+                    # the list snapshot expired before we got to the end, start again
+                    logger.warning("Job list expired before the informer finished paging through it, starting again")
+                    active = {}
+                    seen = set()
+                    list_version = None
+                    continue_token = None
+                    continue
+                raise
+
+            if list_version is None:
+                list_version = job_list.metadata.resource_version
+            for job in job_list.items:
+                seen.add(job.metadata.uid)
+                if not job_is_finished(job):
+                    active[job.metadata.uid] = self._route_of(job)
+            continue_token = job_list.metadata._continue
+            if not continue_token:
+                break
+
+        with self._lock:
+            self._active = active
+            self._seen = seen
+        logger.info("Job informer listed %s jobs in %s, %s of them active", len(seen), self.namespace, len(active))
+        self.synced.set()
+        self._notify()
+        return list_version
+
+    def _watch(self, resource_version:str):
+        # StrictWatch raises an ApiException with status 410 if resource_version is too old, and run() then lists again
+        w = StrictWatch()
+        while not self._stop.is_set():
+            for event in w.stream(self._batch.list_namespaced_job, self.namespace, label_selector=self.label_selector,
+                                  resource_version=resource_version, timeout_seconds=self.watch_timeout):
+                if self._stop.is_set():
+                    w.stop()
+                    return
+                self._apply(event["type"], event["object"])
+                resource_version = event["object"].metadata.resource_version
+                self._notify()
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self._watch(self.relist())
+            except kubernetes.client.exceptions.ApiException as e:
+                if e.status!=410:
+                    logger.warning("Job informer could not list or watch jobs: {0}".format(str(e)))
+                    self._stop.wait(self.retry_delay)
+            except Exception as e:
+                logger.warning("Job informer failed: {0}".format(str(e)), exc_info=e)
+                self._stop.wait(self.retry_delay)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="JobInformer", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
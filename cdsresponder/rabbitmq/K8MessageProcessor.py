@@ -60,7 +60,11 @@ class K8Message(object):
 class K8MessageProcessor(MessageProcessor):
     schema = K8Message.schema
     routing_key = "cds.job.*"
+    # most status messages need no work, but failed and success ones download the pod logs
+    prefetch_count = 16
+    target_latency = 10.0
     pod_log_basepath = os.getenv("POD_LOGS_BASEPATH")   #if this is not set then no pod logs will be written
+    deduplicator = None
 
     @staticmethod
     def get_should_keep_jobs():
@@ -72,7 +76,12 @@ class K8MessageProcessor(MessageProcessor):
         else:
             raise ValueError("You must set KEEP_JOBS to either 'yes' or 'no'. Remember to quote these strings in a yaml document.")
 
-    def __init__(self, namespace:str):
+    def __init__(self, namespace:str, deduplicator=None):
+        """
+        :param namespace: namespace to fall back to if we are not running in a cluster
+        :param deduplicator: LaunchDeduplicator to tell about failed jobs, so that their requests can be tried again
+        """
+        self.deduplicator = deduplicator
         try:
             config.load_incluster_config()
         except config.config_exception.ConfigException as e:
@@ -118,19 +127,22 @@ class K8MessageProcessor(MessageProcessor):
     def valid_message_receive(self, channel: pika.spec.Channel, exchange_name, routing_key, delivery_tag, body):
             msg = K8Message(body)
 
-            logger.debug("Got a {0} message for job {1} ({2}) from exchange {3}".format(routing_key, msg.job_name, msg.job_id, exchange_name))
+            logger.debug("Got a %s message for job %s (%s) from exchange %s", routing_key, msg.job_name, msg.job_id, exchange_name)
+
+            if routing_key == "cds.job.failed" and self.deduplicator is not None:
+                self.deduplicator.forget_job(msg.job_id)
 
             if routing_key == "cds.job.failed" or routing_key == "cds.job.success":
                 try:
                     saved_logs = self.read_logs(msg.job_name, msg.job_namespace)
-                    logger.info("Job {0} terminated, saved {1} pod logs".format(msg.job_name, saved_logs))
+                    logger.info("Job %s terminated, saved %s pod logs", msg.job_name, saved_logs)
                 except Exception as e:
                     logger.error("Could not save job logs for {0}: {1}".format(msg.job_name, str(e)), exc_info=e)
 
                 if self.should_keep_jobs:
-                    logger.info("Retaining job information {0} in cluster as KEEP_JOBS is set to 'true' or 'yes'. Remove it or set to 'no' in order to remove completed jobs.")
+                    logger.info("Retaining job information %s in cluster as KEEP_JOBS is set to 'true' or 'yes'. Remove it or set to 'no' in order to remove completed jobs.", msg.job_name)
                 else:
-                    logger.info("Removing completed job {0}...".format(msg.job_name))
+                    logger.info("Removing completed job %s...", msg.job_name)
                     self.safe_delete_job(msg.job_name, msg.job_namespace)
             else:
-                logger.info("Job {0} is in progress".format(msg.job_name))
\ No newline at end of file
+                logger.info("Job %s is in progress", msg.job_name)
\ No newline at end of file
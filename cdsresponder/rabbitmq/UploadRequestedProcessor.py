@@ -1,6 +1,7 @@
 from .messageprocessor import MessageProcessor
+from cds.priority import PriorityPolicy
+from cds.dedup import LaunchDeduplicator, LaunchedJob, idempotency_key
 import logging
-import lxml.etree as xml
 import os
 import pathlib
 import random
@@ -8,12 +9,21 @@ import string
 import pika
 import traceback
 import re
+import threading
+import time
+import datetime
 logger = logging.getLogger(__name__)
 
 
 class UploadRequestedProcessor(MessageProcessor):
     my_exchange = "cdsresponder"
+    # the route that the job runs, so that cdsreaper can keep timings per route
+    ROUTE_LABEL = "cds-route"
+    # unix time at which the upload request that led to the job was received
+    UPLOAD_RECEIVED_ANNOTATION = "cdsresponder/upload-received"
     routing_key = "deliverables.syndication.*.upload"
+    prefetch_count = 8
+    target_latency = 5.0
     schema = {
         "type": "object",
         "properties": {
@@ -40,6 +50,9 @@ class UploadRequestedProcessor(MessageProcessor):
             },
             "routename": {
                 "type": "string"
+            },
+            "priority": {
+                "enum": ["low", "normal", "high", None]
             }
         },
         "required": ["inmeta","routename"]
@@ -47,8 +60,51 @@ class UploadRequestedProcessor(MessageProcessor):
 
     def __init__(self):
         from cds.cds_launcher import CDSLauncher    #imported here so that it can be patched out during testing
-        self.xsd_validator = xml.XMLSchema(file=UploadRequestedProcessor.find_inmeta_xsd())
+        from cds.inmeta_validator import InmetaValidator
+        self.inmeta_validator = InmetaValidator(UploadRequestedProcessor.find_inmeta_xsd(),
+                                                process_threshold=int(os.getenv("INMETA_PROCESS_THRESHOLD", 1024*1024)),
+                                                max_processes=int(os.getenv("INMETA_PROCESSES", 2)))
+        # stops two threads from picking the same inmeta filename
+        self._filename_lock = threading.Lock()
         self.launcher = CDSLauncher(os.getenv("NAMESPACE")) #NAMESPACE arg is only used if we are not in-cluster
+        self.priority_policy = PriorityPolicy.from_environment()
+        self.admission = self.build_admission_controller()
+        self.admission_wait = float(os.getenv("ADMISSION_WAIT_SECONDS", 600))
+        dedup_window = float(os.getenv("DEDUP_WINDOW_SECONDS", 3600))
+        # a duplicate waits for the request that is launching its job, which can itself wait for admission first and
+        # then take a while to launch, so it has to be allowed longer than that
+        self.deduplicator = LaunchDeduplicator(self.launcher.batch, self.launcher.namespace, dedup_window,
+                                               lookup_timeout=self.admission_wait + 120) if dedup_window > 0 else None
+
+    def build_admission_controller(self):
+        """
+        sets up an AdmissionController if MAX_CONCURRENT_JOBS, MAX_JOBS_PER_ROUTE or ROUTE_JOB_LIMITS are set
+        :return: AdmissionController, or None if the number of jobs is not limited
+        """
+        from cds.admission import AdmissionController, parse_route_limits
+        from cds.cds_launcher import CDSLauncher
+        from k8s.jobinformer import JobInformer
+        max_jobs = int(os.getenv("MAX_CONCURRENT_JOBS", 0))
+        max_jobs_per_route = int(os.getenv("MAX_JOBS_PER_ROUTE", 0))
+        route_limits = {self.make_safe_label(route): limit for route, limit in parse_route_limits(os.getenv("ROUTE_JOB_LIMITS")).items()}
+        if max_jobs<=0 and max_jobs_per_route<=0 and len(route_limits)==0:
+            return None
+
+        logger.info("Limiting CDS jobs to %s at once and %s per route, with route limits %s", max_jobs or "any number",
+                    max_jobs_per_route or "any number", route_limits)
+        informer = JobInformer(self.launcher.namespace,
+                               "{0}={1}".format(CDSLauncher.MANAGED_BY_LABEL, CDSLauncher.MANAGED_BY_VALUE),
+                               self.ROUTE_LABEL, page_size=int(os.getenv("RELIST_PAGE_SIZE", 500)))
+        controller = AdmissionController(informer, max_jobs, max_jobs_per_route, route_limits)
+        informer.start()
+        return controller
+
+    def stop(self):
+        """
+        stops the requests that are waiting for admission from waiting any longer, so that they are requeued
+        """
+        if self.admission is not None:
+            self.admission.close()
 
     @staticmethod
     def find_inmeta_xsd():
@@ -61,13 +117,13 @@ class UploadRequestedProcessor(MessageProcessor):
             "inmeta.xsd"
         )
 
-    def validate_inmeta(self, content:str)->bool:
-        try:
-            parsed_xml = xml.fromstring(content)
-            return self.xsd_validator.validate(parsed_xml)
-        except xml.ParseError as e:
-            logger.error("Incoming inmeta data did not parse as XML: {0}".format(str(e)))
-            return False
+    def validate_inmeta(self, content:str):
+        """
+        checks that the content is an inmeta document
+        :param content: xml content
+        :return: InmetaValidationResult, which is truthy if the content is valid and otherwise has the errors
+        """
+        return self.inmeta_validator.validate(content)
 
     def build_filename(self, path:str, filename_hint:str)->str:
         initial_filename = os.path.join(path, filename_hint + ".inmeta")
@@ -95,10 +151,11 @@ class UploadRequestedProcessor(MessageProcessor):
             logger.error("Incoming filename '{0}' appears blank".format(filename_hint))
             raise RuntimeError("Could not build target filename")
 
-        target_filename = self.build_filename(basepath, without_extensions[0])
-        logger.info("Writing inmeta content to {0}".format(filename_hint))
-        with open(target_filename, "w") as f:
-            f.write(content)
+        with self._filename_lock:
+            target_filename = self.build_filename(basepath, without_extensions[0])
+            logger.info("Writing inmeta content to {0}".format(filename_hint))
+            with open(target_filename, "w") as f:
+                f.write(content)
         return target_filename
 
     @staticmethod
@@ -108,6 +165,7 @@ class UploadRequestedProcessor(MessageProcessor):
 
     def inform_job_status(self, channel: pika.channel.Channel, status: str, body: dict):
         import json
+        body["status-time"] = time.time()
         channel.basic_publish(
             exchange=self.my_exchange,
             routing_key="cds.job.{0}".format(status),
@@ -132,12 +190,15 @@ class UploadRequestedProcessor(MessageProcessor):
             return abbreviated+"..."
 
     def valid_message_receive(self, channel: pika.channel.Channel, exchange_name:str, routing_key:str, delivery_tag:str, body:dict):
-        logger.info("Received upload request from {0} with key {1} and delivery tag {2}".format(exchange_name, routing_key, delivery_tag))
+        received = time.time()
+        logger.info("Received upload request from %s with key %s and delivery tag %s", exchange_name, routing_key, delivery_tag,
+                    extra={"exchange": exchange_name, "routing_key": routing_key, "delivery_tag": delivery_tag})
 
-        if not self.validate_inmeta(body["inmeta"]):
-            logger.error("inmeta term did not validate as an xml inmeta document: {0}".format(self.xsd_validator.error_log))
+        validation = self.validate_inmeta(body["inmeta"])
+        if not validation:
+            logger.error("inmeta term did not validate as an xml inmeta document: {0}".format(validation.error_message))
             logger.error("Offending content was {0}".format(body["inmeta"]))
-            body["error"] = self.xsd_validator.error_log
+            body["error"] = validation.error_message
             self.inform_job_status(channel, "invalid", body)
             raise MessageProcessor.NackMessage
 
@@ -158,17 +219,87 @@ class UploadRequestedProcessor(MessageProcessor):
             "online-id": self.make_safe_label(str(body["online_id"])) if "online_id" in body else "None",
             "nearline-id": self.make_safe_label(str(body["nearline_id"])) if "nearline_id" in body else "None",
             "archive-id": self.make_safe_label(str(body["archive_id"])) if "archive_id" in body else "None",
+            self.ROUTE_LABEL: self.make_safe_label(str(body["routename"])),
+        }
+        # cdsreaper picks this up to time the whole lifecycle of the job, from the request arriving here
+        annotations = {
+            self.UPLOAD_RECEIVED_ANNOTATION: "{0:.3f}".format(received)
         }
 
-        inmeta_file = self.write_out_inmeta(self.launcher.sanitise_job_name(filename_hint), body["inmeta"])
+        key = idempotency_key(body)
+        labels[LaunchDeduplicator.KEY_LABEL] = key
+        if self.deduplicator is not None:
+            try:
+                existing = self.deduplicator.claim(key)
+            except TimeoutError:
+                logger.warning("Upload request %s is still being launched by another thread, requeueing it", delivery_tag)
+                raise MessageProcessor.NackWithRetry
+            if existing is not None:
+                logger.info("Upload request %s is a duplicate of job %s, not launching another", delivery_tag, existing.name)
+                body["job-id"] = existing.uid
+                body["job-name"] = existing.name
+                body["job-namespace"] = existing.namespace
+                self.inform_job_status(channel, "duplicate", body)
+                return
+
+        try:
+            self.launch_job(channel, body, filename_hint, labels, annotations, received)
+        except Exception:
+            if self.deduplicator is not None:
+                self.deduplicator.abandon(key)
+            raise
+        if self.deduplicator is not None:
+            self.deduplicator.record(key, LaunchedJob(body["job-id"], body["job-name"], body["job-namespace"], body["job-created-time"]))
+
+        try:
+            self.inform_job_status(channel, "started", body)
+        except Exception as e:
+            logger.error("Job started but could not inform exchange: {0}".format(e))
+            raise MessageProcessor.NackMessage
+
+    def launch_job(self, channel: pika.channel.Channel, body:dict, filename_hint:str, labels:dict, annotations:dict, received:float):
+        """
+        waits for admission, then writes out the inmeta and launches the job, adding the job's details to the body
+        :param channel: channel to inform of a failed launch
+        :param body: upload request
+        :param filename_hint: name to base the inmeta file and job name on
+        :param labels: labels for the job
+        :param annotations: annotations for the job
+        :param received: unix time at which the request arrived
+        :return: the V1Job that was created
+        """
+        priority = self.priority_policy.level_for(body)
+        reservation = None
+        if self.admission is not None:
+            # hold on to the message until there is room in the cluster for another job
+            reservation = self.admission.acquire(labels[self.ROUTE_LABEL], timeout=self.admission_wait,
+                                                 priority=PriorityPolicy.queue_priority(priority))
+            if reservation is None:
+                logger.warning("No capacity for another %s job after %ss, requeueing the request", labels[self.ROUTE_LABEL], self.admission_wait)
+                raise MessageProcessor.NackWithRetry
+
+        try:
+            inmeta_file = self.write_out_inmeta(self.launcher.sanitise_job_name(filename_hint), body["inmeta"])
+        except Exception:
+            if reservation is not None:
+                self.admission.release(reservation)
+            raise
         job_name = "cds-{0}-{1}".format(filename_hint, self.randomstring(4))
         try:
-            result = self.launcher.launch_cds_job(inmeta_file, job_name, body["routename"], labels)
+            result = self.launcher.launch_cds_job(inmeta_file, job_name, body["routename"], labels, annotations,
+                                                  priority_class_name=self.priority_policy.priority_class(priority))
+            if reservation is not None:
+                self.admission.confirm(reservation, result.metadata.uid)
             body["job-id"] = result.metadata.uid
             body["job-name"] = result.metadata.name
             body["job-namespace"] = result.metadata.namespace
+            body["upload-received-time"] = received
+            created = result.metadata.creation_timestamp
+            body["job-created-time"] = created.timestamp() if isinstance(created, datetime.datetime) else time.time()
         except Exception as e:
             logger.error("Could not launch job for {0}: {1}".format(body, str(e)))
+            if reservation is not None:
+                self.admission.release(reservation)
             os.remove(inmeta_file)
             try:
                 body["job-name"] = job_name
@@ -178,9 +309,4 @@ class UploadRequestedProcessor(MessageProcessor):
             except Exception as e:
                 logger.error("Could not inform exchange of job failure: {0}".format(e))
             raise MessageProcessor.NackMessage
-
-        try:
-            self.inform_job_status(channel, "started", body)
-        except Exception as e:
-            logger.error("Job started but could not inform exchange: {0}".format(e))
-            raise MessageProcessor.NackMessage
+        return result
@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait as wait_for_futures
+
+import pika
+import pika.spec
+
+from .flowcontrol import PrefetchController
+
+logger = logging.getLogger(__name__)
+
+### pika's SelectConnection is single-threaded: every callback, and every call on a channel, has to happen on the thread
+### running its ioloop.  So that a slow kubernetes call or log download in one handler does not hold up every queue (and
+### the connection's heartbeats), WorkerDispatcher runs each handler on a pool of worker threads of its own and the handler
+### is given a ThreadSafeChannel, which hands its acks, nacks and publishes back to the ioloop to be carried out.
+
+
+class ThreadSafeChannel(object):
+    """
+    wraps a pika channel so that it can be used from a worker thread.  Each call is scheduled on the connection's ioloop
+    with add_callback_threadsafe and returns straight away; the calls are carried out in the order in which they were made.
+    """
+    def __init__(self, channel:pika.channel.Channel):
+        self._channel = channel
+
+    def __str__(self):
+        return str(self._channel)
+
+    @property
+    def channel_number(self):
+        return self._channel.channel_number
+
+    def _call_on_ioloop(self, method_name:str, *args, **kwargs):
+        def do_call():
+            try:
+                getattr(self._channel, method_name)(*args, **kwargs)
+            except Exception as e:
+                logger.error("Could not {0} on channel {1}: {2}".format(method_name, self._channel.channel_number, str(e)))
+        self._channel.connection.ioloop.add_callback_threadsafe(do_call)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._call_on_ioloop("basic_ack", delivery_tag=delivery_tag, multiple=multiple)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self._call_on_ioloop("basic_nack", delivery_tag=delivery_tag, multiple=multiple, requeue=requeue)
+
+    def basic_reject(self, delivery_tag=0, requeue=True):
+        self._call_on_ioloop("basic_reject", delivery_tag=delivery_tag, requeue=requeue)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        self._call_on_ioloop("basic_publish", exchange=exchange, routing_key=routing_key, body=body,
+                             properties=properties, mandatory=mandatory)
+
+    def basic_cancel(self, consumer_tag=''):
+        self._call_on_ioloop("basic_cancel", consumer_tag=consumer_tag)
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False):
+        self._call_on_ioloop("basic_qos", prefetch_size=prefetch_size, prefetch_count=prefetch_count, global_qos=global_qos)
+
+
+class WorkerDispatcher(object):
+    """
+    runs a MessageProcessor's raw_message_receive on a pool of worker threads rather than on the pika ioloop.
+    Pass `on_message` to basic_consume in place of raw_message_receive.
+    """
+    def __init__(self, handler, max_workers:int, prefetch_count:int=0, flow_control:PrefetchController=None):
+        """
+        :param handler: MessageProcessor instance
+        :param max_workers: number of messages that can be processed at once.  0 processes them on the ioloop, as before
+        :param prefetch_count: number of unacked messages that the broker should send us, 0 for no limit
+        :param flow_control: if given, the channel's prefetch count is changed as this PrefetchController decides
+        """
+        self.handler = handler
+        self.max_workers = max_workers
+        self.prefetch_count = flow_control.prefetch_count if flow_control is not None else prefetch_count
+        self.flow_control = flow_control
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix=handler.__class__.__name__) if max_workers>0 else None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._shut_down = False
+        self._pending = {}   # Future -> (ThreadSafeChannel, delivery tag) for each message in the pool that is not finished
+
+    @staticmethod
+    def from_mapping(mapping:dict):
+        """
+        builds a WorkerDispatcher for an entry in EXCHANGE_MAPPINGS.  The prefetch count and target latency are taken from
+        the entry's "prefetch_count" and "target_latency" if they are set, otherwise from the handler class.  If neither
+        gives a prefetch count, it is twice the number of workers; if neither gives a target latency, the prefetch
+        count is not adjusted, otherwise it is kept between the number of workers and its starting value
+        :param mapping: dict with "handler" and optionally "max_workers", "prefetch_count" and "target_latency"
+        :return: WorkerDispatcher
+        """
+        handler = mapping["handler"]
+        max_workers = mapping.get("max_workers", 0)
+        prefetch_count = mapping.get("prefetch_count") or handler.prefetch_count or max(max_workers*2, 1)
+        target_latency = mapping.get("target_latency") or handler.target_latency
+        flow_control = PrefetchController(prefetch_count, target_latency, minimum=min(max_workers, prefetch_count)) if target_latency else None
+        return WorkerDispatcher(handler, max_workers, prefetch_count, flow_control)
+
+    def in_flight(self)->int:
+        """
+        :return: the number of messages that have been received but not yet processed
+        """
+        with self._lock:
+            return self._in_flight
+
+    def _handle(self, channel, method:pika.spec.Basic.Deliver, properties:pika.spec.BasicProperties, body:bytes):
+        started = time.monotonic()
+        try:
+            self.handler.raw_message_receive(channel, method, properties, body)
+        finally:
+            if self.flow_control is not None:
+                updated = self.flow_control.record(time.monotonic() - started)
+                if updated is not None:
+                    self.prefetch_count = updated
+                    # the channel only has one consumer, so a channel-wide limit is the same as a per-consumer one,
+                    # and unlike a per-consumer one the broker applies it to a consumer that already exists
+                    channel.basic_qos(prefetch_count=updated, global_qos=True)
+
+    def _run(self, channel, method:pika.spec.Basic.Deliver, properties:pika.spec.BasicProperties, body:bytes):
+        try:
+            self._handle(channel, method, properties, body)
+        except Exception as e:
+            logger.exception("Unhandled error processing message with delivery tag {0} in {1}: {2}"
+                             .format(method.delivery_tag, self.handler.__class__.__name__, str(e)), exc_info=e)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def on_message(self, channel:pika.channel.Channel, method:pika.spec.Basic.Deliver, properties:pika.spec.BasicProperties, body:bytes):
+        """
+        called from the pika library on the ioloop when a message is received, see MessageProcessor.raw_message_receive
+        """
+        if self._executor is None:
+            self._handle(channel, method, properties, body)
+            return
+
+        with self._lock:
+            if self._shut_down:
+                # we are on the ioloop here, so can use the channel directly
+                logger.info("Shutting down, requeueing message with delivery tag %s", method.delivery_tag)
+                channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                return
+            self._in_flight += 1
+            safe_channel = ThreadSafeChannel(channel)
+            future = self._executor.submit(self._run, safe_channel, method, properties, body)
+            # registered under the lock, so that shutdown() sees every message that it has not turned away
+            self._pending[future] = (safe_channel, method.delivery_tag)
+        future.add_done_callback(self._forget)
+
+    def _forget(self, future):
+        with self._lock:
+            self._pending.pop(future, None)
+
+    def shutdown(self, wait:bool=True, timeout:float=None, requeue_waiting:bool=False):
+        """
+        stops accepting messages, requeueing any more that arrive, and optionally waits for the ones in progress to finish
+        :param wait: if True, block until the messages in progress have been processed
+        :param timeout: maximum number of seconds to wait, None to wait for as long as they take.  A message that is
+        still in progress afterwards is left unacked, and the broker requeues it when the connection closes
+        :param requeue_waiting: if True, the messages that are waiting for a worker are requeued rather than processed,
+        and the handler's stop() is called so that the ones in progress give up on anything that they are waiting for
+        :return: the number of messages that were still in progress
+        """
+        with self._lock:
+            self._shut_down = True
+            pending = list(self._pending.items())
+
+        if requeue_waiting:
+            requeued = 0
+            for future, (channel, delivery_tag) in pending:
+                if future.cancel():
+                    # it never started, so _run won't count it off
+                    channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+                    with self._lock:
+                        self._in_flight -= 1
+                    requeued += 1
+            if requeued > 0:
+                logger.info("Requeued {0} messages for {1} that had not started".format(requeued, self.handler.__class__.__name__))
+            try:
+                self.handler.stop()
+            except Exception as e:
+                logger.warning("Could not stop {0}: {1}".format(self.handler.__class__.__name__, str(e)))
+
+        if self._executor is None:
+            return 0
+        if wait:
+            done, not_done = wait_for_futures([future for future, _ in pending if not future.cancelled()], timeout=timeout)
+            if len(not_done) > 0:
+                logger.warning("{0} messages for {1} were still in progress after {2}s, leaving them to be requeued"
+                               .format(len(not_done), self.handler.__class__.__name__, timeout))
+        self._executor.shutdown(wait=False)
+        return self.in_flight()
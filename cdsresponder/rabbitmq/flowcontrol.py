@@ -0,0 +1,67 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+### The broker only sends a consumer as many unacked messages as its prefetch count allows, so the prefetch count bounds
+### how many messages a replica holds in memory waiting for a worker, and so how much of a burst it takes for itself
+### rather than leaving for the other replicas.
+### PrefetchController adjusts the prefetch count as the handler's latency changes: while the smoothed latency is above
+### the target, it halves the prefetch count, down to `minimum`; while it is below three quarters of the target, it adds
+### one, up to `maximum`.  It only makes a change once as many messages as the current prefetch count have been handled,
+### so that each change has a chance to take effect before the next.  The minimum is normally the number of workers,
+### since a lower prefetch count would leave some of them idle.
+
+
+class PrefetchController(object):
+    def __init__(self, initial:int, target_latency:float, minimum:int=1, maximum:int=None, smoothing:float=0.2):
+        """
+        :param initial: prefetch count to start with
+        :param target_latency: number of seconds that handling a message should take
+        :param minimum: lowest prefetch count to set
+        :param maximum: highest prefetch count to set, defaults to `initial`
+        :param smoothing: weight of each new latency in the moving average, between 0 and 1
+        """
+        self.target_latency = target_latency
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum if maximum is not None else initial, self.minimum)
+        self.smoothing = smoothing
+        self._prefetch = min(max(initial, self.minimum), self.maximum)
+        self._average = None
+        self._since_change = 0
+        self._lock = threading.Lock()
+
+    @property
+    def prefetch_count(self)->int:
+        return self._prefetch
+
+    @property
+    def average_latency(self):
+        return self._average
+
+    def record(self, seconds:float):
+        """
+        records how long a message took to handle.  Can be called from any thread
+        :param seconds: handler latency
+        :return: the new prefetch count if it should be changed, otherwise None
+        """
+        with self._lock:
+            if self._average is None:
+                self._average = seconds
+            else:
+                self._average += self.smoothing * (seconds - self._average)
+            self._since_change += 1
+            if self._since_change < self._prefetch:
+                return None
+
+            if self._average > self.target_latency and self._prefetch > self.minimum:
+                updated = max(self._prefetch // 2, self.minimum)
+            elif self._average < self.target_latency * 0.75 and self._prefetch < self.maximum:
+                updated = self._prefetch + 1
+            else:
+                return None
+            logger.info("Handler latency is %.2fs against a target of %.2fs, changing prefetch count from %s to %s",
+                        self._average, self.target_latency, self._prefetch, updated)
+            self._prefetch = updated
+            self._since_change = 0
+            return updated
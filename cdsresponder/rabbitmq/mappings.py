@@ -4,13 +4,27 @@ from .UploadRequestedProcessor import UploadRequestedProcessor
 from .K8MessageProcessor import K8MessageProcessor
 
 ##This structure is imported by name in the run_rabbitmq_responder
+## max_workers is the number of messages for that exchange that can be processed at once, each on its own thread.
+## 0 processes them one at a time on the rabbitmq connection's thread.
+## prefetch_count and target_latency override the handler's own, see WorkerDispatcher.from_mapping.
+## max_priority, if more than 0, declares the queue as a priority queue (x-max-priority), see cds/priority.py.
+upload_requested_processor = UploadRequestedProcessor()
+
 EXCHANGE_MAPPINGS = [
     {
         "exchange": 'pluto-deliverables',
-        "handler": UploadRequestedProcessor(),
+        "handler": upload_requested_processor,
+        "max_workers": int(os.getenv("UPLOAD_REQUEST_WORKERS", 4)),
+        "prefetch_count": int(os.getenv("UPLOAD_REQUEST_PREFETCH", 0)),
+        "target_latency": float(os.getenv("UPLOAD_REQUEST_TARGET_LATENCY", 0)),
+        "max_priority": int(os.getenv("UPLOAD_REQUEST_MAX_PRIORITY", 0)),
     },
     {
         "exchange": 'cdsresponder',
-        "handler": K8MessageProcessor(os.getenv("NAMESPACE")),
+        # failed jobs are dropped from the upload handler's duplicate check, so that they can be requested again
+        "handler": K8MessageProcessor(os.getenv("NAMESPACE"), upload_requested_processor.deduplicator),
+        "max_workers": int(os.getenv("JOB_EVENT_WORKERS", 4)),
+        "prefetch_count": int(os.getenv("JOB_EVENT_PREFETCH", 0)),
+        "target_latency": float(os.getenv("JOB_EVENT_TARGET_LATENCY", 0)),
     }
 ]
@@ -5,6 +5,27 @@ import pika.spec
 
 logger = logging.getLogger(__name__)
 
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+
+def compile_schema(schema:dict, use_fastjsonschema:bool=True):
+    """
+    builds a function that validates content against a json schema.  The schema is checked and compiled once, with
+    fastjsonschema (which generates python code for it) if it is installed, or otherwise into a jsonschema validator
+    :param schema: json schema
+    :param use_fastjsonschema: set to False to always use jsonschema
+    :return: function taking the content to validate, which raises an exception if the content does not validate
+    """
+    if use_fastjsonschema and fastjsonschema is not None:
+        return fastjsonschema.compile(schema)
+
+    validator_class = jsonschema.validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema).validate
+
 
 class MessageProcessor(object):
     """
@@ -12,12 +33,24 @@ class MessageProcessor(object):
     """
     schema = None       # override this in a subclass
     routing_key = None  # override this in a subclass
+    prefetch_count = None   # number of unacked messages the broker sends us at once, see WorkerDispatcher.from_mapping
+    target_latency = None   # seconds; if set, the prefetch count is lowered while messages take longer than this to handle
 
     class NackMessage(Exception):
         pass
     class NackWithRetry(Exception):
         pass
 
+    # the schema is compiled once for each subclass, when it is defined
+    _validator = None
+    _validator_schema = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.schema and cls.schema is not cls._validator_schema:
+            cls._validator = staticmethod(compile_schema(cls.schema))
+            cls._validator_schema = cls.schema
+
     def valid_message_receive(self, channel:pika.spec.Channel, exchange_name, routing_key, delivery_tag, body):
         """
         override this method in a subclass in order to receive information
@@ -28,12 +61,24 @@ class MessageProcessor(object):
         :param body:
         :return:
         """
-        logger.debug("Received validated message from {0} via {1} with {2}: {3}".format(exchange_name, routing_key, delivery_tag, body))
+        logger.debug("Received validated message from %s via %s with %s: %s", exchange_name, routing_key, delivery_tag, body)
+        pass
+
+    def stop(self):
+        """
+        called when the responder is shutting down.  Override this in a subclass whose handler can wait a long time for
+        something, so that the messages in progress give up and are requeued rather than holding up the shutdown
+        :return:
+        """
         pass
 
     def validate_with_schema(self, body):
         content = json.loads(body.decode('UTF-8'))
-        jsonschema.validate(content, self.schema)   # throws an exception if the content does not validate
+        if self.schema is not self._validator_schema:
+            # the schema has been replaced since the class was defined
+            self._validator = compile_schema(self.schema)
+            self._validator_schema = self.schema
+        self._validator(content)   # throws an exception if the content does not validate
         return content  #if we get to this line, then validation was successful
 
     def raw_message_receive(self, channel, method:pika.spec.Basic.Deliver, properties:pika.spec.BasicProperties, body:bytes):
@@ -52,7 +97,8 @@ class MessageProcessor(object):
         tag = method.delivery_tag
         validated_content = None
         try:
-            logger.debug("Received message with delivery tag {2} from {0}: {1}".format(channel, body.decode('UTF-8'), tag))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received message with delivery tag %s from %s: %s", tag, channel, body.decode('UTF-8', errors='replace'))
 
             if self.schema:
                 validated_content = self.validate_with_schema(body)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+measures the per-message cost of validating messages against the UploadRequestedProcessor and K8MessageProcessor
+schemas, with jsonschema.validate (as cdsresponder used to), a compiled jsonschema validator and fastjsonschema.
+
+    python schemabench.py [--number 20000] [--max-us 20]
+"""
+import argparse
+import sys
+import timeit
+
+import jsonschema
+
+from rabbitmq.K8MessageProcessor import K8Message
+from rabbitmq.UploadRequestedProcessor import UploadRequestedProcessor
+from rabbitmq.messageprocessor import compile_schema, fastjsonschema
+
+SAMPLES = {
+    "UploadRequestedProcessor": (UploadRequestedProcessor.schema, {
+        "deliverable_asset": 1234,
+        "deliverable_bundle": 56,
+        "filename": "some-file.mxf",
+        "online_id": "VX-1234",
+        "nearline_id": None,
+        "archive_id": None,
+        "inmeta": "<?xml version=\"1.0\"?><meta-data><meta-group type=\"movie meta\"><meta name=\"itemId\" value=\"VX-1234\"/></meta-group></meta-data>",
+        "routename": "some-route.xml",
+    }),
+    "K8MessageProcessor": (K8Message.schema, {
+        "job-id": "5c3d7a5e-1b2c-4d3e-8f9a-0b1c2d3e4f5a",
+        "job-name": "cds-some-file-abcd",
+        "job-namespace": "cds",
+        "retry-count": 1,
+        "failure-reason": "BackoffLimitExceeded",
+    }),
+}
+
+
+def time_per_call(fn, number:int)->float:
+    """
+    :return: the best of three runs, in microseconds per call
+    """
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Benchmark json schema validation of cdsresponder's messages")
+    parser.add_argument("--number", type=int, default=20000, help="validations per timed run")
+    parser.add_argument("--max-us", type=float, default=None, help="fail if the compiled validator takes longer than this per message")
+    args = parser.parse_args()
+
+    print("{0:<26} {1:>14} {2:>14} {3:>14}".format("schema", "validate", "jsonschema", "fastjsonschema"))
+    failures = []
+    for name, (schema, content) in SAMPLES.items():
+        uncompiled = time_per_call(lambda: jsonschema.validate(content, schema), max(args.number // 20, 1))
+        compiled_jsonschema = compile_schema(schema, use_fastjsonschema=False)
+        with_jsonschema = time_per_call(lambda: compiled_jsonschema(content), args.number)
+        if fastjsonschema is not None:
+            compiled_fast = compile_schema(schema)
+            with_fast = time_per_call(lambda: compiled_fast(content), args.number)
+        else:
+            with_fast = None
+        print("{0:<26} {1:>12.1f}us {2:>12.1f}us {3:>14}".format(name, uncompiled, with_jsonschema,
+                                                                   "{0:.1f}us".format(with_fast) if with_fast is not None else "not installed"))
+
+        in_use = with_fast if with_fast is not None else with_jsonschema
+        if args.max_us is not None and in_use > args.max_us:
+            failures.append("{0} validation takes {1:.1f}us, more than {2}us".format(name, in_use, args.max_us))
+
+    for f in failures:
+        print("FAILED: {0}".format(f))
+    sys.exit(1 if len(failures)>0 else 0)
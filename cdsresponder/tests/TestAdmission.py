@@ -0,0 +1,309 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import json
+import threading
+import time
+
+import kubernetes.client.exceptions
+
+from cds.admission import AdmissionController, parse_route_limits
+from k8s.jobinformer import JobInformer
+
+
+class FakeInformer(object):
+    def __init__(self, active=None):
+        self.active = active if active is not None else {}
+        self.seen = set(self.active.keys())
+        self.on_change = []
+        self.synced = threading.Event()
+        self.synced.set()
+
+    def active_jobs(self):
+        return dict(self.active)
+
+    def has_seen(self, uid):
+        return uid in self.seen
+
+    def add(self, uid, route):
+        self.active[uid] = route
+        self.seen.add(uid)
+        for callback in self.on_change:
+            callback()
+
+    def finish(self, uid):
+        del self.active[uid]
+        for callback in self.on_change:
+            callback()
+
+
+class FakeResponse(object):
+    """
+    stands in for the urllib3 response that the kubernetes client streams a watch from
+    """
+    def __init__(self, events:list):
+        self._chunks = [(json.dumps(event) + "\n").encode("UTF-8") for event in events]
+        self.close = MagicMock()
+        self.release_conn = MagicMock()
+
+    def read_chunked(self, decode_content=False):
+        return iter(self._chunks)
+
+
+class TestAdmissionController(TestCase):
+    def test_global_limit(self):
+        """
+        acquire should admit jobs until the global limit is reached, counting launches the informer has not seen yet
+        :return:
+        """
+        informer = FakeInformer({"uid-1": "route-a"})
+        to_test = AdmissionController(informer, max_jobs=2)
+        reservation = to_test.acquire("route-b", timeout=0)
+        self.assertIsNotNone(reservation)
+        self.assertIsNone(to_test.acquire("route-c", timeout=0.05))
+
+        to_test.confirm(reservation, "uid-2")
+        informer.add("uid-2", "route-b")
+        self.assertEqual(to_test.running(), (2, {"route-a": 1, "route-b": 1}))
+
+        informer.finish("uid-1")
+        self.assertIsNotNone(to_test.acquire("route-c", timeout=0))
+
+    def test_route_limit(self):
+        """
+        acquire should limit each route separately, with overrides for particular routes
+        :return:
+        """
+        informer = FakeInformer({"uid-1": "route-a", "uid-2": "route-b"})
+        to_test = AdmissionController(informer, max_jobs_per_route=1, route_limits={"route-b": 2})
+        self.assertIsNone(to_test.acquire("route-a", timeout=0))
+        self.assertIsNotNone(to_test.acquire("route-b", timeout=0))
+        self.assertIsNone(to_test.acquire("route-b", timeout=0))
+        self.assertIsNotNone(to_test.acquire("route-c", timeout=0))
+
+    def test_waits_for_capacity(self):
+        """
+        a handler waiting in acquire should be admitted as soon as a job finishes
+        :return:
+        """
+        informer = FakeInformer({"uid-1": "route-a"})
+        to_test = AdmissionController(informer, max_jobs=1)
+        threading.Timer(0.1, informer.finish, args=("uid-1",)).start()
+        started = time.monotonic()
+        self.assertIsNotNone(to_test.acquire("route-a", timeout=5))
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_priority_order(self):
+        """
+        when capacity frees up, the highest priority waiter should be admitted first, then the earliest
+        :return:
+        """
+        informer = FakeInformer({"uid-1": "route-a"})
+        to_test = AdmissionController(informer, max_jobs=1)
+        admitted = []
+
+        def wait(name, priority):
+            reservation = to_test.acquire("route-a", timeout=5, priority=priority)
+            admitted.append(name)
+            to_test.confirm(reservation, "uid-" + name)
+            informer.add("uid-" + name, "route-a")
+
+        threads = []
+        for name, priority in (("bulk-1", 1), ("urgent", 9), ("bulk-2", 1)):
+            t = threading.Thread(target=wait, args=(name, priority))
+            t.start()
+            threads.append(t)
+            time.sleep(0.05)
+
+        running = "uid-1"
+        for i in range(3):
+            informer.finish(running)
+            deadline = time.monotonic() + 2
+            # wait for the next waiter to be admitted and its job to appear
+            while not (len(admitted) > i and "uid-" + admitted[i] in informer.active) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            running = "uid-" + admitted[i]
+        for t in threads:
+            t.join(5)
+        self.assertEqual(admitted, ["urgent", "bulk-1", "bulk-2"])
+
+    def test_release_and_timeout(self):
+        """
+        released reservations, and ones the informer never sees, should stop counting
+        :return:
+        """
+        informer = FakeInformer()
+        to_test = AdmissionController(informer, max_jobs=1, reservation_timeout=0.1)
+        reservation = to_test.acquire("route-a", timeout=0)
+        to_test.release(reservation)
+        reservation = to_test.acquire("route-a", timeout=0)
+        self.assertIsNotNone(reservation)
+        self.assertIsNone(to_test.acquire("route-a", timeout=0))
+        time.sleep(0.15)
+        self.assertIsNotNone(to_test.acquire("route-a", timeout=0))
+
+    def test_not_synced(self):
+        """
+        nothing should be admitted until the informer has listed the jobs
+        :return:
+        """
+        informer = FakeInformer()
+        informer.synced.clear()
+        to_test = AdmissionController(informer, max_jobs=5)
+        self.assertIsNone(to_test.acquire("route-a", timeout=0.05))
+
+    def test_close(self):
+        """
+        closing the controller should make a handler that is waiting for capacity give up straight away
+        :return:
+        """
+        informer = FakeInformer({"uid-1": "route-a"})
+        to_test = AdmissionController(informer, max_jobs=1)
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(to_test.acquire("route-a", timeout=30)))
+        waiter.start()
+        time.sleep(0.1)
+        to_test.close()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(results, [None])
+        self.assertIsNone(to_test.acquire("route-b", timeout=30))
+
+    def test_parse_route_limits(self):
+        self.assertEqual(parse_route_limits("route-a.xml=2, route-b.xml=5"), {"route-a.xml": 2, "route-b.xml": 5})
+        self.assertEqual(parse_route_limits(None), {})
+        with self.assertRaises(ValueError):
+            parse_route_limits("route-a.xml")
+
+
+class TestJobInformer(TestCase):
+    def make_job(self, uid, route, finished=False):
+        job = MagicMock()
+        job.metadata.uid = uid
+        job.metadata.labels = {"cds-route": route}
+        if finished:
+            condition = MagicMock()
+            condition.type = "Complete"
+            condition.status = "True"
+            job.status.conditions = [condition]
+        else:
+            job.status.conditions = None
+        return job
+
+    def test_relist_and_events(self):
+        """
+        the informer should track the jobs that have not finished, from the list and then from watch events
+        :return:
+        """
+        job_list = MagicMock()
+        job_list.items = [self.make_job("uid-1", "route-a"), self.make_job("uid-2", "route-b", finished=True)]
+        job_list.metadata.resource_version = "1234"
+        job_list.metadata._continue = None
+        mock_batch = MagicMock()
+        mock_batch.list_namespaced_job = MagicMock(return_value=job_list)
+        changes = []
+
+        to_test = JobInformer("cds", "app.kubernetes.io/managed-by=cdsresponder", "cds-route", batch=mock_batch)
+        to_test.on_change.append(lambda: changes.append(1))
+        self.assertEqual(to_test.relist(), "1234")
+        self.assertTrue(to_test.synced.is_set())
+        self.assertEqual(to_test.active_jobs(), {"uid-1": "route-a"})
+        self.assertTrue(to_test.has_seen("uid-2"))
+        mock_batch.list_namespaced_job.assert_called_once_with("cds", label_selector="app.kubernetes.io/managed-by=cdsresponder", limit=500)
+
+        to_test._apply("ADDED", self.make_job("uid-3", "route-a"))
+        to_test._apply("MODIFIED", self.make_job("uid-1", "route-a", finished=True))
+        self.assertEqual(to_test.active_jobs(), {"uid-3": "route-a"})
+        to_test._apply("DELETED", self.make_job("uid-3", "route-a"))
+        self.assertEqual(to_test.active_jobs(), {})
+        self.assertFalse(to_test.has_seen("uid-3"))
+        self.assertEqual(len(changes), 1)
+
+    def test_relist_pages(self):
+        """
+        relist should page through the jobs, starting again if the list expires, and take its resource version from the
+        first page of the list it finished
+        :return:
+        """
+        def make_page(items, resource_version, continue_token):
+            page = MagicMock()
+            page.items = items
+            page.metadata.resource_version = resource_version
+            page.metadata._continue = continue_token
+            return page
+
+        mock_batch = MagicMock()
+        mock_batch.list_namespaced_job.side_effect = [
+            make_page([self.make_job("uid-0", "route-c")], "1000", "token-a"),
+            kubernetes.client.exceptions.ApiException(status=410),
+            make_page([self.make_job("uid-1", "route-a")], "2000", "token-b"),
+            make_page([self.make_job("uid-2", "route-b"), self.make_job("uid-3", "route-b", finished=True)], "2000", None),
+        ]
+
+        to_test = JobInformer("cds", "app.kubernetes.io/managed-by=cdsresponder", "cds-route", batch=mock_batch, page_size=2)
+        self.assertEqual(to_test.relist(), "2000")
+        self.assertEqual(to_test.active_jobs(), {"uid-1": "route-a", "uid-2": "route-b"})
+        self.assertFalse(to_test.has_seen("uid-0"))
+        self.assertTrue(to_test.has_seen("uid-3"))
+        calls = mock_batch.list_namespaced_job.call_args_list
+        self.assertEqual(calls[1].kwargs, {"label_selector": "app.kubernetes.io/managed-by=cdsresponder", "limit": 2,
+                                           "_continue": "token-a"})
+        self.assertNotIn("_continue", calls[2].kwargs)
+        self.assertEqual(calls[3].kwargs["_continue"], "token-b")
+
+    def test_relist_after_gone(self):
+        """
+        when the watch's resource version has expired, the informer should list the jobs again rather than watching
+        from the same version for ever.  This runs a real kubernetes Watch over the server's 410 ERROR event
+        :return:
+        """
+        from kubernetes.client import BatchV1Api, V1JobList, V1ListMeta
+        calls = []
+
+        def fake_call_api(resource_path, method, path_params, query_params, *args, **kwargs):
+            params = dict(query_params)
+            calls.append(params)
+            if len(calls) >= 10:
+                # it is stuck watching the expired version
+                to_test.stop()
+            if params.get("watch"):
+                return FakeResponse([{"type": "ERROR", "object": {"kind": "Status", "code": 410, "reason": "Expired",
+                                                                  "message": "too old resource version: 999"}}])
+            if len([c for c in calls if not c.get("watch")]) >= 2:
+                to_test.stop()
+            return V1JobList(items=[self.make_job("uid-1", "route-a")], metadata=V1ListMeta(resource_version="999"))
+
+        api_client = MagicMock()
+        api_client.call_api = MagicMock(side_effect=fake_call_api)
+        to_test = JobInformer("cds", "app.kubernetes.io/managed-by=cdsresponder", "cds-route", batch=BatchV1Api(api_client))
+        to_test.run()
+
+        self.assertEqual([bool(c.get("watch")) for c in calls], [False, True, False])
+        self.assertEqual(calls[1]["resourceVersion"], "999")
+        self.assertEqual(to_test.active_jobs(), {"uid-1": "route-a"})
+
+
+class TestPriorityPolicy(TestCase):
+    def test_parse_route_priorities(self):
+        from cds.priority import parse_route_priorities
+        self.assertEqual(parse_route_priorities("news.xml=high, backfill.xml=LOW,"), {"news.xml": "high", "backfill.xml": "low"})
+        self.assertEqual(parse_route_priorities(None), {})
+        with self.assertRaises(ValueError):
+            parse_route_priorities("news.xml=urgent")
+
+    def test_from_environment(self):
+        """
+        from_environment should read the route priorities, priority classes and default from the given environment
+        """
+        from cds.priority import PriorityPolicy
+        policy = PriorityPolicy.from_environment({"ROUTE_PRIORITIES": "news.xml=high",
+                                                  "PRIORITY_CLASS_HIGH": "cds-urgent",
+                                                  "PRIORITY_CLASS_LOW": "",
+                                                  "DEFAULT_PRIORITY": "Low"})
+        self.assertEqual(policy.level_for({"routename": "news.xml"}), "high")
+        self.assertEqual(policy.level_for({"routename": "news.xml", "priority": "normal"}), "normal")
+        self.assertEqual(policy.level_for({"routename": "other.xml", "priority": None}), "low")
+        self.assertEqual(policy.priority_class("high"), "cds-urgent")
+        self.assertIsNone(policy.priority_class("low"))
+        self.assertEqual(PriorityPolicy.queue_priority("high"), 9)
+        with self.assertRaises(ValueError):
+            PriorityPolicy.from_environment({"DEFAULT_PRIORITY": "urgent"})
@@ -3,6 +3,23 @@ import re
 
 
 class TestCDSLauncher(TestCase):
+    TEST_TEMPLATE = """apiVersion: batch/v1
+kind: Job
+metadata:
+  name: cds-job
+  labels:
+    app: cds
+spec:
+  backoffLimit: 2
+  template:
+    spec:
+      restartPolicy: Never
+      containers:
+        - name: cds
+          image: guardianmultimedia/cds:latest
+          command: ["/bin/false"]
+"""
+
     def test_sanitise_job_name_length(self):
         """
         sanitise_job_name should never return more than 63 characters and should strip spaces
@@ -30,4 +47,83 @@ class TestCDSLauncher(TestCase):
         long_test_name = "this is a very long test name which is not going to get th in its entirety, because it is really too long"
         sanitised = CDSLauncher.sanitise_job_name(long_test_name)
 
-        self.assertEqual(sanitised, "this-is-a-very-long-test-name-which-is-not-going-to-get-th")
\ No newline at end of file
+        self.assertEqual(sanitised, "this-is-a-very-long-test-name-which-is-not-going-to-get-th")
+    def test_build_job_doc(self):
+        """
+        build_job_doc should fill in the job name, command and labels from the template, and add the managed-by label
+        :return:
+        """
+        import os
+        import tempfile
+        from cds.cds_launcher import CDSLauncher
+        with tempfile.TemporaryDirectory() as tempdir:
+            with open(os.path.join(tempdir, "cdsjob.yaml"), "w") as f:
+                f.write(self.TEST_TEMPLATE)
+            os.environ["TEMPLATES_PATH"] = tempdir
+            launcher = CDSLauncher.__new__(CDSLauncher)
+
+            doc = launcher.build_job_doc("Some Job", ["/bin/true", "--flag"], {"deliverable-asset-id": "1234"},
+                                         {"cdsresponder/upload-received": "1234.5"}, "cds-urgent")
+            del os.environ["TEMPLATES_PATH"]
+
+        self.assertEqual(doc["metadata"]["name"], "some-job")
+        self.assertEqual(doc["metadata"]["labels"]["deliverable-asset-id"], "1234")
+        self.assertEqual(doc["metadata"]["labels"]["app.kubernetes.io/managed-by"], "cdsresponder")
+        self.assertEqual(doc["metadata"]["annotations"]["cdsresponder/upload-received"], "1234.5")
+        self.assertEqual(doc["spec"]["template"]["spec"]["containers"][0]["command"], ["/bin/true", "--flag"])
+        self.assertEqual(doc["spec"]["template"]["spec"]["priorityClassName"], "cds-urgent")
+
+    def test_template_cache(self):
+        """
+        load_job_template should only parse the template again when the file changes, and build_job_doc should not
+        change the cached template
+        :return:
+        """
+        import os
+        import tempfile
+        from unittest.mock import patch
+        from cds.cds_launcher import CDSLauncher
+        with tempfile.TemporaryDirectory() as tempdir:
+            template_path = os.path.join(tempdir, "cdsjob.yaml")
+            with open(template_path, "w") as f:
+                f.write(self.TEST_TEMPLATE)
+            os.environ["TEMPLATES_PATH"] = tempdir
+            launcher = CDSLauncher.__new__(CDSLauncher)
+
+            try:
+                with patch("cds.cds_launcher.CDSLauncher.parse_job_template", wraps=CDSLauncher.parse_job_template) as mock_parse:
+                    first = launcher.build_job_doc("first", ["/bin/true"], {"deliverable-asset-id": "1"})
+                    second = launcher.build_job_doc("second", ["/bin/true"], {"deliverable-asset-id": "2"})
+                    self.assertEqual(mock_parse.call_count, 1)
+
+                    with open(template_path, "w") as f:
+                        f.write(self.TEST_TEMPLATE.replace("backoffLimit: 2", "backoffLimit: 5"))
+                    stat = os.stat(template_path)
+                    os.utime(template_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+                    third = launcher.build_job_doc("third", ["/bin/true"], {})
+                    self.assertEqual(mock_parse.call_count, 2)
+            finally:
+                del os.environ["TEMPLATES_PATH"]
+
+        self.assertEqual(first["metadata"]["labels"]["deliverable-asset-id"], "1")
+        self.assertEqual(second["metadata"]["labels"]["deliverable-asset-id"], "2")
+        self.assertEqual(first["metadata"]["name"], "first")
+        self.assertNotIn("deliverable-asset-id", third["metadata"]["labels"])
+        self.assertNotIn("priorityClassName", third["spec"]["template"]["spec"])
+        self.assertEqual(first["spec"]["backoffLimit"], 2)
+        self.assertEqual(third["spec"]["backoffLimit"], 5)
+
+    def test_parse_job_template_not_job(self):
+        """
+        parse_job_template should raise a ValueError if the file does not define a Job
+        :return:
+        """
+        import os
+        import tempfile
+        from cds.cds_launcher import CDSLauncher
+        with tempfile.TemporaryDirectory() as tempdir:
+            template_path = os.path.join(tempdir, "cdsjob.yaml")
+            with open(template_path, "w") as f:
+                f.write(self.TEST_TEMPLATE.replace("kind: Job", "kind: Pod"))
+            with self.assertRaises(ValueError):
+                CDSLauncher.parse_job_template(template_path)
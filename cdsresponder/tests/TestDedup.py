@@ -0,0 +1,91 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+import datetime
+import threading
+import time
+
+from cds.dedup import LaunchDeduplicator, LaunchedJob, idempotency_key
+
+
+def fake_job(uid:str, age:float=0, failed:bool=False):
+    job = MagicMock()
+    job.metadata.uid = uid
+    job.metadata.name = "cds-" + uid
+    job.metadata.namespace = "cds"
+    job.metadata.creation_timestamp = datetime.datetime.fromtimestamp(time.time() - age, datetime.timezone.utc)
+    condition = MagicMock()
+    condition.type = "Failed"
+    condition.status = "True"
+    job.status.conditions = [condition] if failed else None
+    return job
+
+
+class TestLaunchDeduplicator(TestCase):
+    def test_idempotency_key(self):
+        """
+        the key should depend on the asset, bundle, route and inmeta, and nothing else
+        """
+        body = {"deliverable_asset": 1, "deliverable_bundle": 2, "routename": "route.xml", "inmeta": "<meta/>"}
+        self.assertEqual(idempotency_key(body), idempotency_key(dict(body, filename="other.mxf", priority="high")))
+        self.assertNotEqual(idempotency_key(body), idempotency_key(dict(body, deliverable_bundle=3)))
+        self.assertNotEqual(idempotency_key(body), idempotency_key(dict(body, inmeta="<meta></meta>")))
+        self.assertEqual(len(idempotency_key(body)), 40)
+
+    def test_claim_finds_existing_job(self):
+        """
+        claim should return a job found by label that is within the window and has not failed, and cache it
+        """
+        batch = MagicMock()
+        batch.list_namespaced_job.return_value.items = [fake_job("failed", failed=True), fake_job("old", age=7200),
+                                                        fake_job("running", age=60)]
+        to_test = LaunchDeduplicator(batch, "cds", window=3600)
+        result = to_test.claim("somekey")
+        self.assertEqual(result.uid, "running")
+        batch.list_namespaced_job.assert_called_once_with("cds", label_selector="cds-idempotency-key=somekey")
+
+        self.assertEqual(to_test.claim("somekey").uid, "running")
+        batch.list_namespaced_job.assert_called_once()
+
+    def test_claim_nothing_found(self):
+        """
+        claim should return None if there is no usable job, or the lookup fails
+        """
+        batch = MagicMock()
+        batch.list_namespaced_job.return_value.items = [fake_job("failed", failed=True)]
+        to_test = LaunchDeduplicator(batch, "cds")
+        self.assertIsNone(to_test.claim("somekey"))
+        to_test.abandon("somekey")
+
+        batch.list_namespaced_job.side_effect = RuntimeError("api unavailable")
+        self.assertIsNone(to_test.claim("somekey"))
+
+    def test_concurrent_claim(self):
+        """
+        a second claim for a key that is being launched should wait, then get the job that was launched
+        """
+        batch = MagicMock()
+        batch.list_namespaced_job.return_value.items = []
+        to_test = LaunchDeduplicator(batch, "cds")
+        self.assertIsNone(to_test.claim("somekey"))
+
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(to_test.claim("somekey")))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertEqual(results, [])
+        to_test.record("somekey", LaunchedJob("new-uid", "cds-new", "cds"))
+        waiter.join(5)
+        self.assertEqual(results[0].uid, "new-uid")
+
+    def test_window(self):
+        """
+        a recorded job should stop counting once it is older than the window
+        """
+        batch = MagicMock()
+        batch.list_namespaced_job.return_value.items = []
+        to_test = LaunchDeduplicator(batch, "cds", window=0.1)
+        to_test.claim("somekey")
+        to_test.record("somekey", LaunchedJob("new-uid", "cds-new", "cds"))
+        self.assertEqual(to_test.claim("somekey").uid, "new-uid")
+        time.sleep(0.15)
+        self.assertIsNone(to_test.claim("somekey"))
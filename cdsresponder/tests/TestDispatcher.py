@@ -0,0 +1,247 @@
+from rabbitmq.dispatcher import ThreadSafeChannel, WorkerDispatcher
+from rabbitmq.messageprocessor import MessageProcessor
+from unittest.mock import MagicMock
+from unittest import TestCase
+import threading
+import time
+import pika
+
+import logging
+logging.basicConfig(level=logging.FATAL)
+
+
+class FakeIOLoop(object):
+    """
+    collects the callbacks passed to add_callback_threadsafe, so that the test can run them as the ioloop would
+    """
+    def __init__(self):
+        self.callbacks = []
+        self.threads = []
+
+    def add_callback_threadsafe(self, callback):
+        self.threads.append(threading.current_thread())
+        self.callbacks.append(callback)
+
+    def run_callbacks(self):
+        while len(self.callbacks)>0:
+            self.callbacks.pop(0)()
+
+
+def make_channel(ioloop:FakeIOLoop):
+    mock_channel = MagicMock(target=pika.channel.Channel)
+    mock_channel.connection.ioloop = ioloop
+    return mock_channel
+
+
+class TestThreadSafeChannel(TestCase):
+    def test_marshals_calls(self):
+        """
+        ThreadSafeChannel should not call the channel directly, but schedule the calls on the ioloop in the order they were made
+        :return:
+        """
+        ioloop = FakeIOLoop()
+        mock_channel = make_channel(ioloop)
+        to_test = ThreadSafeChannel(mock_channel)
+
+        to_test.basic_publish(exchange="some-exchange", routing_key="some.key", body="content")
+        to_test.basic_ack(delivery_tag=1234)
+        mock_channel.basic_publish.assert_not_called()
+        mock_channel.basic_ack.assert_not_called()
+
+        ioloop.run_callbacks()
+        mock_channel.basic_publish.assert_called_once_with(exchange="some-exchange", routing_key="some.key", body="content",
+                                                           properties=None, mandatory=False)
+        mock_channel.basic_ack.assert_called_once_with(delivery_tag=1234, multiple=False)
+        self.assertEqual([c[0] for c in mock_channel.method_calls], ["basic_publish", "basic_ack"])
+
+    def test_closed_channel(self):
+        """
+        an error from the channel should be logged rather than raised on the ioloop
+        :return:
+        """
+        ioloop = FakeIOLoop()
+        mock_channel = make_channel(ioloop)
+        mock_channel.basic_nack = MagicMock(side_effect=pika.exceptions.ChannelClosed(406, "closed"))
+
+        ThreadSafeChannel(mock_channel).basic_nack(delivery_tag=1234, requeue=False)
+        ioloop.run_callbacks()
+        mock_channel.basic_nack.assert_called_once_with(delivery_tag=1234, multiple=False, requeue=False)
+
+
+class TestWorkerDispatcher(TestCase):
+    def make_method(self, tag):
+        mock_method = MagicMock(target=pika.spec.Basic.Deliver)
+        mock_method.delivery_tag = tag
+        return mock_method
+
+    def test_runs_on_worker(self):
+        """
+        WorkerDispatcher should run the handler on a worker thread, and the ack it sends should be carried out on the ioloop
+        :return:
+        """
+        class TestProcessor(MessageProcessor):
+            schema = {"type": "object"}
+
+        handled_on = []
+        handler = TestProcessor()
+        handler.valid_message_receive = MagicMock(side_effect=lambda *args: handled_on.append(threading.current_thread()))
+        ioloop = FakeIOLoop()
+        mock_channel = make_channel(ioloop)
+
+        to_test = WorkerDispatcher(handler, max_workers=2)
+        to_test.on_message(mock_channel, self.make_method(1234), MagicMock(), b'{"key": "value"}')
+        to_test.shutdown(wait=True)
+
+        self.assertEqual(len(handled_on), 1)
+        self.assertNotEqual(handled_on[0], threading.current_thread())
+        mock_channel.basic_ack.assert_not_called()
+        self.assertEqual(ioloop.threads, handled_on)
+        ioloop.run_callbacks()
+        mock_channel.basic_ack.assert_called_once_with(delivery_tag=1234, multiple=False)
+        self.assertEqual(to_test.in_flight(), 0)
+
+    def test_concurrency_limit(self):
+        """
+        WorkerDispatcher should process no more than max_workers messages at once
+        :return:
+        """
+        lock = threading.Lock()
+        running = [0]
+        most_running = [0]
+        release = threading.Event()
+
+        def slow_receive(*args):
+            with lock:
+                running[0] += 1
+                most_running[0] = max(most_running[0], running[0])
+            release.wait(5)
+            with lock:
+                running[0] -= 1
+
+        handler = MagicMock(target=MessageProcessor)
+        handler.raw_message_receive = MagicMock(side_effect=slow_receive)
+        to_test = WorkerDispatcher(handler, max_workers=2)
+        for i in range(5):
+            to_test.on_message(make_channel(FakeIOLoop()), self.make_method(i), MagicMock(), b'{}')
+        self.assertEqual(to_test.in_flight(), 5)
+
+        release.set()
+        to_test.shutdown(wait=True)
+        self.assertEqual(handler.raw_message_receive.call_count, 5)
+        self.assertEqual(most_running[0], 2)
+
+    def test_inline(self):
+        """
+        with no workers, WorkerDispatcher should call the handler directly with the real channel
+        :return:
+        """
+        handler = MagicMock(target=MessageProcessor)
+        mock_channel = make_channel(FakeIOLoop())
+        mock_method = self.make_method(1234)
+
+        to_test = WorkerDispatcher(handler, max_workers=0)
+        to_test.on_message(mock_channel, mock_method, "props", b'{}')
+        handler.raw_message_receive.assert_called_once_with(mock_channel, mock_method, "props", b'{}')
+
+    def test_requeue_after_shutdown(self):
+        """
+        messages that arrive after shutdown should be requeued without being processed
+        :return:
+        """
+        handler = MagicMock(target=MessageProcessor)
+        mock_channel = make_channel(FakeIOLoop())
+
+        to_test = WorkerDispatcher(handler, max_workers=2)
+        to_test.shutdown(wait=True)
+        to_test.on_message(mock_channel, self.make_method(1234), MagicMock(), b'{}')
+        handler.raw_message_receive.assert_not_called()
+        mock_channel.basic_nack.assert_called_once_with(delivery_tag=1234, requeue=True)
+
+    def test_shutdown_requeues_queued(self):
+        """
+        shutdown should requeue the messages that are waiting for a worker, stop the handler, and only wait for the one in
+        progress for as long as the timeout
+        :return:
+        """
+        ioloop = FakeIOLoop()
+        mock_channel = make_channel(ioloop)
+        release = threading.Event()
+        started = threading.Event()
+
+        def slow_receive(channel, method, properties, body):
+            started.set()
+            release.wait(5)
+        handler = MagicMock(target=MessageProcessor)
+        handler.raw_message_receive.side_effect = slow_receive
+
+        to_test = WorkerDispatcher(handler, max_workers=1)
+        for tag in (1, 2, 3):
+            to_test.on_message(mock_channel, self.make_method(tag), MagicMock(), b'{}')
+        self.assertTrue(started.wait(5))
+        self.assertEqual(to_test.in_flight(), 3)
+
+        still_running = to_test.shutdown(wait=True, timeout=0.1, requeue_waiting=True)
+        self.assertEqual(still_running, 1)
+        handler.stop.assert_called_once_with()
+        ioloop.run_callbacks()
+        self.assertEqual(mock_channel.basic_nack.call_count, 2)
+        mock_channel.basic_nack.assert_any_call(delivery_tag=2, multiple=False, requeue=True)
+        mock_channel.basic_nack.assert_any_call(delivery_tag=3, multiple=False, requeue=True)
+        handler.raw_message_receive.assert_called_once()
+
+        release.set()
+        for i in range(50):
+            if to_test.in_flight()==0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(to_test.in_flight(), 0)
+
+    def test_from_mapping(self):
+        """
+        from_mapping should take the prefetch count and target latency from the mapping, falling back to the handler's
+        :return:
+        """
+        class TestProcessor(MessageProcessor):
+            prefetch_count = 8
+            target_latency = 5.0
+
+        class UnconfiguredProcessor(MessageProcessor):
+            pass
+
+        result = WorkerDispatcher.from_mapping({"handler": TestProcessor(), "max_workers": 2})
+        self.assertEqual(result.prefetch_count, 8)
+        self.assertEqual(result.flow_control.target_latency, 5.0)
+        self.assertEqual(result.flow_control.minimum, 2)
+        result.shutdown()
+
+        result = WorkerDispatcher.from_mapping({"handler": TestProcessor(), "max_workers": 2, "prefetch_count": 3, "target_latency": 1.5})
+        self.assertEqual(result.prefetch_count, 3)
+        self.assertEqual(result.flow_control.target_latency, 1.5)
+        result.shutdown()
+
+        result = WorkerDispatcher.from_mapping({"handler": UnconfiguredProcessor(), "max_workers": 3, "prefetch_count": 0, "target_latency": 0})
+        self.assertEqual(result.prefetch_count, 6)
+        self.assertIsNone(result.flow_control)
+        result.shutdown()
+
+    def test_flow_control(self):
+        """
+        when the flow controller changes the prefetch count, the dispatcher should set it on the channel via the ioloop
+        :return:
+        """
+        from rabbitmq.flowcontrol import PrefetchController
+        handler = MagicMock(target=MessageProcessor)
+        flow_control = PrefetchController(4, target_latency=1.0, minimum=1)
+        flow_control.record = MagicMock(side_effect=[None, 2])
+        ioloop = FakeIOLoop()
+        mock_channel = make_channel(ioloop)
+
+        to_test = WorkerDispatcher(handler, max_workers=1, flow_control=flow_control)
+        self.assertEqual(to_test.prefetch_count, 4)
+        to_test.on_message(mock_channel, self.make_method(1), MagicMock(), b'{}')
+        to_test.on_message(mock_channel, self.make_method(2), MagicMock(), b'{}')
+        to_test.shutdown(wait=True)
+        ioloop.run_callbacks()
+
+        mock_channel.basic_qos.assert_called_once_with(prefetch_size=0, prefetch_count=2, global_qos=True)
+        self.assertEqual(to_test.prefetch_count, 2)
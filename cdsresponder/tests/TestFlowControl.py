@@ -0,0 +1,48 @@
+from rabbitmq.flowcontrol import PrefetchController
+from unittest import TestCase
+
+
+class TestPrefetchController(TestCase):
+    def test_lowers_when_slow(self):
+        """
+        PrefetchController should halve the prefetch count, down to the minimum, once a window of messages has been slow
+        :return:
+        """
+        to_test = PrefetchController(16, target_latency=1.0, minimum=4)
+        results = [to_test.record(2.0) for _ in range(15)]
+        self.assertEqual(results, [None]*15)
+        self.assertEqual(to_test.record(2.0), 8)
+        self.assertEqual([to_test.record(2.0) for _ in range(8)], [None]*7 + [4])
+        self.assertEqual([to_test.record(2.0) for _ in range(8)], [None]*8)
+        self.assertEqual(to_test.prefetch_count, 4)
+
+    def test_raises_when_fast(self):
+        """
+        PrefetchController should add one to the prefetch count when messages are quick, but not go over the maximum
+        :return:
+        """
+        to_test = PrefetchController(4, target_latency=1.0, minimum=2, maximum=5)
+        to_test._prefetch = 2
+        self.assertEqual([to_test.record(0.1) for _ in range(2)], [None, 3])
+        self.assertEqual([to_test.record(0.1) for _ in range(3)], [None, None, 4])
+        self.assertEqual([to_test.record(0.1) for _ in range(4)], [None, None, None, 5])
+        self.assertEqual([to_test.record(0.1) for _ in range(10)], [None]*10)
+
+    def test_holds_near_target(self):
+        """
+        PrefetchController should leave the prefetch count alone while the latency is between 3/4 of the target and the target
+        :return:
+        """
+        to_test = PrefetchController(8, target_latency=1.0, minimum=1, maximum=16)
+        self.assertEqual([to_test.record(0.9) for _ in range(20)], [None]*20)
+        self.assertEqual(to_test.prefetch_count, 8)
+
+    def test_smoothing(self):
+        """
+        a single slow message should not be enough to lower the prefetch count
+        :return:
+        """
+        to_test = PrefetchController(2, target_latency=1.0, minimum=1, smoothing=0.2)
+        to_test.record(0.5)
+        self.assertIsNone(to_test.record(3.0))
+        self.assertAlmostEqual(to_test.average_latency, 1.0)
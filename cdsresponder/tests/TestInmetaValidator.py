@@ -0,0 +1,93 @@
+from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import signal
+
+from cds.inmeta_validator import InmetaValidator
+from rabbitmq.UploadRequestedProcessor import UploadRequestedProcessor
+
+logging.basicConfig(level=logging.FATAL)
+
+
+class TestInmetaValidator(TestCase):
+    VALID_DOC = """<?xml version="1.0" encoding="UTF-8"?>
+<meta-data><meta-group type="movie meta"><meta name="itemId" value="VX-{0}"/></meta-group></meta-data>"""
+    INVALID_DOC = """<?xml version="1.0"?>
+<meta-data><meta-group type="movie meta"><meta name="itemId" vilue="VX-{0}"/></meta-group></meta-data>"""
+
+    def test_validate(self):
+        """
+        validate should return a truthy result for a valid document, and a falsy one with the errors for an invalid or
+        malformed one
+        :return:
+        """
+        to_test = InmetaValidator(UploadRequestedProcessor.find_inmeta_xsd())
+        self.assertTrue(to_test.validate(self.VALID_DOC.format(1)))
+        self.assertTrue(to_test.validate(self.VALID_DOC.format(1).encode("UTF-8")))
+
+        result = to_test.validate(self.INVALID_DOC.format(1))
+        self.assertFalse(result)
+        self.assertIn("vilue", result.error_message)
+
+        result = to_test.validate("<meta-data><meta-group>")
+        self.assertFalse(result)
+        self.assertGreater(len(result.errors), 0)
+
+    def test_concurrent_errors(self):
+        """
+        each result should only have the errors from its own document, when documents are validated on several threads
+        :return:
+        """
+        to_test = InmetaValidator(UploadRequestedProcessor.find_inmeta_xsd())
+        expected_errors = to_test.validate(self.INVALID_DOC.format(1)).errors
+        self.assertEqual(len(expected_errors), 2)
+
+        def check(i):
+            doc = self.INVALID_DOC.format(i) if i % 2 else self.VALID_DOC.format(i)
+            return i, to_test.validate(doc)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(check, range(200)))
+        for i, result in results:
+            if i % 2:
+                self.assertFalse(result)
+                self.assertEqual(result.errors, [e.replace("VX-1", "VX-{0}".format(i)) for e in expected_errors])
+            else:
+                self.assertTrue(result)
+                self.assertEqual(result.errors, [])
+
+    def test_process_pool(self):
+        """
+        documents over the size threshold should be validated in a separate process, with the same results
+        :return:
+        """
+        to_test = InmetaValidator(UploadRequestedProcessor.find_inmeta_xsd(), process_threshold=10, max_processes=1)
+        try:
+            self.assertTrue(to_test.validate(self.VALID_DOC.format(1)))
+            result = to_test.validate(self.INVALID_DOC.format(1))
+            self.assertFalse(result)
+            self.assertIn("vilue", result.error_message)
+            self.assertIsNotNone(to_test._pool)
+        finally:
+            to_test.shutdown()
+
+    def test_broken_pool(self):
+        """
+        if a process in the pool is killed, the pool should be replaced and the document validated in the new one
+        :return:
+        """
+        to_test = InmetaValidator(UploadRequestedProcessor.find_inmeta_xsd(), process_threshold=10, max_processes=1)
+        try:
+            self.assertTrue(to_test.validate(self.VALID_DOC.format(1)))
+            broken_pool = to_test._pool
+            for process in list(broken_pool._processes.values()):
+                os.kill(process.pid, signal.SIGKILL)
+                process.join(5)
+
+            self.assertTrue(to_test.validate(self.VALID_DOC.format(2)))
+            self.assertIsNotNone(to_test._pool)
+            self.assertIsNot(to_test._pool, broken_pool)
+            self.assertFalse(to_test.validate(self.INVALID_DOC.format(3)))
+        finally:
+            to_test.shutdown()
@@ -69,6 +69,24 @@ class TestK8MessageProcessor(TestCase):
         processor.read_logs.assert_called_once_with("some-job","job-namespace")
         processor.safe_delete_job.assert_called_once_with("some-job","job-namespace")
 
+    def test_valid_message_receive_failure_dedup(self):
+        """
+        valid_message_receive should drop a failed job from the upload handler's duplicate check, but not a successful one
+        :return:
+        """
+        test_msg = {
+            "job-id": "some-id",
+            "job-name": "some-job",
+            "job-namespace": "job-namespace",
+        }
+
+        processor = self.ToTest("test-namespace", False)
+        processor.deduplicator = MagicMock()
+        processor.valid_message_receive(MagicMock(pika.channel.Channel), "some-exchange", "cds.job.success", 1, test_msg)
+        processor.deduplicator.forget_job.assert_not_called()
+        processor.valid_message_receive(MagicMock(pika.channel.Channel), "some-exchange", "cds.job.failed", 2, test_msg)
+        processor.deduplicator.forget_job.assert_called_once_with("some-id")
+
     def test_valid_message_receive_success_nodel(self):
         """
         valid_message_receive should try to delete the pod if it was asked not to
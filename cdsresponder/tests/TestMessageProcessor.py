@@ -105,4 +105,57 @@ class TestMessageProcessorRawReceive(TestCase):
                                                               {'id': 12345, 'title': 'Some title', 'junk_field': 'junk'}
                                                               )
         mock_channel.basic_ack.assert_not_called()
-        mock_channel.basic_nack.assert_called_once_with(delivery_tag="deltag", requeue=False)
\ No newline at end of file
+        mock_channel.basic_nack.assert_called_once_with(delivery_tag="deltag", requeue=False)
+
+class TestMessageProcessorSchema(TestCase):
+    def test_compiled_once(self):
+        """
+        a subclass's schema should be compiled when the class is defined, not for every message
+        :return:
+        """
+        with patch("rabbitmq.messageprocessor.compile_schema", return_value=MagicMock()) as mock_compile:
+            class TestProcessor(MessageProcessor):
+                schema = TestMessageProcessorRawReceive.MOCK_SCHEMA
+
+            to_test = TestProcessor()
+            to_test.validate_with_schema(b'{"id": 1, "title": "first"}')
+            to_test.validate_with_schema(b'{"id": 2, "title": "second"}')
+            mock_compile.assert_called_once_with(TestMessageProcessorRawReceive.MOCK_SCHEMA)
+            self.assertEqual(TestProcessor._validator.call_count, 2)
+
+    def test_replaced_schema(self):
+        """
+        if an instance's schema is replaced, that schema should be used instead
+        :return:
+        """
+        class TestProcessor(MessageProcessor):
+            schema = TestMessageProcessorRawReceive.MOCK_SCHEMA
+
+        to_test = TestProcessor()
+        to_test.schema = {"type": "object", "required": ["other"]}
+        self.assertEqual(to_test.validate_with_schema(b'{"other": true}'), {"other": True})
+        with self.assertRaises(Exception):
+            to_test.validate_with_schema(b'{"id": 1, "title": "first"}')
+
+    def test_compile_schema(self):
+        """
+        compile_schema should give the same results with and without fastjsonschema
+        :return:
+        """
+        from rabbitmq.messageprocessor import compile_schema
+        for use_fastjsonschema in (True, False):
+            validate = compile_schema(TestMessageProcessorRawReceive.MOCK_SCHEMA, use_fastjsonschema=use_fastjsonschema)
+            validate({"id": 1, "title": "valid"})
+            with self.assertRaises(Exception):
+                validate({"id": "1", "title": "valid"})
+            with self.assertRaises(Exception):
+                validate({"title": "no id"})
+
+    def test_invalid_schema(self):
+        """
+        an invalid schema should be rejected when the class is defined
+        :return:
+        """
+        with self.assertRaises(Exception):
+            class TestProcessor(MessageProcessor):
+                schema = {"type": "not-a-type"}
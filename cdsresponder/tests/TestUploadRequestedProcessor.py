@@ -183,4 +183,148 @@ class TestUploadRequestedProcessor(TestCase):
             mocked_launcher.launch_cds_job.assert_called_once()
             self.assertEqual(mocked_launcher.launch_cds_job.call_args[0][0], "/path/to/mdpacket.inmeta")
             self.assertEqual(mocked_launcher.launch_cds_job.call_args[0][2], fake_message["routename"])
-            to_test.inform_job_status.assert_called_once()
\ No newline at end of file
+            self.assertEqual(mocked_launcher.launch_cds_job.call_args[0][3]["cds-route"], "someroute.xml")
+            self.assertIn("cdsresponder/upload-received", mocked_launcher.launch_cds_job.call_args[0][4])
+            self.assertIn("upload-received-time", fake_message)
+            to_test.inform_job_status.assert_called_once()
+    def test_valid_message_receive_admission(self):
+        """
+        valid_message_receive should wait for admission before launching the job, confirm the reservation with the new
+        job's uid, and requeue the message if there is no capacity
+        :return:
+        """
+        from rabbitmq.messageprocessor import MessageProcessor
+        mocked_launcher = MagicMock(target=cds.cds_launcher.CDSLauncher)
+        mocked_launcher.sanitise_job_name = MagicMock(return_value="sanitised-job-name")
+        mocked_launcher.launch_cds_job.return_value.metadata.uid = "new-uid"
+        mocked_channel = MagicMock(target=pika.channel.Channel)
+
+        with patch("cds.cds_launcher.CDSLauncher", return_value=mocked_launcher):
+            from rabbitmq.UploadRequestedProcessor import UploadRequestedProcessor
+            to_test = UploadRequestedProcessor()
+            to_test.validate_inmeta = MagicMock(return_value=True)
+            to_test.write_out_inmeta = MagicMock(return_value="/path/to/mdpacket.inmeta")
+            to_test.inform_job_status = MagicMock()
+            to_test.admission = MagicMock()
+            to_test.admission.acquire = MagicMock(return_value="reservation")
+            to_test.deduplicator = None     # the same message is sent twice
+
+            fake_message = {"inmeta": "metdata-goes-here", "filename": "somefile.mxf", "routename": "someroute.xml"}
+            to_test.valid_message_receive(mocked_channel, "some-exchange", "routing.key", "2345", dict(fake_message))
+            to_test.admission.acquire.assert_called_once_with("someroute.xml", timeout=to_test.admission_wait, priority=5)
+            to_test.admission.confirm.assert_called_once_with("reservation", "new-uid")
+
+            to_test.admission.acquire = MagicMock(return_value=None)
+            mocked_launcher.launch_cds_job.reset_mock()
+            with self.assertRaises(MessageProcessor.NackWithRetry):
+                to_test.valid_message_receive(mocked_channel, "some-exchange", "routing.key", "2346", dict(fake_message))
+            mocked_launcher.launch_cds_job.assert_not_called()
+
+    def test_valid_message_receive_priority(self):
+        """
+        valid_message_receive should take the request's priority from its route, or its own priority field, and use it
+        for admission and the job's priority class
+        :return:
+        """
+        from cds.priority import PriorityPolicy
+        mocked_launcher = MagicMock(target=cds.cds_launcher.CDSLauncher)
+        mocked_launcher.sanitise_job_name = MagicMock(return_value="sanitised-job-name")
+        mocked_channel = MagicMock(target=pika.channel.Channel)
+
+        with patch("cds.cds_launcher.CDSLauncher", return_value=mocked_launcher):
+            from rabbitmq.UploadRequestedProcessor import UploadRequestedProcessor
+            to_test = UploadRequestedProcessor()
+            to_test.validate_inmeta = MagicMock(return_value=True)
+            to_test.write_out_inmeta = MagicMock(return_value="/path/to/mdpacket.inmeta")
+            to_test.inform_job_status = MagicMock()
+            to_test.admission = MagicMock()
+            to_test.priority_policy = PriorityPolicy({"news.xml": "high"}, {"high": "cds-urgent", "low": "cds-bulk"})
+            to_test.deduplicator = None
+
+            to_test.valid_message_receive(mocked_channel, "some-exchange", "routing.key", "1",
+                                          {"inmeta": "metadata", "filename": "news.mxf", "routename": "news.xml"})
+            self.assertEqual(to_test.admission.acquire.call_args[1]["priority"], 9)
+            self.assertEqual(mocked_launcher.launch_cds_job.call_args[1]["priority_class_name"], "cds-urgent")
+
+            to_test.valid_message_receive(mocked_channel, "some-exchange", "routing.key", "2",
+                                          {"inmeta": "metadata", "filename": "news.mxf", "routename": "news.xml", "priority": "low"})
+            self.assertEqual(to_test.admission.acquire.call_args[1]["priority"], 1)
+            self.assertEqual(mocked_launcher.launch_cds_job.call_args[1]["priority_class_name"], "cds-bulk")
+
+            to_test.valid_message_receive(mocked_channel, "some-exchange", "routing.key", "3",
+                                          {"inmeta": "metadata", "filename": "other.mxf", "routename": "other.xml"})
+            self.assertEqual(to_test.admission.acquire.call_args[1]["priority"], 5)
+            self.assertIsNone(mocked_launcher.launch_cds_job.call_args[1]["priority_class_name"])
+
+    def test_valid_message_receive_duplicate(self):
+        """
+        valid_message_receive should label the job with the request's idempotency key, and ack a repeat of the request
+        with a cds.job.duplicate message pointing at the first job rather than launching another
+        :return:
+        """
+        from cds.dedup import LaunchDeduplicator
+        mocked_launcher = MagicMock(target=cds.cds_launcher.CDSLauncher)
+        mocked_launcher.sanitise_job_name = MagicMock(return_value="sanitised-job-name")
+        mocked_launcher.launch_cds_job.return_value.metadata.uid = "first-uid"
+        mocked_launcher.launch_cds_job.return_value.metadata.name = "cds-somefile-abcd"
+        mocked_launcher.launch_cds_job.return_value.metadata.namespace = "cds"
+        mocked_launcher.launch_cds_job.return_value.metadata.creation_timestamp = None
+        mocked_channel = MagicMock(target=pika.channel.Channel)
+
+        with patch("cds.cds_launcher.CDSLauncher", return_value=mocked_launcher):
+            from rabbitmq.UploadRequestedProcessor import UploadRequestedProcessor
+            to_test = UploadRequestedProcessor()
+            to_test.validate_inmeta = MagicMock(return_value=True)
+            to_test.write_out_inmeta = MagicMock(return_value="/path/to/mdpacket.inmeta")
+            to_test.inform_job_status = MagicMock()
+            batch = MagicMock()
+            batch.list_namespaced_job.return_value.items = []
+            to_test.deduplicator = LaunchDeduplicator(batch, "cds")
+
+            fake_message = {"inmeta": "metdata-goes-here", "filename": "somefile.mxf", "routename": "someroute.xml", "deliverable_asset": 12}
+            to_test.valid_message_receive(mocked_channel, "some-exchange", "routing.key", "1", dict(fake_message))
+            key = mocked_launcher.launch_cds_job.call_args[0][3][LaunchDeduplicator.KEY_LABEL]
+            self.assertEqual(batch.list_namespaced_job.call_args[1]["label_selector"], "cds-idempotency-key={0}".format(key))
+            self.assertEqual(to_test.inform_job_status.call_args[0][1], "started")
+
+            to_test.valid_message_receive(mocked_channel, "some-exchange", "routing.key", "2", dict(fake_message))
+            mocked_launcher.launch_cds_job.assert_called_once()
+            self.assertEqual(to_test.inform_job_status.call_args[0][1], "duplicate")
+            self.assertEqual(to_test.inform_job_status.call_args[0][2]["job-name"], "cds-somefile-abcd")
+
+            # a different asset is a different request
+            to_test.valid_message_receive(mocked_channel, "some-exchange", "routing.key", "3", dict(fake_message, deliverable_asset=13))
+            self.assertEqual(mocked_launcher.launch_cds_job.call_count, 2)
+
+            # a job that failed can be tried again
+            to_test.deduplicator.forget_job("first-uid")
+            to_test.valid_message_receive(mocked_channel, "some-exchange", "routing.key", "4", dict(fake_message))
+            self.assertEqual(mocked_launcher.launch_cds_job.call_count, 3)
+
+    def test_valid_message_receive_duplicate_timeout(self):
+        """
+        a duplicate should wait for longer than the first request can wait for admission, and be requeued rather than
+        failed if the first request still hasn't finished launching
+        :return:
+        """
+        from cds.dedup import LaunchDeduplicator, idempotency_key
+        from rabbitmq.messageprocessor import MessageProcessor
+        mocked_launcher = MagicMock(target=cds.cds_launcher.CDSLauncher)
+        mocked_channel = MagicMock(target=pika.channel.Channel)
+
+        with patch("cds.cds_launcher.CDSLauncher", return_value=mocked_launcher):
+            from rabbitmq.UploadRequestedProcessor import UploadRequestedProcessor
+            to_test = UploadRequestedProcessor()
+            self.assertGreater(to_test.deduplicator.lookup_timeout, to_test.admission_wait)
+
+            to_test.validate_inmeta = MagicMock(return_value=True)
+            batch = MagicMock()
+            batch.list_namespaced_job.return_value.items = []
+            to_test.deduplicator = LaunchDeduplicator(batch, "cds", lookup_timeout=0.05)
+            fake_message = {"inmeta": "metdata-goes-here", "filename": "somefile.mxf", "routename": "someroute.xml"}
+            # another thread is launching the same request
+            to_test.deduplicator.claim(idempotency_key(fake_message))
+
+            with self.assertRaises(MessageProcessor.NackWithRetry):
+                to_test.valid_message_receive(mocked_channel, "some-exchange", "routing.key", "2", dict(fake_message))
+            mocked_launcher.launch_cds_job.assert_not_called()